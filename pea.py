@@ -30,30 +30,31 @@
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
-import os, sys, json, time, ast, datetime, binascii, asyncio, platform, shlex, importlib
+import os, sys, json, time, ast, binascii, platform, shlex
+
+if __name__ == "__main__" and len(sys.argv) > 1:  # headless mode, never touches tkinter
+    from peacore.cli import main as cli_main
+    sys.exit(cli_main())
+
 import tkinter.ttk as ttk
-from tkinter import Tk, filedialog, messagebox, VERTICAL, TRUE, FALSE, Text, Canvas, Frame, Menu, PhotoImage, NW, YES, BOTH, LEFT, RIGHT, END, TOP, BOTTOM, Y, X, Toplevel, IntVar, TclError, StringVar
+from tkinter import Tk, filedialog, messagebox, simpledialog, VERTICAL, TRUE, FALSE, Text, Canvas, Frame, Menu, PhotoImage, NW, YES, BOTH, LEFT, RIGHT, END, TOP, BOTTOM, Y, X, Toplevel, IntVar, TclError, StringVar, READABLE
 
+from peacore import Device, Template, EngineThread, EventQueue, Waker, LogStore, FilterCache, FILTER_MODES, CaptureWriter, SessionRecorder, Profiler
 
-async def run_tk(root, interval=0.01):
-    """
-    Run a tkinter app in an asyncio event loop.
-    """
-    try:
-        while root.winfo_exists():  # Window not closed
-            root.update()
-            await asyncio.sleep(interval)
-    except TclError as e:
-        if "application has been destroyed" not in e.args[0]:
-            raise
+FRAME_INTERVAL = 0.04  # seconds between terminal redraws, 25 per second at most
+TERMINAL_LINES = 10000  # default number of lines shown in the terminal
+FILTER_CHUNK = 5000  # records a filter tests per Tk callback, more wait for the next one
+CAPTURE_DIR = "captures"  # rotating capture files of the GUI session
+PROFILE_DIR = "profiles"  # reports of the engine profiler
 
 
 class Window(Frame):
-    def __init__(self, master=None):
-        """ create the master frame class """
+    def __init__(self, master=None, engine=None):
+        """ create the master frame class, engine is the thread the sockets run in """
 
         Frame.__init__(self, master)
         self.master = master
+        self.engine = engine
         self.init_window()
 
     def init_window(self):
@@ -64,14 +65,34 @@ class Window(Frame):
         self.pack(fill=BOTH, expand=1)
         self.colorList = ["#FF0000", "#00FF00", "#DDEEFF", "#009900", "#000099"]
         self.terminalrunning = True
-        self.commandsList = None
-        self.devscript = None
+        self.logstore = LogStore()
+        self.filters = FilterCache(self.logstore)
+        self.activefilter = None  # filter of the open filter window
+        self.filterjob = None  # pending after() that tests the next chunk of records
+        self.filtershown = 0
+        self.terminallines = TERMINAL_LINES
+        self.rendered = 0  # index of the first record not in the terminal yet
+        self.shown = 0  # lines in the terminal
+        self.renderpending = False
+        self.lastrender = 0.0
+        self.waker = Waker() if hasattr(self.master.tk, "createfilehandler") else None  # not on Windows
+        self.events = EventQueue(self.waker.notify if self.waker else None)
+        self.pollinterval = 10
+        self.device = Device()  # lives in the engine thread, only touch it through self.engine
+        self.device.listeners.append(self.events.log)
+        self.device.watchers.append(self.events.clients)
+        self.clients = []
         
         self.port = {"listen": 0, "connected": 0}
         self.portopen = False
-        self.mySocket = None
-        self.loop = None   
         self.logmodeactive = IntVar()
+        self.captureactive = IntVar()
+        self.capture = None
+        self.capturelistener = None
+        self.recordactive = IntVar()
+        self.recorder = None
+        self.profiler = Profiler(PROFILE_DIR, "pea-gui")
+        self.profileactive = {"cprofile": IntVar(), "sample": IntVar()}
         self.showbytecount = IntVar()
         self.fname = None
 
@@ -81,6 +102,9 @@ class Window(Frame):
         filemenu = Menu(menubar, tearoff=0)
         filemenu.add_command(label="Browse for Emulator JSON File", command=self.browseFunction)
         filemenu.add_separator()
+        filemenu.add_checkbutton(label="Capture to Files", variable=self.captureactive, command=self.captureFunction)
+        filemenu.add_checkbutton(label="Record Session", variable=self.recordactive, command=self.recordFunction)
+        filemenu.add_separator()
         filemenu.add_command(label="Exit PEA", command=on_closing)
         menubar.add_cascade(label="File", menu=filemenu)
 
@@ -97,6 +121,18 @@ class Window(Frame):
         toolsmenu.add_separator()
         toolsmenu.add_command(label="Standard ASCII Chart", command=lambda i=1: self.asciichartWindow(i))
         toolsmenu.add_command(label="Extended ASCII Chart", command=lambda i=2: self.asciichartWindow(i))
+        toolsmenu.add_separator()
+        toolsmenu.add_command(label="Terminal Buffer Size", command=self.buffersizeFunction)
+        toolsmenu.add_separator()
+        toolsmenu.add_checkbutton(
+            label="Profile Engine (cProfile)", variable=self.profileactive["cprofile"],
+            command=lambda: self.profileFunction("cprofile"),
+        )
+        toolsmenu.add_checkbutton(
+            label="Sample Engine (Flame Graph)", variable=self.profileactive["sample"],
+            command=lambda: self.profileFunction("sample"),
+        )
+        toolsmenu.add_command(label="Script Time Budget", command=self.budgetFunction)
         menubar.add_cascade(label="Tools", menu=toolsmenu)
 
         helpmenu = Menu(menubar, tearoff=0)
@@ -130,7 +166,7 @@ class Window(Frame):
         self.portentry.pack(padx=5, pady=5, side=LEFT)        
         self.portbutton = ttk.Button(portframe,
             text="Open Port", width=13,
-            command=lambda: asyncio.ensure_future(self.listenFunction()))
+            command=lambda: self.listenFunction())
         self.portbutton.pack(padx=5, pady=5, side=LEFT)
 
         connectionframe = ttk.LabelFrame(mainframe1, text="TCP Connection",)
@@ -144,6 +180,11 @@ class Window(Frame):
         )
         self.disconnectbutton.pack(padx=5, pady=5, side=LEFT)
         self.disconnectbutton.config(state="disabled")
+        self.targetvar = StringVar()
+        self.targetvar.set("All Clients")
+        self.targetbox = ttk.Combobox(connectionframe, textvariable=self.targetvar, width=24, state="readonly")
+        self.targetbox["values"] = ["All Clients"]
+        self.targetbox.pack(padx=5, pady=5, side=LEFT)
 
         # send grid section --------------------------------------------------
 
@@ -254,7 +295,8 @@ class Window(Frame):
         logmodecheckbox = ttk.Checkbutton(
             terminalfuncframe, 
             text="Log Mode",
-            variable=self.logmodeactive)
+            variable=self.logmodeactive,
+            command=lambda: self.engine.call(setattr, self.device, "logmode", self.logmodeactive.get() != 0))
 
         logmodecheckbox.pack(padx=5, pady=5, side=LEFT)      
 
@@ -280,7 +322,9 @@ class Window(Frame):
         mainframe4.grid(row=3, column=0, padx=5, pady=5, sticky='nsew')        
 
         self.terminalbox = Text(mainframe4, width=127, height=31)
-        self.terminalbox.config(font=("consolas", 10), undo=True, wrap="word")
+        self.terminalbox.config(font=("consolas", 10), undo=False, wrap="word")  # an undo stack would keep every line
+        for color in self.colorList:
+            self.terminalbox.tag_config(color, foreground=color)
         self.terminalbox.grid(row=0, column=0, sticky="nsew", padx=2, pady=2)
         self.terminalbox.bind("<ButtonRelease-3>", self.rClicker, add="")
 
@@ -317,20 +361,23 @@ class Window(Frame):
     def reloadScript(self):
         """ function to reload a script when changed """
 
-        importlib.reload(self.devscript)
-        try:
-            self.func1Text.set(self.devscript.funcName[0])
-            self.func2Text.set(self.devscript.funcName[1])
-            self.func3Text.set(self.devscript.funcName[2])
-            self.func4Text.set(self.devscript.funcName[3])
-            self.func5Text.set(self.devscript.funcName[4])
-        except:
-            msg = "Script import: Problem with Custom Function names 'funcName'"
-            self.terminalFunction("ER", msg)
+        self.engine.wait(self.device.reloadScript)
+        self.setFuncNames()
             
         msg = "Script has been reloaded"
         self.terminalFunction("--", msg)
 
+    def setFuncNames(self):
+        """ labels the custom function buttons from the script """
+
+        names = None
+        if self.device.script:
+            names = self.engine.wait(self.device.funcNames)
+        if not names:
+            names = ["Func 1", "Func 2", "Func 3", "Func 4", "Func 5"]
+        for text, name in zip((self.func1Text, self.func2Text, self.func3Text, self.func4Text, self.func5Text), names):
+            text.set(name)
+
     def browseFunction(self):
         """ pressed on the browse button """
 
@@ -361,57 +408,20 @@ class Window(Frame):
 
             """ Open the simulation json file """
             try:
-                with open(fname) as data_file:
-                    data = json.load(data_file)
+                template = Template.load(fname)
 
-                    loadedManufacturer = ""
-                    loadedModel = ""
-                    loadedPort = 0
-                    loadedDelay = ""
+                self.portentry.delete(0, END)
+                self.portentry.insert(0, template.port)
+                self.filelabel.config(text=str(template))
 
-                    if data:
-                        loadedManufacturer = data[0]["Manufacturer"]
-                        loadedModel = data[1]["Model"]
-                        loadedPort = data[4]["Port"]
-                        loadedDelay = data[5]["Delay"]
-
-                        self.portentry.delete(0, END)
-                        self.portentry.insert(0, loadedPort)
-                        self.filelabel.config(text="{} - {}".format(loadedManufacturer, loadedModel))
-
-                        msg = "{} - {} loaded with a Response Delay of {}s".format(
-                            loadedManufacturer, loadedModel, loadedDelay
-                        )
-                        self.terminalFunction("--", msg)
-                        self.runstopFunction(1)
-
-                        if data[6]["Script"]:  # If a script is specified then also open that
-                            msg = "Importing Script file: {}.py".format(scriptName)
-                            self.terminalFunction("--", msg)
-                            sys.path.append("{}".format(path))
-                            try:
-                                self.devscript = __import__(scriptName)
-                            except Exception as e:
-                                msg = "Script import failed: {}.py".format(e)
-                                self.terminalFunction("ER", msg)
-                            try:
-                                self.func1Text.set(self.devscript.funcName[0])
-                                self.func2Text.set(self.devscript.funcName[1])
-                                self.func3Text.set(self.devscript.funcName[2])
-                                self.func4Text.set(self.devscript.funcName[3])
-                                self.func5Text.set(self.devscript.funcName[4])
-                            except:
-                                msg = "Script import: Problem with Custom Function names 'funcName'"
-                                self.terminalFunction("ER", msg)
-                        else:
-                            self.devscript = None
-                            self.func1Text.set("Func 1")
-                            self.func2Text.set("Func 2")
-                            self.func3Text.set("Func 3")
-                            self.func4Text.set("Func 4")
-                            self.func5Text.set("Func 5")
-
-                        self.updateCommandsList(data)
+                msg = "{} - {} loaded with a Response Delay of {}s".format(
+                    template.manufacturer, template.model, template.delay
+                )
+                self.terminalFunction("--", msg)
+                self.runstopFunction(1)
+
+                self.engine.wait(self.device.loadTemplate, template)  # also opens a script if specified
+                self.setFuncNames()
 
             except Exception as e:
                 print("Error opening sim file:", e) 
@@ -419,7 +429,7 @@ class Window(Frame):
     def reloadJSON(self):
         """ pressed on the reload JSON button """
 
-        if self.fname:
+        if self.fname and self.device.template:
             try:
                 msg = "Reloading JSON commands from {}".format(self.fname)
                 self.terminalFunction("--", msg)
@@ -428,27 +438,67 @@ class Window(Frame):
 
             """ Open the simulation json file """
             try:
-                with open(self.fname) as data_file:
-                    data = json.load(data_file)
-
-                    if data:
-                        self.updateCommandsList(data)
-
+                self.engine.wait(self.device.reloadCommands)
             except Exception as e:        
                 print("Error opening sim file:", e) 
 
-    def updateCommandsList(self, data):
+    def watchEvents(self):
+        """ shows engine events as soon as they are queued, Tk sleeps while nothing happens """
+
+        if self.waker:
+            self.master.tk.createfilehandler(self.waker.fileno(), READABLE, lambda fd, mask: self.pollEvents())
+        else:
+            self.pollEvents()
+
+    def pollEvents(self):
+        """ shows the events the engine thread queued since the last call """
+
+        if self.waker:
+            self.waker.clear()
+        events = self.events.drain()
+        for event in events:
+            if event[0] == "log":
+                self.terminalFunction(*event[1:])
+            elif event[0] == "clients":
+                self.connectionsChanged(event[1])
+
+        if not self.waker:  # polling fallback, backs off to 5 wakeups a second while idle
+            self.pollinterval = 10 if events else min(self.pollinterval * 2, 200)
+            self.master.after(self.pollinterval, self.pollEvents)
+
+    def connectionsChanged(self, clients):
+        """ updates the connection state and client selection from a list of (id, label) """
+
+        self.clients = clients
+        self.port["connected"] = len(clients)
+        if clients:
+            self.colorlabel.config(background=self.colorList[1])
+            self.disconnectbutton.config(state="active")
+        else:
+            self.colorlabel.config(background=self.colorList[0])
+            self.disconnectbutton.config(state="disabled")
+        self.updateTargetList()
+
+    def updateTargetList(self):
+        """ refreshes the client selection after a connect or disconnect """
+
+        targets = ["All Clients"] + [label for _, label in self.clients]
+        self.targetbox["values"] = targets
+        if self.targetvar.get() not in targets:
+            self.targetvar.set("All Clients")
 
-        self.commandsList = data
+    def targetConnections(self):
+        """ returns the ids of the connections selected in the client selection, None for all """
 
-        for idx,cmd in enumerate(self.commandsList[7]): # converts all query and response loaded to bytes
-            self.commandsList[7][idx]['Query'] = cmd['Query'].encode("latin-1").decode("unicode_escape").encode("latin-1")
-            self.commandsList[7][idx]['Response'] = cmd['Response'].encode("latin-1").decode("unicode_escape").encode("latin-1")                                 
+        target = self.targetvar.get()
+        if target == "All Clients":
+            return None
+        return [connid for connid, label in self.clients if label == target]
 
     def disconnectFunction(self):
         """ pressed on the disconnect button """
 
-        app.mySocket.close()
+        self.engine.call(self.device.closeConnections, self.targetConnections())
 
     def sendentry_click(self, event):
         """ pressed on the manual send button """
@@ -460,10 +510,15 @@ class Window(Frame):
         """ sends a custom string defined in the code entry field """
 
         if self.sendentry.get() != "Replace this with ASCII or HEX bytes with prefix \\x":
-            if app.mySocket:
+            if self.clients:
                 sendbyte = ast.literal_eval(f'b"{self.sendentry.get()}"')
-                self.terminalFunction("OU", sendbyte)
-                app.mySocket.write(sendbyte)
+                self.engine.call(self.device.sendTo, sendbyte, self.targetConnections())
+                responseIndex = self.device.template.responseIndex if self.device.template else {}
+                if sendbyte in responseIndex:  # tell which template command this answers
+                    msg = "Sent response of: {}".format(
+                        ", ".join(cmd.description for cmd in responseIndex[sendbyte])
+                    )
+                    self.terminalFunction("--", msg)
             else:
                 msg = "No TCP connection detected"
                 self.terminalFunction("--", msg)            
@@ -471,71 +526,148 @@ class Window(Frame):
     def callCustomFunc(self, func):
         """ sends a custom data function """
 
-        byteresponse = None
-        
-        if self.devscript:
-            try:
-                byteresponse = self.devscript.customFunc(func)
-            except Exception as e:
-                print('Exception occured in customFunc', e)            
-
-            if byteresponse and self.mySocket:
-                byteresponsesend = (byteresponse.encode("latin-1").decode("unicode_escape").encode("latin-1"))
-                if "$$$" in byteresponse:
-                    self.terminalFunction("FB", byteresponsesend[3:])    
-                else:
-                    self.terminalFunction("OU", byteresponsesend)
-                    self.mySocket.write(byteresponsesend)
-            else:
-                msg = "No TCP connection detected"
-                self.terminalFunction("--", msg)                           
-        else:
-            msg = "No script functions are loaded"
-            self.terminalFunction("--", msg)                      
+        self.engine.call(self.device.runCustomFunc, func, self.targetConnections())
 
-    def terminalFunction(self, direction, data):
-        """ printing to the terminal window """
+    def terminalFunction(self, direction, data, connid=None, timestamp=None):
+        """ printing to the terminal window, connid tags the line with the client """
 
         if self.terminalrunning:
-            msgdir = str(direction)
-            now = datetime.datetime.now()
-            msgnow = str(now.strftime("%H:%M:%S.%f")[:-3])
-            msglen = len(data)
-            msgdata = str(data)
-
-            if direction == "--" or direction == 'ER':  # info or error lines
-                color = 0
-                msg = "{} | {} | {}\n".format(msgdir, msgnow, msgdata)
-                self.terminalbox.tag_config(
-                    str(self.colorList[color]), foreground=self.colorList[color]
-                )
-                self.terminalbox.insert(END, msg, str(self.colorList[color]))
-                self.terminalbox.see(END)
+            self.logstore.append(direction, data, connid, timestamp)
+            self.scheduleRender()
 
-            else:  # lines for incoming or outgoing data
-                if direction == "IN":
-                    color = 3                    
-                else:
-                    color = 4
-                if app.showbytecount.get() == 0:
-                    msg = "{} | {} | {}\n".format(msgdir, msgnow, msgdata)
-                else:
-                    msg = "{} | {} | {} | {}\n".format(msgdir, msgnow, msgdata, msglen)
+    def captureFunction(self):
+        """ starts or stops writing every event to rotating files in the captures folder """
 
-                self.terminalbox.tag_config(str(self.colorList[color]), foreground=self.colorList[color])
-                self.terminalbox.insert(END, msg, str(self.colorList[color]))
-                self.terminalbox.see(END)
+        if self.captureactive.get():
+            try:
+                self.capture = CaptureWriter(CAPTURE_DIR, "pea-gui")
+            except (OSError, ValueError) as e:
+                self.captureactive.set(0)
+                self.terminalFunction("ER", "Capture not started: {}".format(e))
+                return
+            self.capturelistener = self.capture.listener()
+            self.engine.call(self.device.listeners.append, self.capturelistener)
+            msg = "Capturing to {}".format(os.path.abspath(CAPTURE_DIR))
+            self.terminalFunction("--", msg)
+        elif self.capture:
+            self.engine.wait(self.device.listeners.remove, self.capturelistener)
+            self.capture.close()
+            self.capture = None
+            msg = "Capture stopped"
+            self.terminalFunction("--", msg)
+
+    def recordFunction(self):
+        """ starts or stops recording the client traffic to a session file for python -m pea replay """
+
+        if self.recordactive.get():
+            fname = filedialog.asksaveasfilename(
+                title="Record session to", defaultextension=".pea", filetypes=(("PEA sessions", "*.pea"), ("all files", "*.*"))
+            )
+            if not fname:
+                self.recordactive.set(0)
+                return
+            try:
+                self.recorder = SessionRecorder(fname)
+            except OSError as e:
+                self.recordactive.set(0)
+                self.terminalFunction("ER", "Recording not started: {}".format(e))
+                return
+            self.engine.wait(self.recorder.attach, self.device)
+            msg = "Recording session to {}".format(fname)
+            self.terminalFunction("--", msg)
+        elif self.recorder:
+            self.engine.wait(self.recorder.detach, self.device)
+            self.recorder.close()
+            self.recorder = None
+            msg = "Session recording stopped"
+            self.terminalFunction("--", msg)
 
+    def scheduleRender(self):
+        """ redraws the terminal at most FRAME_INTERVAL apart, however many lines arrive """
+
+        if not self.renderpending:
+            self.renderpending = True
+            wait = self.lastrender + FRAME_INTERVAL - time.monotonic()
+            self.master.after(max(0, int(wait * 1000)), self.renderTerminal)
+
+    def renderTerminal(self):
+        """ formats the new records into the terminal in one insert and trims the oldest lines """
+
+        self.renderpending = False
+        self.lastrender = time.monotonic()
+        store = self.logstore
+        start = max(self.rendered, store.base, store.end - self.terminallines)  # lines trimmed right away are never formatted
+        if start < store.end:
+            bytecount = self.showbytecount.get() != 0
+            chunks = []
+            for index in range(start, store.end):
+                chunks += [store.line(index, bytecount), self.lineColor(store.direction(index))]
+            self.terminalbox.insert(END, *chunks)
+            self.terminalbox.see(END)
+            self.shown += store.end - start
+            self.rendered = store.end
+        if self.shown > self.terminallines:
+            self.terminalbox.delete("1.0", "{}.0".format(self.shown - self.terminallines + 1))
+            self.shown = self.terminallines
         self.terminallengthFunction()
+        if self.activefilter:
+            self.showMatches(self.activefilter.update(FILTER_CHUNK))
+            self.scheduleFilter()
+
+    def lineColor(self, direction):
+        """ returns the color tag of a terminal line """
+
+        if direction == "IN":
+            return self.colorList[3]
+        if direction == "OU":
+            return self.colorList[4]
+        return self.colorList[0]  # info, error and feedback lines
 
     def terminallengthFunction(self):
         """ displays the total number of lines in the terminal """
 
-        self.linelabel.config(
-            text="{:06d}".format(
-                int(self.terminalbox.index("end-1c").split(".")[0]) - 1
-            )
+        self.linelabel.config(text="{:06d}".format(self.shown))
+
+    def buffersizeFunction(self):
+        """ asks for the number of lines the terminal keeps """
+
+        maxlines = simpledialog.askinteger(
+            "Terminal Buffer Size", "Lines kept in the terminal:",
+            initialvalue=self.terminallines, minvalue=100, maxvalue=1000000, parent=self.master
+        )
+        if maxlines:
+            self.terminallines = maxlines
+            self.logstore.resize(max(maxlines, self.logstore.maxrecords))
+            self.terminalbox.delete(1.0, END)
+            self.shown = 0
+            self.rendered = 0
+            self.renderTerminal()
+
+    def profileFunction(self, mode):
+        """ starts or stops profiling the engine thread, the reports go to the profiles folder """
+
+        if self.profileactive[mode].get():
+            try:
+                self.engine.wait(self.profiler.start, mode)
+            except ValueError as e:
+                self.profileactive[mode].set(0)
+                self.terminalFunction("ER", "Profiler not started: {}".format(e))
+                return
+            msg = "Profiling the engine with {}".format(mode)
+            self.terminalFunction("--", msg)
+        elif self.profiler.mode == mode:
+            for fname in self.engine.wait(self.profiler.stop):
+                self.terminalFunction("--", "Profile written to {}".format(os.path.abspath(fname)))
+
+    def budgetFunction(self):
+        """ asks for the time a script call may take before it is logged as slow """
+
+        budget = simpledialog.askfloat(
+            "Script Time Budget", "Log script calls slower than (ms, 0 never):",
+            initialvalue=(self.device.scriptBudget or 0) * 1000, minvalue=0, parent=self.master
         )
+        if budget is not None:
+            self.engine.call(setattr, self.device, "scriptBudget", budget / 1000)
 
     def runstopFunction(self, index):
         """ starts/stops/clears the terminal box """
@@ -552,7 +684,12 @@ class Window(Frame):
     def clearFunction(self):
         """ clears the terminal box """
 
+        self.logstore.clear()
+        self.filters.clear()
         self.terminalbox.delete(1.0, END)
+        self.shown = 0
+        if self.activefilter:
+            self.refreshFunction()
         self.terminallengthFunction()
 
     def rClicker(self, e):
@@ -605,6 +742,7 @@ class Window(Frame):
             """ kills the filter window """
 
             self.filterbutton.config(state="normal")
+            self.activefilter = None
             filterWindow.destroy()
 
         filterWindow = Toplevel()
@@ -625,7 +763,7 @@ class Window(Frame):
         self.filterentry1.pack(padx=5, pady=5, side=LEFT)
 
         self.filtervar = StringVar()
-        filteroptions = ["AND", "OR"]
+        filteroptions = list(FILTER_MODES)
         self.filterword = ttk.OptionMenu(
             functionframe, self.filtervar, filteroptions[0], *filteroptions
         )
@@ -636,16 +774,19 @@ class Window(Frame):
         self.filterentry2.insert(0, "")
         self.filterentry2.pack(padx=5, pady=5, side=LEFT)
 
+        self.filterentry1.bind("<Return>", lambda e: self.refreshFunction())
+        self.filterentry2.bind("<Return>", lambda e: self.refreshFunction())
+
         refreshbutton = ttk.Button(
             functionframe, text="Apply", width=10, command=self.refreshFunction
         )
         refreshbutton.pack(padx=5, pady=5, side=LEFT)
 
-        filterframe = ttk.LabelFrame(filterWindow, text="Filtered Terminal")
+        self.filterframe = filterframe = ttk.LabelFrame(filterWindow, text="Filtered Terminal")
         filterframe.pack(fill=BOTH, padx=5, pady=5, side=BOTTOM)
 
         self.filterbox = Text(filterframe, width=120, height=20)
-        self.filterbox.config(font=("consolas", 10), undo=True, wrap="word")
+        self.filterbox.config(font=("consolas", 10), undo=False, wrap="word")
         self.filterbox.grid(row=0, column=0, sticky="nsew", padx=2, pady=2)
         self.filterbox.bind("<Button-3>", self.rClicker, add="")
 
@@ -666,28 +807,50 @@ class Window(Frame):
         self.refreshFunction()
 
     def refreshFunction(self):
-        """ refresh the filter box """
+        """ refresh the filter box, later matches are added as they arrive """
 
         self.filterbox.delete(1.0, END)
+        self.filtershown = 0
 
-        filterword1 = self.filterentry1.get()
-        filterword2 = self.filterentry2.get()
-
-        if len(filterword1) > 0 and len(filterword2) == 0:
-            for line in self.terminalbox.get("1.0", "end-1c").splitlines():
-                if filterword1 in line:
-                    self.filterbox.insert(END, "{}\n".format(line))
-        elif len(filterword1) > 0 and len(filterword2) > 0:
-            for line in self.terminalbox.get("1.0", "end-1c").splitlines():
-                if self.filtervar.get() == "AND":
-                    if filterword1 in line and filterword2 in line:
-                        self.filterbox.insert(END, "{}\n".format(line))
-                elif self.filtervar.get() == "OR":
-                    if filterword1 in line or filterword2 in line:
-                        self.filterbox.insert(END, "{}\n".format(line))
-        else:
-            for line in self.terminalbox.get("1.0", "end-1c").splitlines():
-                self.filterbox.insert(END, "{}\n".format(line))
+        words = [self.filterentry1.get(), self.filterentry2.get()]
+        try:
+            self.activefilter = self.filters.select(self.filtervar.get(), words, FILTER_CHUNK)
+        except ValueError as e:
+            self.activefilter = None
+            self.filterbox.insert(END, "{}\n".format(e))
+            self.filterframe.config(text="Filtered Terminal")
+            return
+        self.showMatches(self.activefilter.matches[-self.terminallines:])
+        self.scheduleFilter()
+
+    def scheduleFilter(self):
+        """ tests the rest of the records in later callbacks, so a long log does not block the GUI """
+
+        if self.filterjob is None and self.activefilter and self.activefilter.pending:
+            self.filterjob = self.master.after(1, self.continueFilter)
+
+    def continueFilter(self):
+        """ tests the next chunk of records for the active filter """
+
+        self.filterjob = None
+        if self.activefilter:
+            self.showMatches(self.activefilter.update(FILTER_CHUNK))
+            self.scheduleFilter()
+
+    def showMatches(self, indexes):
+        """ adds the filtered records to the filter box in one insert, keeps as many lines as the terminal """
+
+        if len(indexes):
+            bytecount = self.showbytecount.get() != 0
+            self.filterbox.insert(END, "".join(self.logstore.line(index, bytecount) for index in indexes))
+            self.filterbox.see(END)
+            self.filtershown += len(indexes)
+            if self.filtershown > self.terminallines:
+                self.filterbox.delete("1.0", "{}.0".format(self.filtershown - self.terminallines + 1))
+                self.filtershown = self.terminallines
+        self.filterframe.config(text="Filtered Terminal - {} matches{}".format(
+            len(self.activefilter), " so far" if self.activefilter.pending else ""
+        ))
 
     def jsoneditorWindow(self):
         """ opens a new JSON editor window """
@@ -706,6 +869,8 @@ class Window(Frame):
         jsoneditorWindow.attributes('-topmost', True)  
 
         self.outfileName = str()
+        self.extraOptions = list()
+        self.commandExtras = list()  # keys of each command besides Description, Query and Response
         self.entryframes = list()
         self.commandlist = list()
         self.querylist = list()
@@ -768,6 +933,8 @@ class Window(Frame):
             delayentry.delete(0, END)
             delayentry.insert(0, 0.1)
             scriptbool.set(False)
+            self.extraOptions = list()
+            self.commandExtras = list()
             
             versionentry.insert(0, '1_0_0_0')
             spinnerbox.set('1')
@@ -821,6 +988,11 @@ class Window(Frame):
                         delayentry.insert(0, float(data[5]['Delay']))
                         scriptbool.set(data[6]['Script'])   
                         spinnerbox.set(str(len(data[7])))
+                        self.extraOptions = data[8:]  # optional entries such as Framing are kept as they are
+                        self.commandExtras = [
+                            {key: value for key, value in entry.items() if key not in ("Description", "Query", "Response")}
+                            for entry in data[7]
+                        ]
 
                         for idx,data in enumerate(data[7]):
                             cmd = data['Description']
@@ -871,6 +1043,10 @@ class Window(Frame):
                         que = str(self.querylist[idx].get()).encode('latin-1').decode()
                         res = str(self.responselist[idx].get()).encode('latin-1').decode()
                         data[7].append({"Description":cmd, "Query":que.replace(r'\x', r'\\x'), "Response":res.replace(r'\x', r'\\x')})                
+                        if idx < len(self.commandExtras):  # such as the query Type
+                            data[7][-1].update(self.commandExtras[idx])
+
+                    data.extend(self.extraOptions)
 
                     outfile.write(json.dumps(data, sort_keys=True, indent=4).encode('latin-1').decode('unicode-escape'))
                     outfile.close()
@@ -1115,6 +1291,51 @@ and not the connection details. If you change one of the other
 details such as Port number, Script checkbox or the Delay you need
 to use the Browse for Emulator JSON File menu option again.
 
+The AND and OR filters look for the words anywhere in the terminal
+line. A word like =IN, =ER or =#3 only matches the direction or the
+connection of a line. Only these are indexed and fast on a long log,
+other words are searched line by line while the matches come in.
+
+Devices that send several commands in one go or split them up
+need framing. Add an optional entry after the commands list:
+
+    {"Framing": {"Mode": "delimiter", "Delimiter": "\\r"}}
+
+Modes are delimiter, fixed (Length), length (Offset, Size, Order,
+Adjust) and gap (Timeout). A Timeout also works with the other
+modes to flush partial data after the line was idle.
+
+Queries match exactly unless a command says otherwise with a
+"Type": prefix (the data starts with the query), regex (a Python
+regular expression the data fully matches) or mask (a "Mask" of
+hex bytes, 00 matches any byte):
+
+    {"Description": "Volume", "Type": "regex",
+     "Query": "VOL(100|[1-9]?[0-9])\\r", "Response": "VOLOK\\r"}
+
+With "Format": true the response can use the groups of a regex
+query, {count}, {conn.id} and {device.clients}:
+
+    {"Description": "Tie", "Type": "regex", "Format": true,
+     "Query": "(?P<input>[0-9]+)\\\\*(?P<output>[0-9]+)!",
+     "Response": "Out{output} In{input} All\\r\\n"}
+
+Variables declared in a {"State": ..} entry are changed with the
+"Actions" of a command, tested with its "Guard" and shown with
+{state.name}, see templates/template_with_state.json.
+
+A script with PEA_API = 2 gets a memoryview of the received data
+in rxscript and returns bytes or a list of buffers, which are sent
+as they are. Without it rxscript returns a str with \\x escapes.
+
+Instead of rxscript a script can register a handler per command:
+
+    @pea.on(rb"(\\d+)\\*(\\d+)!")
+    def tie(conn, match):
+        ...
+
+All pea.on patterns are searched in one pass.
+
 Look at the example template JSON and PY Script for more details
 on how to deal with received and send strings.'''
 
@@ -1186,27 +1407,23 @@ feel free to donate ANY amount you like, big or small to:"""
 
     # start of socket functions -----------------------------------------------------------------------------------------------                
 
-    async def listenFunction(self):
+    def listenFunction(self):
         """ gets trigger from Open Port button or the file loader """
 
         if self.portopen == False:
-            if self.commandsList and int(self.portentry.get()) >= 1024:
+            if self.device.template and int(self.portentry.get()) >= 1024:
                 self.portbutton.config(text="Close Port")
                 self.portopen = True
                 
                 newport = int(self.portentry.get())
                 self.port["listen"] = newport
 
-                msg = "Port {} is open".format(newport)
-                self.terminalFunction("--", msg)
-
                 self.portentry.delete(0, END)
                 self.portentry.insert(0, str(self.port["listen"]))
                 self.portentry.config(state="disabled")   
 
                 try:
-                    self.loop = asyncio.get_running_loop()
-                    self.sock = await self.loop.create_server(lambda: SocketServer(),'0.0.0.0', int(self.portentry.get()))
+                    self.engine.submit(self.device.start('0.0.0.0', newport)).result(10)
                 except Exception as e:
                     print(e)                        
 
@@ -1215,104 +1432,12 @@ feel free to donate ANY amount you like, big or small to:"""
                 self.terminalFunction("--", msg)
 
         elif self.portopen == True:
-            msg = "Port is closed"
-            self.terminalFunction("--", msg)  
-
             self.portentry.config(state="normal")
             self.portbutton.config(text="Open Port")
             self.port["listen"] = 0
             self.portopen = False      
 
-            connection_close()
-            self.sock.close()
-
-class SocketServer(asyncio.Protocol):
-    def connection_made(self, transport):
-        self.socketdetails = transport.get_extra_info('sockname')
-        app.port["connected"] = self.socketdetails[1]
-        app.mySocket = transport 
-
-        msg = "Client {} connected".format(self.socketdetails[0])
-        app.colorlabel.config(background=app.colorList[1])
-        app.terminalFunction("--", msg)
-        app.disconnectbutton.config(state="active")
-
-        if app.commandsList:
-            if b'ON_CONNECT' in app.commandsList[7][0]["Query"]:
-                app.terminalFunction("OU", app.commandsList[7][0]["Response"])
-                try:
-                    app.mySocket.write(app.commandsList[7][0]["Response"])
-                except:
-                    print('Error sending bytes')          
-
-    def data_received(self, data):
-        app.terminalFunction("IN", data) 
-
-        self.idx = 0
-
-        if app.commandsList:
-
-            result = any(x["Query"] == data for self.idx, x in enumerate(app.commandsList[7]))
-
-            if result:  # command found in query
-                delay = float(app.commandsList[5]["Delay"])
-                time.sleep(delay)
-                app.terminalFunction("OU", app.commandsList[7][self.idx]["Response"])
-                try:
-                    app.mySocket.write(app.commandsList[7][self.idx]["Response"])
-                except:
-                    pass
-            else:  # command not found in query, trying script
-
-                if app.devscript:  # invoke the script (if there is one)
-                    try:
-                        byteresponse = app.devscript.rxscript(
-                            app.mySocket, data
-                        )
-                    except Exception as e:
-                        print('Exception occured in devscript', e)
-                    try:
-                        if byteresponse:
-                            byteresponsesend = (
-                                byteresponse.encode("latin-1")
-                                .decode("unicode_escape")
-                                .encode("latin-1")
-                            )
-                            app.mySocket.write(byteresponsesend)
-                            app.terminalFunction("OU", byteresponsesend)
-                        else:  # Nothing found in query or script
-                            if app.logmodeactive.get() == 0:
-                                byteresponse = "Error - no match found in query or script"
-                                app.terminalFunction("ER", byteresponse)
-                            try:
-                                app.mySocket.write(bytes(byteresponse, "utf-8"))
-                            except Exception as e:
-                                print('Exception occured in sending', e)
-                    except:
-                        app.terminalFunction("ER", 'Script ERROR!')
-                else:  # Nothing found in query
-                    if app.logmodeactive.get() == 0:
-                        byteresponse = "Error - no match found with query"
-                        app.terminalFunction("ER", byteresponse)
-                        app.mySocket.write(bytes(byteresponse, "utf-8"))
-        else:
-            app.terminalFunction(
-                "--", "Error - no device emulator file has been loaded"
-            )             
-
-    def connection_lost(self, exc):
-        msg = "Client {} disconnected".format(self.socketdetails[0])
-        app.colorlabel.config(background=app.colorList[0])
-        app.terminalFunction("--", msg)
-        app.port["connected"] = 0
-        app.disconnectbutton.config(state="disabled")
-
-def connection_close():
-    if app.mySocket:
-        app.mySocket.close()
-    app.mySocket = None
-    app.port["connected"] = 0
-    app.disconnectbutton.config(state="disabled")
+            self.engine.call(self.device.stop)
 
 class VerticalScrolledFrame(Frame):
     """A pure Tkinter scrollable frame that actually works!
@@ -1357,10 +1482,6 @@ class VerticalScrolledFrame(Frame):
         canvas.bind('<Configure>', _configure_canvas)        
 
 
-async def main():
-    await run_tk(root)
-
-
 def on_closing():
     """ closes the main window and kills the proces / task """
 
@@ -1373,7 +1494,10 @@ root.resizable(width=False, height=False)
 root.wm_attributes('-topmost', 0)
 root.protocol("WM_DELETE_WINDOW", on_closing)  # Trigger on plain closing the window
 root.call("wm", "iconphoto", root._w, PhotoImage(file="assets/icon.png"))    
-app = Window(root)
+engine = EngineThread()
+engine.start()
+app = Window(root, engine)
+app.watchEvents()
 
 mystyle = ttk.Style()
 if sys.platform.startswith('win'):
@@ -1381,4 +1505,13 @@ if sys.platform.startswith('win'):
 else:
     mystyle.theme_use("default")
 
-asyncio.run(main())
+try:
+    root.mainloop()
+finally:
+    if app.profiler.running:
+        engine.wait(app.profiler.stop)
+    engine.stop()
+    if app.capture:
+        app.capture.close()
+    if app.recorder:
+        app.recorder.close()
@@ -0,0 +1,25 @@
+"""
+    #PEA core
+
+    The emulation engine of PEA without any GUI: JSON templates, stream
+    framing, connected clients and the headless command line.
+    Nothing in this package imports tkinter.
+"""
+
+from .template import Command, Template, template_option, to_bytes, from_bytes
+from .response import ResponseFormat
+from .state import StateModel, CommandActions
+from .framing import FrameSpec, Framer, compile_framing
+from .device import Connection, Device, ResponseScheduler, SocketServer
+from .manager import DeviceManager, load_manifest
+from .fleet import Fleet, fleet_addresses
+from .logfmt import format_line, format_entry
+from .logstore import LogStore
+from .logfilter import FilterCache, LogFilter, LogIndex, FILTER_MODES
+from .capture import CaptureWriter
+from .session import SessionRecorder, ReplayServer, load_session, read_session, replay_client
+from .learn import Learner, LearningProxy
+from .metrics import DeviceMetrics, Histogram, MetricsServer, prometheus_text
+from .profiler import Profiler, PROFILE_MODES
+from .scriptapi import ScriptRegistry
+from .enginethread import EngineThread, EventQueue, Waker
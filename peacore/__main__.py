@@ -0,0 +1,7 @@
+""" python -m peacore <command>, the same as python -m pea <command> """
+
+import sys
+
+from .cli import main
+
+sys.exit(main())
@@ -0,0 +1,140 @@
+"""
+    Load generator and latency benchmark.
+
+    Concurrent clients send the queries of a template to a device, each
+    client with one query in flight, and time every query until the
+    template response arrived. The device is either started in-process
+    from the same template or a running PEA or real device.
+"""
+
+import time, array, asyncio
+
+REPORT_KEYS = ("queries", "errors", "timeouts", "mismatches", "connecterrors", "qps", "p50", "p90", "p99", "max")
+
+
+def bench_commands(template):
+    """
+    returns the (query, response) pairs of a template a client can send and
+    the fixed reply it expects: patterns are no literal queries, formatted,
+    stateful and guarded replies change, and of repeated queries only the
+    entry answering them counts
+    """
+
+    return [
+        (command.query, command.response) for command in template.commands
+        if command.kind == "exact" and command.query != b"ON_CONNECT"
+        and command.render is None and command.actions is None
+        and template.queryIndex.get(command.query) is command
+    ]
+
+
+def percentile(values, fraction):
+    """ percentile of sorted values, 0.0 without values """
+
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class BenchStats:
+    """ latencies and error counts of all clients """
+
+    def __init__(self):
+        self.latencies = array.array("d")
+        self.timeouts = 0
+        self.mismatches = 0
+        self.connecterrors = 0
+
+    def report(self, elapsed):
+        """ returns the results as a dict, latencies in milliseconds """
+
+        latencies = sorted(self.latencies)
+        errors = self.timeouts + self.mismatches + self.connecterrors
+        return {
+            "queries": len(latencies), "errors": errors, "timeouts": self.timeouts,
+            "mismatches": self.mismatches, "connecterrors": self.connecterrors,
+            "seconds": round(elapsed, 3),
+            "qps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+            "p50": round(percentile(latencies, 0.5) * 1000, 3),
+            "p90": round(percentile(latencies, 0.9) * 1000, 3),
+            "p99": round(percentile(latencies, 0.99) * 1000, 3),
+            "max": round(latencies[-1] * 1000, 3) if latencies else 0.0,
+        }
+
+
+async def read_reply(reader, expected, timeout):
+    """ reads until len(expected) bytes arrived, or the first data if nothing is expected """
+
+    received = b""
+    while True:
+        chunk = await asyncio.wait_for(reader.read(65536), timeout)
+        if not chunk:
+            raise ConnectionResetError("connection closed by the device")
+        received += chunk
+        if len(received) >= len(expected):
+            return received
+
+
+async def bench_client(host, port, commands, greeting, stats, deadline, interval, timeout, offset):
+    """ one client: sends the commands round robin until deadline, every interval seconds or flat out """
+
+    loop = asyncio.get_running_loop()
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+        if greeting:
+            await read_reply(reader, greeting, timeout)
+    except (OSError, asyncio.TimeoutError):
+        stats.connecterrors += 1
+        return
+
+    position = offset
+    due = loop.time()
+    try:
+        while loop.time() < deadline:
+            if interval:
+                due += interval
+                if due > loop.time():
+                    await asyncio.sleep(due - loop.time())
+            query, response = commands[position % len(commands)]
+            position += 1
+            started = time.perf_counter()
+            writer.write(query)
+            try:
+                reply = await read_reply(reader, response, timeout)
+            except asyncio.TimeoutError:
+                stats.timeouts += 1
+                break  # a late reply would be taken for the next query
+            stats.latencies.append(time.perf_counter() - started)
+            if response and reply != response:
+                stats.mismatches += 1
+    except OSError:
+        stats.connecterrors += 1
+    finally:
+        writer.close()
+
+
+async def run_bench(host, port, commands, greeting=b"", clients=10, duration=10.0, rate=0.0, timeout=2.0):
+    """ drives the device with clients for duration seconds, rate is the total queries per second, 0 flat out """
+
+    if not commands:
+        raise ValueError("The template has no queries to send")
+    loop = asyncio.get_running_loop()
+    stats = BenchStats()
+    interval = clients / rate if rate else 0.0
+    started = loop.time()
+    deadline = started + duration
+    await asyncio.gather(*(
+        bench_client(host, port, commands, greeting, stats, deadline, interval, timeout, client)
+        for client in range(clients)
+    ))
+    return stats.report(loop.time() - started)
+
+
+def report_table(results):
+    """ formats the results as a two column table """
+
+    lines = []
+    for key in REPORT_KEYS:
+        unit = " ms" if key in ("p50", "p90", "p99", "max") else ""
+        lines.append("{:>14} | {}{}".format(key, results[key], unit))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,154 @@
+"""
+    Capture of all device events to rotating files on disk.
+
+    Listeners only append the event to a queue. A background thread
+    formats and writes the queued events in batches, so a slow disk never
+    delays a reply. Files are named <name>-<date>-<time>.<log|jsonl>[.gz|.zst]
+    and a new one is started when the current one reaches maxbytes; only
+    the newest keep files are kept.
+"""
+
+import os, glob, gzip, json, time, datetime, threading, collections
+
+from .logfmt import format_entry
+
+CAPTURE_FORMATS = ("text", "jsonl")
+CAPTURE_COMPRESSIONS = ("none", "gzip", "zstd")
+FLUSH_INTERVAL = 0.5  # seconds between writes of the queued events
+MAX_QUEUED = 200000  # events queued beyond this are dropped and counted, the event loop never waits
+
+
+def open_capture(fname, compress):
+    """ opens a capture file for writing text in the given compression """
+
+    if compress == "gzip":
+        return gzip.open(fname, "wt", encoding="utf-8", compresslevel=6)
+    if compress == "zstd":
+        import io
+        import zstandard
+        return io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(open(fname, "wb")), encoding="utf-8")
+    return open(fname, "w", encoding="utf-8")
+
+
+class CaptureWriter:
+    """
+    Background writer of device events. Use listener(device) as a device
+    listener and close() when done, which writes everything still queued.
+    """
+
+    def __init__(self, directory, name="pea", fmt="text", compress="none", maxbytes=64 * 1024 * 1024, keep=20):
+        if fmt not in CAPTURE_FORMATS:
+            raise ValueError("Unknown capture format: {}".format(fmt))
+        if compress not in CAPTURE_COMPRESSIONS:
+            raise ValueError("Unknown capture compression: {}".format(compress))
+        if compress == "zstd":
+            try:
+                import zstandard  # noqa: F401
+            except ImportError:
+                raise ValueError("zstd captures need the zstandard package, pip install zstandard")
+
+        self.directory = directory
+        self.name = name
+        self.fmt = fmt
+        self.compress = compress
+        self.maxbytes = maxbytes
+        self.keep = keep
+        self.events = collections.deque()
+        self.dropped = 0
+        self.file = None
+        self.fname = None
+        self.written = 0
+        self.running = True
+        self.wakeup = threading.Event()
+        os.makedirs(directory, exist_ok=True)
+        self.thread = threading.Thread(target=self.run, name="pea-capture", daemon=True)
+        self.thread.start()
+
+    def listener(self, device=None):
+        """ returns a device listener capturing its events, tagged with the device name """
+
+        devicename = str(device) if device is not None else None
+
+        def capture(direction, data, conn=None):
+            if len(self.events) >= MAX_QUEUED:
+                self.dropped += 1
+                return
+            if not isinstance(data, (bytes, str)):
+                data = bytes(data)
+            self.events.append((time.time(), devicename, direction, data, None if conn is None else conn.id))
+
+        return capture
+
+    def run(self):
+        while self.running:
+            self.wakeup.wait(FLUSH_INTERVAL)
+            self.wakeup.clear()
+            self.writeQueued()
+        self.writeQueued()
+        self.closeFile()
+
+    def close(self):
+        """ writes the queued events and closes the file """
+
+        self.running = False
+        self.wakeup.set()
+        self.thread.join()
+
+    def writeQueued(self):
+        events = []
+        popleft = self.events.popleft
+        try:
+            while True:
+                events.append(popleft())
+        except IndexError:
+            pass
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            msg = "Capture queue full, {} events were not captured".format(dropped)
+            events.append((time.time(), None, "ER", msg, None))
+        if not events:
+            return
+
+        try:
+            chunk = "".join(self.formatEvent(*event) for event in events)
+            if self.file is None or self.written >= self.maxbytes:
+                self.rotate()
+            self.file.write(chunk)
+            self.file.flush()
+            self.written += len(chunk)
+        except OSError as e:
+            print("Capture error:", e)
+
+    def formatEvent(self, stamp, devicename, direction, data, connid):
+        if self.fmt == "jsonl":
+            record = {
+                "time": stamp, "device": devicename, "dir": direction, "conn": connid,
+                "text": isinstance(data, str),
+                "data": data if isinstance(data, str) else data.decode("latin-1"),
+            }
+            return json.dumps(record) + "\n"
+        line = format_entry(direction, data, connid, False, datetime.datetime.fromtimestamp(stamp))
+        return "[{}] {}".format(devicename, line) if devicename else line
+
+    def rotate(self):
+        """ closes the current file, starts a new one and deletes the oldest beyond keep """
+
+        self.closeFile()
+        suffix = {"none": "", "gzip": ".gz", "zstd": ".zst"}[self.compress]
+        extension = ".jsonl" if self.fmt == "jsonl" else ".log"
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        self.fname = os.path.join(self.directory, "{}-{}{}{}".format(self.name, stamp, extension, suffix))
+        self.file = open_capture(self.fname, self.compress)
+        self.written = 0
+
+        pattern = os.path.join(glob.escape(self.directory), "{}-[0-9]*{}{}".format(glob.escape(self.name), extension, suffix))
+        for old in sorted(glob.glob(pattern))[:-self.keep]:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+
+    def closeFile(self):
+        if self.file:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,532 @@
+"""
+    Headless command line of PEA, runs emulators without the GUI:
+
+        python -m pea serve templates/template.json --port 5000
+        python -m pea run rig.json
+        python -m pea fleet templates/lg_98uh5e_1_0_0_0.json --count 300 --port 6000
+        python -m pea replay session.pea --host 10.0.0.5 --speed max
+        python -m pea learn 10.0.0.5:23 --port 5000 --out learned.json
+        python -m pea bench templates/template.json --clients 50 --delay 0
+        python -m pea microbench --save
+"""
+
+import sys, json, time, signal, asyncio, argparse
+
+from .template import Template, to_bytes
+from .device import Device
+from .manager import DeviceManager, load_manifest
+from .fleet import Fleet
+from .logfmt import format_line
+from .capture import CaptureWriter, CAPTURE_FORMATS, CAPTURE_COMPRESSIONS
+from .session import SessionRecorder, ReplayServer, load_session, replay_client
+from .learn import Learner, LearningProxy
+from .bench import bench_commands, run_bench, report_table
+from .metrics import MetricsServer
+from .profiler import Profiler, PROFILE_MODES
+from . import microbench as suite
+
+
+class LineWriter:
+    """ device listener writing the formatted log lines to a text stream """
+
+    def __init__(self, stream, bytecount=False, prefix="", quiet=False):
+        self.stream = stream
+        self.bytecount = bytecount
+        self.prefix = prefix
+        self.quiet = quiet
+
+    def __call__(self, direction, data, conn=None):
+        if self.quiet and direction not in ("--", "ER"):
+            return
+        self.stream.write(self.prefix + format_line(direction, data, conn, self.bytecount))
+
+
+def open_log(args):
+    """ returns the stream to log to: a line buffered log file or stdout, which a worker shares with its parent """
+
+    if getattr(args, "stream", None):
+        return args.stream
+    if args.log:
+        return open(args.log, "a", buffering=1)
+    return sys.stdout
+
+
+def close_log(stream):
+    stream.flush()
+    if stream is not sys.stdout:
+        stream.close()
+
+
+def start_capture(args):
+    """ returns the capture writer of the command, None with --no-capture """
+
+    if args.no_capture:
+        return None
+    name = "pea-{}".format(args.func.__name__)
+    if getattr(args, "worker", None):
+        name += "-w{}".format(args.part[0])
+    return CaptureWriter(
+        args.capture_dir, name, args.capture_format, args.capture_compress,
+        args.capture_size * 1024 * 1024, args.capture_keep,
+    )
+
+
+def close_writer(writer):
+    """ closes a capture writer or session recorder if there is one """
+
+    if writer:
+        writer.close()
+
+
+def start_recording(args, devices):
+    """ records the clients of devices to the --record session file, returns the recorder or None """
+
+    if not args.record:
+        return None
+    fname = args.record
+    if getattr(args, "worker", None):
+        fname += ".w{}".format(args.part[0])
+    recorder = SessionRecorder(fname)
+    for device in devices:
+        recorder.attach(device)
+    return recorder
+
+
+async def start_metrics(args, devices, profiler=None):
+    """ starts the --metrics-port endpoint, workers use the port plus their number """
+
+    if not args.metrics_port:
+        return None
+    port = args.metrics_port + args.part[0]
+    metrics = MetricsServer(devices)
+    if profiler:
+        metrics.routes.update(profiler.routes())
+    await metrics.start(args.metrics_host, port)
+    msg = "Metrics on http://{}:{}/metrics and /metrics.json".format(args.metrics_host, port)
+    sys.stdout.write(format_line("--", msg))
+    return metrics
+
+
+def start_profiler(args):
+    """ returns the profiler of the command, profiling from the start with --profile """
+
+    name = "pea-{}".format(args.func.__name__)
+    if getattr(args, "worker", None):
+        name += "-w{}".format(args.part[0])
+    profiler = Profiler(args.profile_dir, name)
+    if args.profile:
+        profiler.start(args.profile)
+    return profiler
+
+
+def stop_profiler(profiler):
+    """ writes the reports of a running profiler """
+
+    if profiler.running:
+        for fname in profiler.stop():
+            sys.stdout.write(format_line("--", "Profile written to {}".format(fname)))
+
+
+async def hold(args, devices):
+    """ serves until cancelled, worker processes report their counters meanwhile """
+
+    reporter = getattr(args, "reporter", None)
+    for device in devices:
+        device.scriptBudget = args.script_budget / 1000
+    profiler = start_profiler(args)
+    metrics = await start_metrics(args, devices, profiler)
+    try:
+        if reporter:
+            await reporter.run(devices)
+        else:
+            await asyncio.Event().wait()
+    finally:
+        if metrics:
+            metrics.stop()
+        stop_profiler(profiler)
+        for device in devices:
+            device.stop()
+        if reporter:
+            reporter.report(devices)
+
+
+async def serve(args):
+    """ loads the template and its script and serves it until interrupted """
+
+    stream = open_log(args)
+    writer = LineWriter(stream, args.bytecount, quiet=args.quiet)
+    capture = start_capture(args)
+    recorder = None
+
+    try:
+        template = Template.load(args.template)
+        device = Device(template)
+        device.listeners.append(writer)
+        if capture:
+            device.listeners.append(capture.listener(device))
+        device.logmode = args.log_mode
+
+        msg = "{} - {} loaded with a Response Delay of {}s".format(
+            template.manufacturer, template.model, template.delay
+        )
+        writer("--", msg)
+        if template.script and not device.loadScript():
+            return 1
+
+        recorder = start_recording(args, [device])
+        await device.start(args.host, args.port, args.reuse_port)
+        await hold(args, [device])
+    finally:
+        close_writer(recorder)
+        close_writer(capture)
+        close_log(stream)
+
+
+async def run(args):
+    """ hosts all devices of a manifest on one event loop until interrupted """
+
+    manager = DeviceManager()
+    stream = open_log(args)
+    capture = start_capture(args)
+    recorder = None
+    streams = []
+    try:
+        for entry in load_manifest(args.manifest):
+            device = manager.addManifestEntry(entry)
+            if capture:
+                device.listeners.append(capture.listener(device))
+            if entry.get("Log") and not getattr(args, "stream", None):
+                devicestream = open(entry["Log"], "a", buffering=1)
+                streams.append(devicestream)
+                device.listeners.append(LineWriter(devicestream, args.bytecount, quiet=args.quiet))
+            else:
+                device.listeners.append(LineWriter(stream, args.bytecount, "[{}] ".format(device), args.quiet))
+
+        if not manager.loadScripts():
+            return 1
+        recorder = start_recording(args, manager.devices)
+        await manager.start(args.reuse_port)
+        msg = "{} devices running".format(len(manager))
+        stream.write(format_line("--", msg))
+        await hold(args, manager.devices)
+    finally:
+        for devicestream in streams:
+            devicestream.close()
+        close_writer(recorder)
+        close_writer(capture)
+        close_log(stream)
+
+
+async def fleet(args):
+    """ runs count identical instances of one template until interrupted """
+
+    stream = open_log(args)
+    capture = start_capture(args)
+    recorder = None
+    try:
+        template = Template.load(args.template)
+        hosts = [host.strip() for host in args.hosts.split(",")] if args.hosts else None
+        devices = Fleet(template)
+        ok = await devices.launch(args.count, args.port, hosts, args.name, args.part)
+        for device in devices:  # listeners are added after measuring, they are not per instance state
+            device.listeners.append(LineWriter(stream, args.bytecount, "[{}] ".format(device), args.quiet))
+            if capture:
+                device.listeners.append(capture.listener(device))
+        if not ok:
+            msg = "Script import failed: {}".format(template.scriptFile())
+            stream.write(format_line("ER", msg))
+            devices.stop()
+            return 1
+        recorder = start_recording(args, devices.devices)
+
+        first, last = devices.devices[0], devices.devices[-1]
+        msg = "{} instances running on {}:{} .. {}:{}".format(len(devices), first.host, first.port, last.host, last.port)
+        stream.write(format_line("--", msg))
+        stream.write(format_line("--", devices.memoryReport()))
+        await hold(args, devices.devices)
+    finally:
+        close_writer(recorder)
+        close_writer(capture)
+        close_log(stream)
+
+
+def parse_speed(text):
+    """ replay speed: 'max' or a factor like 1, 10 or 10x """
+
+    if text.lower() == "max":
+        return 0.0
+    try:
+        speed = float(text.lower().rstrip("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("speed must be max or a factor like 10x")
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("speed must be positive")
+    return speed
+
+
+async def replay(args):
+    """ replays a recorded session as the client against a device, or as the server """
+
+    connections = load_session(args.session)
+    if not connections:
+        print("No connections recorded in {}".format(args.session), file=sys.stderr)
+        return 1
+
+    if args.serve:
+        writer = LineWriter(sys.stdout, args.bytecount, quiet=args.quiet)
+        port = args.port or connections[0].port
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(lambda: ReplayServer(connections, args.speed, writer), args.host, port)
+        writer("--", "Replaying {} recorded connections on port {}".format(len(connections), port))
+        try:
+            await asyncio.Event().wait()
+        finally:
+            server.close()
+        return 0
+
+    started = time.monotonic()
+    results = await replay_client(connections, args.host, args.port, args.speed, args.timeout)
+    failed = 0
+    for result in results:
+        if "error" in result:
+            status = "error: {}".format(result["error"])
+        elif result["mismatch"] is None:
+            status = "responses match"
+        else:
+            status = "responses differ at byte {}".format(result["mismatch"])
+        if status != "responses match":
+            failed += 1
+        print("#{}: sent {} msgs/{} bytes, received {} of {} bytes, {}".format(
+            result["conn"], result["sent"], result["sentbytes"], result["received"], result["expected"], status
+        ))
+    print("{} connections replayed in {:.3f}s, {} failed".format(len(results), time.monotonic() - started, failed))
+    return 1 if failed else 0
+
+
+def parse_address(text):
+    """ splits host:port """
+
+    host, _, port = text.rpartition(":")
+    if not host or not port.isdigit():
+        raise ValueError("address must be host:port, not {}".format(text))
+    return host, int(port)
+
+
+async def bench(args):
+    """ benchmarks the template in-process or a running device with concurrent clients """
+
+    template = Template.load(args.template)
+    if args.delay is not None:
+        template.delay = args.delay
+    greeting = template.queryIndex.get(b"ON_CONNECT")
+    greeting = greeting.response if greeting else b""
+
+    device = None
+    if args.target:
+        host, port = parse_address(args.target)
+    else:
+        device = Device(template)
+        if template.script and not device.loadScript(quiet=True):
+            return 1
+        host, port = "127.0.0.1", args.port or template.port
+        await device.start(host, port)
+    try:
+        results = await run_bench(
+            host, port, bench_commands(template), greeting, args.clients, args.duration, args.rate, args.timeout
+        )
+    finally:
+        if device:
+            device.stop()
+
+    results["template"] = str(template)
+    results["target"] = args.target or "in-process"
+    results["clients"] = args.clients
+    results["delay"] = template.delay
+    print(report_table(results), end="")
+    if args.json == "-":
+        print(json.dumps(results))
+    elif args.json:
+        with open(args.json, "w") as outfile:
+            json.dump(results, outfile, indent=4)
+    return 1 if results["errors"] else 0
+
+
+async def microbench(args):
+    """ times the hot paths and compares them with the saved baseline """
+
+    names = args.case or None
+    unknown = set(names or ()) - {name for name, description, setup in suite.CASES}
+    if unknown:
+        raise ValueError("Unknown benchmark cases: {}".format(", ".join(sorted(unknown))))
+    if args.list:
+        for name, description, setup in suite.CASES:
+            print("{:<18} {}".format(name, description))
+        return 0
+
+    results = await suite.run_cases(names, args.repeat)
+    table, regressions = suite.compare(results, suite.load_baseline(args.baseline), args.threshold)
+    print(table, end="")
+    if args.save:
+        suite.save_baseline(args.baseline, results)
+        print("Baseline saved to {}".format(args.baseline))
+    elif regressions:
+        print("{} cases slower than the baseline by more than {:.0%}: {}".format(
+            len(regressions), args.threshold, ", ".join(regressions)
+        ))
+        return 1
+    return 0
+
+
+async def learn(args):
+    """ proxies the clients to the upstream device and writes the learned template when stopped """
+
+    writer = LineWriter(sys.stdout, args.bytecount, quiet=args.quiet)
+    learner = Learner(to_bytes(args.delimiter) if args.delimiter else None)
+    proxy = LearningProxy(learner, parse_address(args.upstream), writer)
+    await proxy.start(args.host, args.port)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        proxy.stop()
+        data = learner.template(args.manufacturer, args.model, args.category, args.version, args.port)
+        with open(args.out, "w") as outfile:
+            json.dump(data, outfile, indent=4)
+        msg = "Learned {} commands with a median delay of {}s, saved to {}".format(len(data[7]), data[5]["Delay"], args.out)
+        writer("--", msg)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="pea", description="PEA - Python Emulator for Audiovisual devices, headless mode"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = commands.add_parser("serve", help="emulate a device from a JSON template")
+    serve_parser.add_argument("template", help="emulator JSON file, a script with the same name is loaded if enabled")
+    serve_parser.add_argument("--port", type=int, help="TCP port, defaults to the port of the template")
+    serve_parser.add_argument("--host", default="0.0.0.0", help="address to listen on")
+    serve_parser.add_argument("--log-mode", action="store_true", help="do not reply errors for unknown commands")
+    serve_parser.set_defaults(func=serve)
+
+    run_parser = commands.add_parser("run", help="emulate all devices listed in a manifest")
+    run_parser.add_argument("manifest", help="JSON list of devices with Template, Port, Name, Host, Log and LogMode")
+    run_parser.set_defaults(func=run)
+
+    fleet_parser = commands.add_parser("fleet", help="emulate many identical devices from one template")
+    fleet_parser.add_argument("template", help="emulator JSON file, shared by all instances")
+    fleet_parser.add_argument("--count", type=int, required=True, help="number of instances")
+    fleet_parser.add_argument("--port", type=int, help="first TCP port, defaults to the port of the template")
+    fleet_parser.add_argument("--hosts", help="comma separated IP aliases, every alias gets the same ports")
+    fleet_parser.add_argument("--name", default="{model}-{n:03d}", help="instance name pattern")
+    fleet_parser.set_defaults(func=fleet)
+
+    replay_parser = commands.add_parser("replay", help="replay a session recorded with --record")
+    replay_parser.add_argument("session", help="session file")
+    replay_parser.add_argument("--host", default="127.0.0.1", help="device to replay against, address to listen on with --serve")
+    replay_parser.add_argument("--port", type=int, help="port to use instead of the recorded ones")
+    replay_parser.add_argument("--speed", type=parse_speed, default=1.0, help="1x recorded timing, Nx faster, or max")
+    replay_parser.add_argument("--timeout", type=float, default=2.0, help="seconds to wait for outstanding responses")
+    replay_parser.add_argument("--serve", action="store_true", help="act as the device, answering with the recorded responses")
+    replay_parser.add_argument("--bytecount", action="store_true", help="show the bytecount of IN/OU lines with --serve")
+    replay_parser.add_argument("--quiet", action="store_true", help="only log info and error lines with --serve")
+    replay_parser.set_defaults(func=replay)
+
+    learn_parser = commands.add_parser("learn", help="proxy clients to a device and learn a template from the traffic")
+    learn_parser.add_argument("upstream", help="host:port of the real device or a stand-in")
+    learn_parser.add_argument("--port", type=int, required=True, help="TCP port the clients connect to")
+    learn_parser.add_argument("--host", default="0.0.0.0", help="address to listen on")
+    learn_parser.add_argument("--out", default="learned.json", help="template file written when stopped")
+    learn_parser.add_argument("--delimiter", help="end of a query, like \\r, otherwise every read is one query")
+    learn_parser.add_argument("--manufacturer", default="Unknown", help="manufacturer of the template")
+    learn_parser.add_argument("--model", default="Learned", help="model of the template")
+    learn_parser.add_argument("--category", default="Learned", help="category of the template")
+    learn_parser.add_argument("--version", default="1_0_0_0", help="version of the template")
+    learn_parser.add_argument("--bytecount", action="store_true", help="show the bytecount of IN/OU lines")
+    learn_parser.add_argument("--quiet", action="store_true", help="only log info and error lines, no traffic")
+    learn_parser.set_defaults(func=learn)
+
+    bench_parser = commands.add_parser("bench", help="measure throughput and latency with concurrent clients")
+    bench_parser.add_argument("template", help="emulator JSON file, its queries are sent and its responses expected")
+    bench_parser.add_argument("--target", help="host:port of a running device, otherwise the template is served in-process")
+    bench_parser.add_argument("--port", type=int, help="port of the in-process device, defaults to the port of the template")
+    bench_parser.add_argument("--clients", type=int, default=10, help="concurrent clients, each with one query in flight")
+    bench_parser.add_argument("--duration", type=float, default=10.0, help="seconds to run")
+    bench_parser.add_argument("--rate", type=float, default=0.0, help="total queries per second, 0 sends flat out")
+    bench_parser.add_argument("--delay", type=float, help="response delay instead of the one of the template, 0 for raw speed")
+    bench_parser.add_argument("--timeout", type=float, default=2.0, help="seconds to wait for a response")
+    bench_parser.add_argument("--json", help="also write the results as JSON to this file, - for stdout")
+    bench_parser.set_defaults(func=bench)
+
+    micro_parser = commands.add_parser("microbench", help="time the hot paths and compare them with a baseline")
+    micro_parser.add_argument("case", nargs="*", help="cases to run, all by default")
+    micro_parser.add_argument("--list", action="store_true", help="list the cases")
+    micro_parser.add_argument("--baseline", default=suite.DEFAULT_BASELINE, help="baseline results file")
+    micro_parser.add_argument("--save", action="store_true", help="save the results as the new baseline")
+    micro_parser.add_argument("--threshold", type=float, default=suite.DEFAULT_THRESHOLD, help="slowdown flagged as regression, 0.25 is 25%%")
+    micro_parser.add_argument("--repeat", type=int, default=5, help="runs per case, the best one counts")
+    micro_parser.set_defaults(func=microbench)
+
+    for serving_parser in (serve_parser, run_parser, fleet_parser):
+        serving_parser.add_argument("--log", help="append the log to this file instead of stdout")
+        serving_parser.add_argument("--bytecount", action="store_true", help="show the bytecount of IN/OU lines")
+        serving_parser.add_argument("--quiet", action="store_true", help="only log info and error lines, no traffic")
+        serving_parser.add_argument(
+            "--workers", type=int, default=1,
+            help="worker processes: fleets are split between them, otherwise they share the ports with SO_REUSEPORT",
+        )
+        serving_parser.add_argument("--worker", help=argparse.SUPPRESS)  # set by workers.supervise()
+        serving_parser.add_argument(
+            "--capture-dir", default="captures", help="directory of the rotating capture files of all events"
+        )
+        serving_parser.add_argument("--no-capture", action="store_true", help="do not write capture files")
+        serving_parser.add_argument("--capture-format", choices=CAPTURE_FORMATS, default="text", help="capture file format")
+        serving_parser.add_argument(
+            "--capture-compress", choices=CAPTURE_COMPRESSIONS, default="none", help="compression of the capture files"
+        )
+        serving_parser.add_argument("--capture-size", type=int, default=64, help="MiB per capture file before rotating")
+        serving_parser.add_argument("--capture-keep", type=int, default=20, help="number of capture files kept")
+        serving_parser.add_argument(
+            "--metrics-port", type=int, help="serve metrics over HTTP on this port, workers use the following ports"
+        )
+        serving_parser.add_argument("--metrics-host", default="127.0.0.1", help="address of the metrics endpoint")
+        serving_parser.add_argument("--record", help="record the raw client traffic with its timing to this session file")
+        serving_parser.add_argument(
+            "--profile", choices=PROFILE_MODES,
+            help="profile the event loop until stopped, also switched on and off with /profile/start and /profile/stop of the metrics port",
+        )
+        serving_parser.add_argument("--profile-dir", default="profiles", help="directory of the profile reports")
+        serving_parser.add_argument(
+            "--script-budget", type=float, default=50, help="log script calls slower than this many ms, 0 never"
+        )
+
+    return parser
+
+
+def stop_signal(signum, frame):
+    """ SIGTERM shuts down cleanly like Ctrl-C, e.g. when a container is stopped """
+
+    raise KeyboardInterrupt
+
+
+def main(argv=None):
+    """ entry point of python -m pea <command>, returns the exit code """
+
+    if argv is None:
+        argv = sys.argv[1:]
+    signal.signal(signal.SIGTERM, stop_signal)
+    args = build_parser().parse_args(argv)
+    args.part = (0, 1)
+    args.reuse_port = False
+    try:
+        if getattr(args, "worker", None):
+            from .workers import setup_worker
+            setup_worker(args)
+        elif getattr(args, "workers", 1) > 1:
+            from .workers import supervise
+            return supervise(args, argv)
+        return asyncio.run(args.func(args)) or 0
+    except KeyboardInterrupt:
+        return 0
+    except (OSError, ValueError, KeyError) as e:
+        print("Error: {}".format(e), file=sys.stderr)
+        return 1
@@ -0,0 +1,542 @@
+"""
+    The emulated device: listening server, connected clients, response
+    scheduling and the dispatch of received frames to the template and
+    the optional device script.
+"""
+
+import io, sys, time, types, bisect, asyncio, datetime, contextlib, collections
+
+from .framing import Framer
+from .metrics import LATENCY_BUCKETS, DeviceMetrics, Histogram
+from .scriptapi import LEGACY_API, BYTES_API, ScriptRegistry, script_api, legacy_reply, reply_data
+
+SCRIPT_BUDGET = 0.05  # seconds a script call may take before it is logged as slow
+
+
+class ResponseScheduler:
+    """
+    Queues the responses of one connection and writes them once their
+    delay has passed, without ever blocking the event loop.
+
+    Every response gets an absolute deadline on the loop clock when it is
+    queued, so timing does not drift under load. Deadlines never go
+    backwards, which keeps the responses of a connection in order, and
+    only one timer is armed per connection no matter how many replies
+    are in flight.
+    """
+
+    def __init__(self, loop, send, observe=None):
+        self.loop = loop
+        self.send = send
+        self.observe = observe  # called with the seconds from receipt to write of a response
+        self.queue = collections.deque()
+        self.timer = None
+        self.lastdue = 0.0
+        self.clockres = time.get_clock_info("monotonic").resolution
+
+    def schedule(self, data, delay=0.0, received=None):
+        """ queue data to be sent after delay seconds, received is the loop time of the request """
+
+        now = self.loop.time()
+        due = now + delay
+        if due < self.lastdue:  # never overtake an earlier response
+            due = self.lastdue
+        self.lastdue = due
+
+        if not self.queue and delay <= 0:  # nothing pending, send straight away
+            self.send(data)
+            if received is not None and self.observe:
+                self.observe(self.loop.time() - received)
+            return
+
+        self.queue.append((due, data, received))
+        if self.timer is None:
+            self.timer = self.loop.call_at(due, self.flush)
+
+    def flush(self):
+        """ sends all responses that are due and re-arms the timer for the next one """
+
+        self.timer = None
+        now = self.loop.time() + self.clockres
+        queue = self.queue
+        while queue and queue[0][0] <= now:
+            due, data, received = queue.popleft()
+            self.send(data)
+            if received is not None and self.observe:
+                self.observe(self.loop.time() - received)
+        if queue:
+            self.timer = self.loop.call_at(queue[0][0], self.flush)
+
+    def cancel(self):
+        """ drops all pending responses, e.g. when the connection is lost """
+
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.queue.clear()
+
+
+class Connection:
+    """
+    One connected client: its transport, peer address, traffic counters,
+    response latency histogram, response scheduler, the variables of a
+    template state per connection and a state dict scripts can use.
+    Scripts receive this object as conn, write() works like on a transport.
+    """
+
+    nextId = 1
+
+    def __init__(self, device, transport, loop):
+        self.id = Connection.nextId
+        Connection.nextId += 1
+        self.device = device
+        self.transport = transport
+        self.peer = transport.get_extra_info('peername') or ("?", 0)
+        self.connected = datetime.datetime.now()
+        self.rxcount = 0
+        self.rxbytes = 0
+        self.txcount = 0
+        self.txbytes = 0
+        self.state = {}
+        state = device.template.state if device.template else None
+        self.variables = state.new() if state and state.scope == "connection" else None  # declared template state
+        self.latency = Histogram()
+        self.scheduler = ResponseScheduler(loop, self.sendResponse, self.observeLatency)
+        self.framer = None
+
+    def __str__(self):
+        return "#{} {}:{}".format(self.id, self.peer[0], self.peer[1])
+
+    def observeLatency(self, seconds):
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, seconds)  # same bucket in both histograms
+        latency = self.latency
+        latency.counts[bucket] += 1
+        latency.sum += seconds
+        latency = self.device.metrics.latency
+        latency.counts[bucket] += 1
+        latency.sum += seconds
+
+    def write(self, data):
+        """ writes data to this client right away and counts it, a list of buffers goes out with writelines """
+
+        if self.transport.is_closing():
+            return
+        if type(data) is list:
+            size = sum(len(buffer) for buffer in data)
+            self.transport.writelines(data)
+            if self.device.taps:
+                data = b"".join(data)
+        else:
+            size = len(data)
+            self.transport.write(data)
+        self.txcount += 1
+        self.txbytes += size
+        self.device.txcount += 1
+        self.device.txbytes += size
+        for tap in self.device.taps:
+            tap("OU", data, self)
+
+    def sendResponse(self, data):
+        """ writes a due response to this client and logs it """
+
+        if self.transport.is_closing():
+            return
+        if self.device.listeners:
+            self.device.log("OU", b"".join(data) if type(data) is list else data, self)
+        try:
+            self.write(data)
+        except Exception as e:
+            print('Exception occured in sending', e)
+
+    def close(self):
+        self.transport.close()
+
+
+class SocketServer(asyncio.Protocol):
+    """ protocol of one client connection, hands the frames to its device """
+
+    def __init__(self, device):
+        self.device = device
+        self.conn = None
+
+    def connection_made(self, transport):
+        device = self.device
+        loop = asyncio.get_running_loop()
+        self.conn = conn = Connection(device, transport, loop)
+        conn.framer = Framer(device.template.framing, loop, self.frame_received)
+        device.addConnection(conn)
+
+        command = device.template.queryIndex.get(b'ON_CONNECT')
+        if command:
+            device.log("OU", command.response, conn)
+            try:
+                conn.write(command.response)
+            except:
+                print('Error sending bytes')
+
+    def data_received(self, data):
+        for tap in self.device.taps:
+            tap("IN", data, self.conn)
+        try:
+            self.conn.framer.feed(data)
+        except ValueError as e:
+            self.device.log("ER", "Framing error: {}".format(e))
+            self.conn.framer.cancel()
+
+    def frame_received(self, data):
+        self.device.handleFrame(self.conn, data)
+
+    def connection_lost(self, exc):
+        conn = self.conn
+        conn.scheduler.cancel()
+        conn.framer.cancel()
+        self.device.removeConnection(conn)
+
+
+class Device:
+    """
+    One emulated device: a compiled Template, its optional script module,
+    the listening server and the registry of connected clients.
+
+    Everything the device does is reported as (direction, data, conn) to
+    the callables in listeners, watchers are called with the device
+    whenever a client connects or disconnects. taps get the raw bytes read
+    from and written to the clients as ("IN" or "OU", data, conn), before
+    framing, for session recording.
+    """
+
+    __slots__ = (
+        "template", "name", "script", "server", "host", "port",
+        "connections", "listeners", "watchers", "taps", "logmode",
+        "clients", "rxcount", "rxbytes", "txcount", "txbytes", "metrics", "scriptBudget", "variables", "scriptApi", "rxscript",
+    )
+
+    def __init__(self, template=None, name=None):
+        self.template = template
+        self.name = name
+        self.script = None
+        self.scriptApi = LEGACY_API
+        self.rxscript = None  # answers received data for the script: its pea.on dispatch or rxscript
+        self.server = None
+        self.host = None
+        self.port = 0
+        self.connections = {}
+        self.listeners = []
+        self.watchers = []
+        self.taps = []
+        self.logmode = False  # no error replies for unknown commands
+        self.clients = 0
+        self.rxcount = 0
+        self.rxbytes = 0
+        self.txcount = 0
+        self.txbytes = 0
+        self.metrics = DeviceMetrics()
+        self.scriptBudget = SCRIPT_BUDGET  # None or 0 never warns
+        self.variables = None
+        self.resetState()
+
+    def __str__(self):
+        if self.name:
+            return self.name
+        return str(self.template) if self.template else "No device"
+
+    def log(self, direction, data, conn=None):
+        """ reports one event to all listeners """
+
+        for listener in self.listeners:
+            listener(direction, data, conn)
+
+    # template and script ---------------------------------------------------
+
+    def setTemplate(self, template):
+        self.template = template
+        self.script = None
+        self.rxscript = None
+        self.metrics.reset()
+        self.resetState()
+
+    def resetState(self):
+        """ sets the variables of the template state to their defaults, for the device or every client """
+
+        state = self.template.state if self.template else None
+        self.variables = state.new() if state and state.scope == "device" else None
+        for conn in self.connections.values():
+            conn.variables = state.new() if state and state.scope == "connection" else None
+
+    def reloadCommands(self):
+        """ re-reads the commands of the template file, the state starts over """
+
+        self.template.reloadCommands()
+        self.resetState()
+
+    def loadTemplate(self, template):
+        """ switches to template and runs its script if it has one, returns False if that failed """
+
+        self.setTemplate(template)
+        if template.script:
+            return self.loadScript()
+        return True
+
+    def loadScript(self, quiet=False):
+        """
+        runs the script with the same name next to the template, returns
+        True on success. The code is compiled once per template, but every
+        device gets its own module instance, so devices running the same
+        script share its code and not its globals. quiet hides the prints
+        of the script while it starts.
+        """
+
+        template = self.template
+        msg = "Importing Script file: {}.py".format(template.scriptName)
+        self.log("--", msg)
+        if template.path not in sys.path:  # scripts may import their neighbours
+            sys.path.append(template.path)
+        try:
+            script = types.ModuleType(template.scriptName)
+            script.__file__ = template.scriptFile()
+            self.execScript(script, template.compileScript(), quiet)
+            self.scriptApi = script_api(script)
+        except Exception as e:
+            self.script = None
+            self.rxscript = None
+            msg = "Script import failed: {}.py".format(e)
+            self.log("ER", msg)
+            return False
+        self.script = script
+        return True
+
+    def execScript(self, script, code, quiet=False):
+        """ runs the script code in its module with a new pea registry and binds its handlers """
+
+        script.pea = ScriptRegistry()
+        if quiet:
+            with contextlib.redirect_stdout(io.StringIO()):
+                exec(code, script.__dict__)
+        else:
+            exec(code, script.__dict__)
+        self.rxscript = script.pea.bind(script)
+
+    def reloadScript(self):
+        """ compiles a changed script again and re-runs it in the module instance of this device """
+
+        if self.script:
+            self.execScript(self.script, self.template.compileScript(reload=True))
+            self.scriptApi = script_api(self.script)
+
+    def funcNames(self):
+        """ returns the names of the five custom function buttons of the script """
+
+        try:
+            return [str(name) for name in self.script.funcName[:5]]
+        except Exception:
+            msg = "Script import: Problem with Custom Function names 'funcName'"
+            self.log("ER", msg)
+            return None
+
+    def customFunc(self, func):
+        """ runs customFunc of the script and returns its response as bytes and as the script returned it """
+
+        metrics = self.metrics
+        metrics.customCalls += 1
+        started = time.monotonic()
+        try:
+            byteresponse = self.script.customFunc(func)
+        except Exception as e:
+            metrics.scriptErrors += 1
+            print('Exception occured in customFunc', e)
+            return None, None
+        finally:
+            elapsed = time.monotonic() - started
+            metrics.customSeconds += elapsed
+            self.checkBudget(elapsed, "customFunc", func)
+        if not byteresponse:
+            return None, byteresponse
+        if self.scriptApi == BYTES_API:
+            data = reply_data(byteresponse)
+            return b"".join(data) if type(data) is list else bytes(data), byteresponse
+        return legacy_reply(byteresponse), byteresponse
+
+    def checkBudget(self, elapsed, function, argument):
+        """ logs a script call that took longer than scriptBudget with the input that made it slow """
+
+        if self.scriptBudget and elapsed > self.scriptBudget:
+            self.metrics.slowCalls += 1
+            msg = "Script {} took {:.1f} ms for {!r}, over the budget of {:g} ms".format(
+                function, elapsed * 1000, argument, self.scriptBudget * 1000
+            )
+            self.log("ER", msg)
+
+    def runCustomFunc(self, func, ids=None):
+        """ runs custom function func of the script and sends its response to the clients in ids, None is all """
+
+        if not self.script:
+            msg = "No script functions are loaded"
+            self.log("--", msg)
+            return
+
+        byteresponsesend, byteresponse = self.customFunc(func)
+        targets = self.targets(ids)
+        if byteresponsesend and targets:
+            if b"$$$" in byteresponsesend:
+                self.log("FB", byteresponsesend[3:])
+            else:
+                for conn in targets:
+                    self.log("OU", byteresponsesend, conn)
+                    conn.write(byteresponsesend)
+        else:
+            msg = "No TCP connection detected"
+            self.log("--", msg)
+
+    # server -------------------------------------------------------------
+
+    async def start(self, host="0.0.0.0", port=None, reuse_port=False):
+        """
+        opens the listening port, defaults to the port of the template.
+        reuse_port lets several worker processes listen on the same port.
+        """
+
+        self.host = host
+        self.port = int(port or self.template.port)
+        loop = asyncio.get_running_loop()
+        self.server = await loop.create_server(
+            lambda: SocketServer(self), host, self.port, reuse_port=reuse_port or None
+        )
+        msg = "Port {} is open".format(self.port)
+        self.log("--", msg)
+
+    def stop(self):
+        """ disconnects all clients and closes the listening port """
+
+        for conn in list(self.connections.values()):
+            conn.close()
+        if self.server:
+            self.server.close()
+            self.server = None
+            msg = "Port is closed"
+            self.log("--", msg)
+
+    def targets(self, ids=None):
+        """ returns the connections with the given ids, all of them for None """
+
+        if ids is None:
+            return list(self.connections.values())
+        return [self.connections[connid] for connid in ids if connid in self.connections]
+
+    def sendTo(self, data, ids=None):
+        """ sends data right away to the clients in ids, None is all """
+
+        targets = self.targets(ids)
+        if not targets:
+            msg = "No TCP connection detected"
+            self.log("--", msg)
+        for conn in targets:
+            self.log("OU", data, conn)
+            conn.write(data)
+
+    def closeConnections(self, ids=None):
+        """ disconnects the clients in ids, None is all """
+
+        for conn in self.targets(ids):
+            conn.close()
+
+    def counters(self):
+        """ returns the traffic counters of this device since it was created """
+
+        return {
+            "clients": self.clients, "connected": len(self.connections),
+            "rxcount": self.rxcount, "rxbytes": self.rxbytes,
+            "txcount": self.txcount, "txbytes": self.txbytes,
+        }
+
+    def addConnection(self, conn):
+        self.connections[conn.id] = conn
+        self.clients += 1
+        msg = "Client {} connected".format(conn)
+        self.log("--", msg)
+        for watcher in self.watchers:
+            watcher(self)
+
+    def removeConnection(self, conn):
+        self.connections.pop(conn.id, None)
+        msg = "Client {} disconnected (in: {} msgs/{} bytes, out: {} msgs/{} bytes)".format(
+            conn, conn.rxcount, conn.rxbytes, conn.txcount, conn.txbytes
+        )
+        self.log("--", msg)
+        for watcher in self.watchers:
+            watcher(self)
+
+    # dispatch -----------------------------------------------------------
+
+    def handleFrame(self, conn, data):
+        """ answers one received frame from the template or the script """
+
+        conn.rxcount += 1
+        conn.rxbytes += len(data)
+        self.rxcount += 1
+        self.rxbytes += len(data)
+        loop = conn.scheduler.loop
+        received = loop.time()
+        metrics = self.metrics
+        self.log("IN", data, conn)
+
+        template = self.template
+        command = template.queryIndex.get(data)
+        found = None
+        if command is None and template.matcher:  # prefix, regex and mask queries in one pass
+            found = template.matcher(data)
+            if found:
+                command = template.patternCommands[found.lastgroup]
+        if command is not None and command.actions is not None:
+            try:
+                if not command.actions(found, conn, self, command):
+                    command = command.actions.otherwise  # a guard failed
+            except Exception as e:
+                self.log("ER", "State error in {}: {}".format(command.description, e))
+                command = None
+
+        if command:  # command found in query
+            metrics.commands[command.index] += 1
+            if command.render is None:
+                conn.scheduler.schedule(command.response, template.delay, received)
+            else:
+                try:
+                    conn.scheduler.schedule(command.render(found, conn, self, command), template.delay, received)
+                except Exception as e:
+                    self.log("ER", "Response format error in {}: {}".format(command.description, e))
+        else:  # command not found in query, trying script
+
+            if self.rxscript:  # invoke the script (if there is one)
+                byteresponse = None
+                bytesapi = self.scriptApi == BYTES_API
+                metrics.scriptCalls += 1
+                started = loop.time()
+                try:
+                    byteresponse = self.rxscript(conn, memoryview(data) if bytesapi else data)
+                except Exception as e:
+                    metrics.scriptErrors += 1
+                    print('Exception occured in devscript', e)
+                elapsed = loop.time() - started
+                metrics.scriptSeconds += elapsed
+                if self.scriptBudget and elapsed > self.scriptBudget:
+                    self.checkBudget(elapsed, "rxscript", data)
+                try:
+                    if byteresponse:
+                        if bytesapi:  # written as the script returned it
+                            conn.scheduler.schedule(reply_data(byteresponse), 0, received)
+                        else:
+                            conn.scheduler.schedule(legacy_reply(byteresponse), 0, received)
+                    else:  # Nothing found in query or script
+                        metrics.misses += 1
+                        if not self.logmode:
+                            byteresponse = "Error - no match found in query or script"
+                            self.log("ER", byteresponse)
+                            conn.scheduler.schedule(bytes(byteresponse, "utf-8"), 0, received)
+                except:
+                    metrics.scriptErrors += 1
+                    self.log("ER", 'Script ERROR!')
+            else:  # Nothing found in query
+                metrics.misses += 1
+                if not self.logmode:
+                    byteresponse = "Error - no match found with query"
+                    self.log("ER", byteresponse)
+                    conn.scheduler.schedule(bytes(byteresponse, "utf-8"), 0, received)
@@ -0,0 +1,129 @@
+"""
+    Runs the emulation engine on its own asyncio loop in a background
+    thread, so a GUI redraw never delays a protocol reply.
+
+    The GUI talks to the engine only through EngineThread.call/wait/submit,
+    the engine reports back only through an EventQueue the GUI drains in
+    its own thread. A Waker lets the GUI sleep until there is something to
+    drain instead of polling the queue.
+"""
+
+import os, time, asyncio, threading, collections, concurrent.futures
+
+
+class Waker:
+    """
+    Self-pipe the engine writes one byte to when events are waiting, the
+    GUI watches the read end with its own event loop (Tk createfilehandler).
+    """
+
+    def __init__(self):
+        self.rfd, self.wfd = os.pipe()
+        os.set_blocking(self.rfd, False)
+        os.set_blocking(self.wfd, False)
+
+    def fileno(self):
+        return self.rfd
+
+    def notify(self):
+        try:
+            os.write(self.wfd, b"!")
+        except (BlockingIOError, OSError):  # a full pipe wakes up the reader anyway
+            pass
+
+    def clear(self):
+        try:
+            while os.read(self.rfd, 512):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    def close(self):
+        os.close(self.rfd)
+        os.close(self.wfd)
+
+
+class EventQueue:
+    """
+    Thread-safe queue of events from the engine to the GUI. Device events
+    carry the connection id and the monotonic time they happened at, not
+    when the GUI gets to them.
+    notify is called once when events arrive after a drain, not per event.
+    """
+
+    def __init__(self, notify=None):
+        self.events = collections.deque()  # append and popleft are thread-safe
+        self.notify = notify
+        self.notified = False
+
+    def log(self, direction, data, conn=None):
+        """ device listener """
+
+        self.put("log", direction, data, None if conn is None else conn.id, time.monotonic())
+
+    def clients(self, device):
+        """ device watcher, passes a snapshot of the connected clients """
+
+        self.put("clients", [(conn.id, str(conn)) for conn in device.connections.values()])
+
+    def put(self, *event):
+        self.events.append(event)
+        if self.notify and not self.notified:
+            self.notified = True
+            self.notify()
+
+    def drain(self):
+        """ returns all queued events, oldest first """
+
+        self.notified = False  # before popping, so an event put meanwhile notifies again
+        events = []
+        popleft = self.events.popleft
+        try:
+            while True:
+                events.append(popleft())
+        except IndexError:
+            return events
+
+
+class EngineThread(threading.Thread):
+    """ background thread running the asyncio loop of the engine until stop() """
+
+    def __init__(self):
+        threading.Thread.__init__(self, name="pea-engine", daemon=True)
+        self.loop = asyncio.new_event_loop()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+    def stop(self):
+        if self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        self.join(timeout=2)
+
+    def call(self, func, *args):
+        """ runs func(*args) in the engine thread without waiting for it """
+
+        self.loop.call_soon_threadsafe(func, *args)
+
+    def submit(self, coro):
+        """ schedules a coroutine in the engine thread, returns a concurrent Future """
+
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def wait(self, func, *args, timeout=10):
+        """ runs func(*args) in the engine thread and returns its result, for quick calls only """
+
+        future = concurrent.futures.Future()
+
+        def runner():
+            try:
+                future.set_result(func(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+        self.loop.call_soon_threadsafe(runner)
+        return future.result(timeout)
@@ -0,0 +1,80 @@
+"""
+    Fleet mode: hundreds of identical devices from one template, e.g. all
+    displays of a campus, on a port range and/or several IP aliases.
+
+    All instances share the compiled template and the compiled script
+    code, each instance only owns its script globals (e.g. dev['MuteState']),
+    its server and its connections.
+"""
+
+import tracemalloc
+
+from .manager import DeviceManager
+
+
+def fleet_addresses(count, port, hosts=None):
+    """
+    returns (host, port) for count instances: with several hosts every host
+    gets the same ports, otherwise the instances use consecutive ports
+    """
+
+    hosts = hosts or ["0.0.0.0"]
+    return [(hosts[idx % len(hosts)], port + idx // len(hosts)) for idx in range(count)]
+
+
+class Fleet(DeviceManager):
+    """ a DeviceManager whose devices are all created from one Template """
+
+    def __init__(self, template):
+        DeviceManager.__init__(self)
+        self.template = template
+        self.instanceBytes = 0
+
+    def populate(self, count, port=None, hosts=None, name="{model}-{n:03d}", part=(0, 1)):
+        """
+        creates count instances and runs their scripts, returns False if a
+        script failed. part=(worker, workers) only creates every workers-th
+        instance, so worker processes can split a fleet between them.
+        """
+
+        template = self.template
+        worker, workers = part
+        ok = True
+        for n, (host, port) in enumerate(fleet_addresses(count, int(port or template.port), hosts), 1):
+            if (n - 1) % workers != worker:
+                continue
+            device = self.add(template, name.format(model=template.model, n=n), port, host)
+            if template.script and not device.loadScript(quiet=len(self) > 1):
+                ok = False
+        return ok
+
+    async def launch(self, count, port=None, hosts=None, name="{model}-{n:03d}", part=(0, 1)):
+        """
+        populates and starts the fleet while tracemalloc measures the memory
+        the instances and their servers take, tracing stops once they run
+        """
+
+        if self.template.script:
+            self.template.compileScript()  # shared, so not part of the instance cost
+
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        try:
+            if not self.populate(count, port, hosts, name, part):
+                return False
+            await self.start()
+            self.instanceBytes = (tracemalloc.get_traced_memory()[0] - before) / max(len(self), 1)
+        finally:
+            if not tracing:
+                tracemalloc.stop()
+        return True
+
+    def memoryReport(self):
+        """ returns a line describing the memory cost per instance """
+
+        total = self.instanceBytes * len(self)
+        return "Fleet of {} x {}: {:.1f} KiB per instance, {:.1f} MiB in total (Python heap, excluding sockets)".format(
+            len(self), self.template, self.instanceBytes / 1024, total / 1024 / 1024
+        )
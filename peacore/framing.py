@@ -0,0 +1,182 @@
+"""
+    Stream framing: cuts the byte stream of a connection into the frames
+    that are matched against the template queries.
+"""
+
+import collections
+
+# compiled stream framing options of a template, see compile_framing()
+FrameSpec = collections.namedtuple(
+    "FrameSpec", "mode delimiter strip length offset size order adjust timeout maxlength"
+)
+FRAMING_MODES = ("none", "delimiter", "fixed", "length", "gap")
+
+
+def compile_framing(options):
+    """
+    Turns the optional "Framing" entry of a template into a FrameSpec.
+
+        {"Framing": {"Mode": "delimiter", "Delimiter": "\\r", "Strip": false}}
+        {"Framing": {"Mode": "fixed", "Length": 8}}
+        {"Framing": {"Mode": "length", "Offset": 1, "Size": 2, "Order": "big", "Adjust": 1}}
+        {"Framing": {"Mode": "gap", "Timeout": 0.05}}
+
+    For length prefixed frames the field of Size bytes starts at Offset and
+    holds the number of bytes following it, Adjust is added for trailers
+    such as checksums. Timeout works in every framing mode and hands over a
+    partial frame after the line was idle that long. Without framing every
+    read is a frame, so there is nothing to time out. MaxLength caps the
+    buffer.
+    """
+
+    options = options or {}
+    mode = str(options.get("Mode", "none")).lower()
+    if mode not in FRAMING_MODES:
+        raise ValueError("Unknown framing mode {}".format(mode))
+
+    delimiter = options.get("Delimiter", "")
+    delimiter = delimiter.encode("latin-1").decode("unicode_escape").encode("latin-1")  # same escapes as queries
+    if mode == "delimiter" and not delimiter:
+        raise ValueError("Framing mode delimiter needs a Delimiter")
+
+    spec = FrameSpec(
+        mode=mode,
+        delimiter=delimiter,
+        strip=bool(options.get("Strip", False)),
+        length=int(options.get("Length", 0)),
+        offset=int(options.get("Offset", 0)),
+        size=int(options.get("Size", 1)),
+        order=str(options.get("Order", "big")).lower(),
+        adjust=int(options.get("Adjust", 0)),
+        timeout=float(options.get("Timeout", 0.0)),
+        maxlength=int(options.get("MaxLength", 65536)),
+    )
+    if mode == "fixed" and spec.length <= 0:
+        raise ValueError("Framing mode fixed needs a Length above 0")
+    if mode == "gap" and spec.timeout <= 0:
+        raise ValueError("Framing mode gap needs a Timeout above 0")
+    return spec
+
+
+class Framer:
+    """
+    Reassembles the byte stream of one connection into complete frames
+    according to a FrameSpec and hands each frame to onFrame.
+
+    Incoming data is appended to one bytearray, frames are cut from a
+    memoryview of it and the consumed part is dropped once per read.
+    Delimiter searches resume where the last search stopped, so no byte
+    is scanned twice however the data was split or merged by TCP.
+    """
+
+    def __init__(self, spec, loop, onFrame):
+        self.spec = spec
+        self.loop = loop
+        self.onFrame = onFrame
+        self.buffer = bytearray()
+        self.scanpos = 0
+        self.lastrx = 0.0
+        self.timer = None
+
+    def feed(self, data):
+        """ adds received data and emits all frames that are complete, a ValueError after them for bad data """
+
+        spec = self.spec
+        if spec.mode == "none":  # every read is one command
+            self.onFrame(data)
+            return
+
+        buffer = self.buffer
+        buffer += data
+        frames = []
+        start = 0
+        invalid = None
+
+        with memoryview(buffer) as view:
+            end = len(buffer)
+            while start < end:
+                try:
+                    stop = self.frameEnd(buffer, start, end)
+                except ValueError as e:  # the frames before it are still good
+                    invalid = e
+                    break
+                if stop is None:
+                    break
+                if spec.strip and spec.mode == "delimiter":
+                    frames.append(bytes(view[start:stop - len(spec.delimiter)]))
+                else:
+                    frames.append(bytes(view[start:stop]))
+                start = stop
+
+        if start:
+            del buffer[:start]
+            self.scanpos = max(self.scanpos - start, 0)
+
+        if len(buffer) > spec.maxlength:  # never grow without limit on garbage
+            frames.append(bytes(buffer))
+            buffer.clear()
+            self.scanpos = 0
+
+        if spec.timeout > 0 and buffer:
+            self.lastrx = self.loop.time()
+            if self.timer is None:
+                self.timer = self.loop.call_later(spec.timeout, self.checkIdle)
+
+        for frame in frames:
+            self.onFrame(frame)
+        if invalid is not None:
+            raise invalid
+
+    def frameEnd(self, buffer, start, end):
+        """ returns the end of the frame starting at start, None if it is not complete yet """
+
+        spec = self.spec
+
+        if spec.mode == "delimiter":
+            delimiter = spec.delimiter
+            found = buffer.find(delimiter, max(self.scanpos, start), end)
+            if found < 0:
+                self.scanpos = max(end - len(delimiter) + 1, start)
+                return None
+            self.scanpos = found + len(delimiter)
+            return self.scanpos
+
+        if spec.mode == "fixed":
+            stop = start + spec.length
+            return stop if stop <= end else None
+
+        if spec.mode == "length":
+            field = start + spec.offset
+            if field + spec.size > end:
+                return None
+            value = int.from_bytes(buffer[field:field + spec.size], spec.order)
+            stop = field + spec.size + value + spec.adjust
+            if stop <= start:
+                raise ValueError("Invalid length prefix")
+            return stop if stop <= end else None
+
+        return None  # gap mode, only the idle timer ends a frame
+
+    def checkIdle(self):
+        """ flushes a partial frame once the line was idle for the timeout """
+
+        self.timer = None
+        if not self.buffer:
+            return
+        remaining = self.lastrx + self.spec.timeout - self.loop.time()
+        if remaining > 0:  # data arrived in between, wait for the rest of the gap
+            self.timer = self.loop.call_later(remaining, self.checkIdle)
+            return
+        frame = bytes(self.buffer)
+        self.buffer.clear()
+        self.scanpos = 0
+        self.onFrame(frame)
+
+    def cancel(self):
+        """ stops the idle timer and drops buffered data """
+
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.buffer.clear()
+        self.scanpos = 0
@@ -0,0 +1,221 @@
+"""
+    Learning proxy: forwards the clients to an upstream device and learns
+    a template from the traffic.
+
+    Forwarding writes every read straight to the other side and pauses
+    reading on one side while the other side's write buffer is full, so
+    the proxy adds next to no latency and never buffers without bound.
+    The learner only notes each chunk with its time; a query is what the
+    client sent (split at the delimiter if there is one), its response is
+    everything upstream sent back until the next query.
+"""
+
+import time, asyncio, statistics, collections
+
+from .template import from_bytes
+
+ON_CONNECT = b"ON_CONNECT"
+
+
+class LearnedCommand:
+    """ everything seen for one query: the responses with their counts and the response delays """
+
+    def __init__(self, query):
+        self.query = query
+        self.count = 0
+        self.responses = collections.Counter()
+        self.delays = []
+
+    def response(self):
+        """ the most frequent response """
+
+        return self.responses.most_common(1)[0][0] if self.responses else b""
+
+    def delay(self):
+        return statistics.median(self.delays) if self.delays else 0.0
+
+
+class Learner:
+    """ pairs the queries and responses of all proxied connections """
+
+    def __init__(self, delimiter=None):
+        self.delimiter = delimiter
+        self.commands = collections.OrderedDict()  # query -> LearnedCommand, in the order first seen
+        self.unsolicited = 0
+        self.pending = {}  # connection id -> [query, sent time, response, first response time, query buffer]
+
+    def opened(self, connid):
+        self.pending[connid] = [ON_CONNECT, time.monotonic(), bytearray(), None, bytearray()]
+
+    def query(self, connid, data):
+        """ notes bytes the client sent """
+
+        state = self.pending[connid]
+        if not self.delimiter:
+            self.finish(connid)
+            self.pending[connid] = [bytes(data), time.monotonic(), bytearray(), None, bytearray()]
+            return
+        buffer = state[4]
+        buffer += data
+        while True:
+            end = buffer.find(self.delimiter)
+            if end < 0:
+                return
+            end += len(self.delimiter)
+            query = bytes(buffer[:end])
+            del buffer[:end]
+            self.finish(connid)
+            state = self.pending[connid] = [query, time.monotonic(), bytearray(), None, buffer]
+
+    def response(self, connid, data):
+        """ notes bytes upstream sent back """
+
+        state = self.pending.get(connid)
+        if state is None or state[0] is None:
+            self.unsolicited += 1
+            return
+        if state[3] is None:
+            state[3] = time.monotonic()
+        state[2] += data
+
+    def finish(self, connid):
+        """ files the query of connid that is still open with the response it got """
+
+        state = self.pending.get(connid)
+        if not state or state[0] is None:
+            return
+        query, sent, response, first = state[:4]
+        state[0] = None
+        if query == ON_CONNECT and not response:
+            return
+        command = self.commands.get(query)
+        if command is None:
+            command = self.commands[query] = LearnedCommand(query)
+        command.count += 1
+        command.responses[bytes(response)] += 1
+        if first is not None and query != ON_CONNECT:
+            command.delays.append(first - sent)
+
+    def closed(self, connid):
+        self.finish(connid)
+        self.pending.pop(connid, None)
+
+    def delay(self):
+        """ median response delay over all queries, rounded to milliseconds """
+
+        delays = [delay for command in self.commands.values() for delay in command.delays]
+        return round(statistics.median(delays), 3) if delays else 0.0
+
+    def template(self, manufacturer, model, category, version, port):
+        """ returns the learned template in the JSON list format """
+
+        for connid in list(self.pending):
+            self.finish(connid)
+        commands = []
+        for command in self.commands.values():
+            if command.query == ON_CONNECT:
+                description = "ON_CONNECT"
+            else:
+                description = "Learned, seen {}x, median delay {:.0f} ms".format(command.count, command.delay() * 1000)
+                if len(command.responses) > 1:
+                    description += ", {} different responses".format(len(command.responses))
+            commands.append({
+                "Description": description,
+                "Query": from_bytes(command.query),
+                "Response": from_bytes(command.response()),
+            })
+        template = [
+            {"Manufacturer": manufacturer}, {"Model": model}, {"Category": category},
+            {"Version": version}, {"Port": port}, {"Delay": self.delay()}, {"Script": False},
+            commands,
+        ]
+        if self.delimiter:  # the queries end with the delimiter, so the frames have to as well
+            template.append({"Framing": {"Mode": "delimiter", "Delimiter": from_bytes(self.delimiter)}})
+        return template
+
+
+class ProxySide(asyncio.Protocol):
+    """ one side of a proxied connection, writes what it reads to its peer side """
+
+    def __init__(self, learner, connid, log, peer=None, onConnect=None):
+        self.learner = learner
+        self.id = connid
+        self.log = log
+        self.upstream = peer is not None
+        self.peer = peer
+        self.onConnect = onConnect
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.onConnect:  # a client is not read until its upstream side is connected
+            transport.pause_reading()
+            asyncio.ensure_future(self.onConnect(self))
+
+    def data_received(self, data):
+        self.peer.transport.write(data)
+        if self.upstream:
+            self.learner.response(self.id, data)
+            self.log("OU", data, self)
+        else:
+            self.learner.query(self.id, data)
+            self.log("IN", data, self)
+
+    def pause_writing(self):  # the peer sends faster than this side can take it
+        self.peer.transport.pause_reading()
+
+    def resume_writing(self):
+        self.peer.transport.resume_reading()
+
+    def connection_lost(self, exc):
+        if self.peer and self.peer.transport:
+            self.peer.transport.close()
+        if not self.upstream:
+            self.learner.closed(self.id)
+            self.log("--", "Client #{} disconnected".format(self.id))
+
+
+class LearningProxy:
+    """ listens for clients and connects every one of them to upstream host:port """
+
+    nextId = 1
+
+    def __init__(self, learner, upstream, log=None):
+        self.learner = learner
+        self.upstream = upstream
+        self.log = log or (lambda direction, data, conn=None: None)
+        self.server = None
+
+    async def start(self, host, port):
+        loop = asyncio.get_running_loop()
+        self.server = await loop.create_server(self.clientSide, host, port)
+        self.log("--", "Learning proxy on port {} for {}:{}".format(port, *self.upstream))
+
+    def clientSide(self):
+        connid = LearningProxy.nextId
+        LearningProxy.nextId += 1
+        return ProxySide(self.learner, connid, self.log, onConnect=self.connectUpstream)
+
+    async def connectUpstream(self, client):
+        """ opens the upstream side of a client and starts reading the client """
+
+        loop = asyncio.get_running_loop()
+        self.learner.opened(client.id)
+        try:
+            transport, upstream = await loop.create_connection(
+                lambda: ProxySide(self.learner, client.id, self.log, peer=client), *self.upstream
+            )
+        except OSError as e:
+            self.log("ER", "Upstream {}:{} not reachable: {}".format(*self.upstream, e))
+            client.transport.close()
+            return
+        client.peer = upstream
+        self.log("--", "Client #{} connected".format(client.id))
+        if client.transport.is_closing():
+            transport.close()
+        else:
+            client.transport.resume_reading()
+
+    def stop(self):
+        if self.server:
+            self.server.close()
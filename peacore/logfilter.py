@@ -0,0 +1,243 @@
+"""
+    Incremental filters over a LogStore.
+
+    A LogFilter remembers which records it has already tested, so new
+    lines only cost one test each and matches can be shown as they arrive.
+    AND and OR words are substrings of the terminal line, except that a
+    word starting with = names a direction (=IN, =OU, =--, =ER, =FB) or a
+    connection (=#3) and selects that field through a LogIndex instead of
+    formatting and searching every line. Only these fields are indexed,
+    other words are tested line by line, which a GUI can spread over
+    several calls with update(limit). A FilterCache keeps the last few
+    filters and narrows a refined AND filter from the previous matches.
+"""
+
+import re, array, bisect, collections
+
+from .logstore import DIRECTIONS, TEXT_FLAG
+from .template import to_bytes
+
+FILTER_MODES = ("AND", "OR", "Regex", "Bytes")
+CACHED_FILTERS = 4
+CONNECTION_WORD = re.compile(r"#(\d+)$")
+FIELD_PREFIX = "="
+
+
+def field_key(word):
+    """ returns the index key of a filter word like =IN or =#3 naming a direction or connection, else None """
+
+    if not word.startswith(FIELD_PREFIX):
+        return None
+    word = word[len(FIELD_PREFIX):]
+    if word in DIRECTIONS:
+        return ("dir", DIRECTIONS.index(word))
+    match = CONNECTION_WORD.match(word)
+    if match:
+        return ("conn", int(match.group(1)))
+    return None
+
+
+class LogIndex:
+    """ posting lists of record indexes per direction and per connection, kept up to date incrementally """
+
+    def __init__(self, store):
+        self.store = store
+        self.postings = {}
+        self.indexed = store.base
+
+    def update(self):
+        store = self.store
+        start = max(self.indexed, store.base)
+        for index in range(start, store.end):
+            pos = index - store.base
+            self.add(("dir", store.codes[pos] & ~TEXT_FLAG), index)
+            if store.connids[pos] >= 0:
+                self.add(("conn", store.connids[pos]), index)
+        self.indexed = store.end
+        if self.postings and store.base > 0:
+            self.prune(store.base)
+
+    def add(self, key, index):
+        postings = self.postings.get(key)
+        if postings is None:
+            postings = self.postings[key] = array.array("Q")
+        postings.append(index)
+
+    def prune(self, base):
+        """ drops the indexes of trimmed records once they are a quarter of a list """
+
+        for key, postings in list(self.postings.items()):
+            cut = bisect.bisect_left(postings, base)
+            if cut == len(postings):
+                del self.postings[key]
+            elif cut > len(postings) // 4:
+                del postings[:cut]
+
+    def lookup(self, key, start, stop):
+        """ returns the indexes of key from start to stop """
+
+        postings = self.postings.get(key, ())
+        return postings[bisect.bisect_left(postings, start):bisect.bisect_left(postings, stop)]
+
+
+class LogFilter:
+    """
+    One filter setup. mode is one of FILTER_MODES, words are the non-empty
+    filter entries: substrings of the terminal line or =fields for AND and OR, regular
+    expressions that must all match the line for Regex, escaped byte
+    strings that must all be in the data for Bytes.
+    """
+
+    def __init__(self, store, index, mode="AND", words=()):
+        if mode not in FILTER_MODES:
+            raise ValueError("Unknown filter mode: {}".format(mode))
+        self.store = store
+        self.index = index
+        self.mode = mode
+        self.words = tuple(word for word in words if word)
+        self.matches = array.array("Q")
+        self.scanned = store.base
+
+        self.fields = []
+        self.substrings = []
+        if mode == "Regex":
+            try:
+                self.patterns = [re.compile(word) for word in self.words]
+            except re.error as e:
+                raise ValueError("Invalid regular expression: {}".format(e))
+        elif mode == "Bytes":
+            self.patterns = [to_bytes(word) for word in self.words]
+        else:
+            for word in self.words:
+                key = field_key(word)
+                if key:
+                    self.fields.append(key)
+                else:
+                    self.substrings.append(word)
+
+    @property
+    def key(self):
+        return (self.mode, self.words)
+
+    def __len__(self):
+        return len(self.matches)
+
+    def test(self, index, line=None):
+        """ True if record index passes the filter, line is its formatted text if already known """
+
+        store = self.store
+        if not self.words:
+            return True
+        if self.mode == "Bytes":
+            data = store.data(index)
+            if isinstance(data, str):
+                data = data.encode("utf-8", "surrogateescape")
+            return all(pattern in data for pattern in self.patterns)
+
+        if self.mode == "Regex":
+            if line is None:
+                line = store.line(index)
+            return all(pattern.search(line) for pattern in self.patterns)
+
+        pos = index - store.base
+        results = [self.fieldMatches(key, pos) for key in self.fields]
+        if self.substrings:  # fields alone never format the line
+            if line is None:
+                line = store.line(index)
+            results += [word in line for word in self.substrings]
+        if self.mode == "OR":
+            return any(results)
+        return all(results)
+
+    def fieldMatches(self, key, pos):
+        store = self.store
+        if key[0] == "dir":
+            return store.codes[pos] & ~TEXT_FLAG == key[1]
+        return store.connids[pos] == key[1]
+
+    def candidates(self, start, stop):
+        """ returns the record indexes from start to stop that can match, narrowed by the index when possible """
+
+        if self.fields and (self.mode == "AND" or not self.substrings):
+            self.index.update()
+            lists = [set(self.index.lookup(key, start, stop)) for key in self.fields]
+            if self.mode == "AND":
+                return sorted(set.intersection(*lists))
+            return sorted(set.union(*lists))
+        return range(start, stop)
+
+    @property
+    def pending(self):
+        """ True while records are left that the filter has not tested """
+
+        return self.scanned < self.store.end
+
+    def update(self, limit=None):
+        """ tests the records added since the last call, at most limit of them, returns the new matches """
+
+        store = self.store
+        start = max(self.scanned, store.base)
+        stop = store.end if limit is None else min(store.end, start + limit)
+        new = [index for index in self.candidates(start, stop) if self.test(index)]
+        self.matches.extend(new)
+        self.scanned = stop
+        if self.matches and self.matches[0] < store.base:
+            del self.matches[:bisect.bisect_left(self.matches, store.base)]
+        return new
+
+    def narrows(self, other):
+        """ True if every record matching self also matches other, so self can refine other's matches """
+
+        if self.mode != "AND" or other.mode not in ("AND", "OR"):
+            return False
+        if other.mode == "OR" and len(other.words) > 1:
+            return False
+        for word in other.words:
+            if field_key(word):
+                if word not in self.words:
+                    return False
+            elif not any(word in own for own in self.words if not field_key(own)):
+                return False
+        return True
+
+    def refine(self, other):
+        """ takes the matches of a broader filter and keeps those that pass this one """
+
+        base = self.store.base
+        self.matches = array.array("Q", (index for index in other.matches if index >= base and self.test(index)))
+        self.scanned = other.scanned
+
+
+class FilterCache:
+    """ the last few filters of a store, so switching between them or refining one does not rescan everything """
+
+    def __init__(self, store):
+        self.store = store
+        self.index = LogIndex(store)
+        self.filters = collections.OrderedDict()
+        self.current = None
+
+    def select(self, mode, words, limit=None):
+        """
+        returns the filter for mode and words, up to date or with limit more
+        records tested, raises ValueError for a bad filter
+        """
+
+        logfilter = LogFilter(self.store, self.index, mode, words)
+        cached = self.filters.pop(logfilter.key, None)
+        if cached:
+            logfilter = cached
+        elif self.current and logfilter.narrows(self.current):
+            logfilter.refine(self.current)
+
+        self.filters[logfilter.key] = logfilter
+        while len(self.filters) > CACHED_FILTERS:
+            self.filters.popitem(last=False)
+        self.current = logfilter
+        logfilter.update(limit)
+        return logfilter
+
+    def clear(self):
+        self.index = LogIndex(self.store)
+        self.filters.clear()
+        self.current = None
@@ -0,0 +1,28 @@
+"""
+    Formatting of terminal and log file lines, shared by the GUI and the
+    headless mode so both print the same thing.
+"""
+
+import datetime
+
+INFO_DIRECTIONS = ("--", "ER")
+
+
+def format_line(direction, data, conn=None, bytecount=False, now=None):
+    """ returns one log line like 'IN | 12:00:00.000 | #1 | b'data'' with a newline """
+
+    return format_entry(direction, data, None if conn is None else conn.id, bytecount, now)
+
+
+def format_entry(direction, data, connid=None, bytecount=False, now=None):
+    """ format_line for a connection id instead of a connection, now may also be the clock text already formatted """
+
+    if now is None:
+        now = datetime.datetime.now()
+    msgnow = now if isinstance(now, str) else now.strftime("%H:%M:%S.%f")[:-3]
+    if connid is not None:
+        msgnow = "{} | #{}".format(msgnow, connid)
+
+    if bytecount and direction not in INFO_DIRECTIONS:
+        return "{} | {} | {} | {}\n".format(direction, msgnow, data, len(data))
+    return "{} | {} | {}\n".format(direction, msgnow, data)
@@ -0,0 +1,150 @@
+"""
+    Compact in-memory traffic log. Every record is a monotonic timestamp,
+    a direction code, a connection id and the offset and length of its
+    data in one shared bytearray, so a long session costs a few dozen
+    bytes per message instead of a formatted string. Lines are only
+    formatted when they are shown or exported.
+"""
+
+import time, array, datetime
+
+from .logfmt import format_entry
+
+DIRECTIONS = ("IN", "OU", "--", "ER", "FB")
+DIRECTION_CODES = {direction: code for code, direction in enumerate(DIRECTIONS)}
+TEXT_FLAG = 0x80  # set on the direction code when the data was a str, stored utf-8
+DEFAULT_MAXRECORDS = 200000
+
+
+class LogStore:
+    """
+    Bounded, append-only record store. Records are addressed by an
+    absolute index that stays valid while the oldest records are trimmed:
+    valid indexes are base <= index < end.
+    """
+
+    def __init__(self, maxrecords=DEFAULT_MAXRECORDS):
+        self.maxrecords = maxrecords
+        self.base = 0
+        self.times = array.array("d")
+        self.codes = array.array("B")
+        self.connids = array.array("l")  # -1 for lines without a connection
+        self.offsets = array.array("Q")  # into arena, relative to arenabase
+        self.lengths = array.array("L")
+        self.arena = bytearray()
+        self.arenabase = 0
+        self.epoch = (time.monotonic(), time.time())  # converts the monotonic timestamps to wall clock
+        self.clocksecond = (None, "")  # last formatted second, lines mostly share it
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def end(self):
+        return self.base + len(self.codes)
+
+    def append(self, direction, data, connid=None, timestamp=None):
+        """ stores one log line, returns its index """
+
+        code = DIRECTION_CODES.get(direction, DIRECTION_CODES["--"])
+        if isinstance(data, str):
+            data = data.encode("utf-8", "surrogateescape")
+            code |= TEXT_FLAG
+        elif not isinstance(data, (bytes, bytearray, memoryview)):
+            data = str(data).encode("utf-8")
+            code |= TEXT_FLAG
+
+        self.times.append(time.monotonic() if timestamp is None else timestamp)
+        self.codes.append(code)
+        self.connids.append(-1 if connid is None else connid)
+        self.offsets.append(self.arenabase + len(self.arena))
+        self.lengths.append(len(data))
+        self.arena += data
+
+        if len(self.codes) > self.maxrecords + self.maxrecords // 4:  # trim in bulk, not per record
+            self.trim(len(self.codes) - self.maxrecords)
+        return self.end - 1
+
+    def trim(self, count):
+        """ drops the count oldest records and their data """
+
+        count = min(count, len(self.codes))
+        if not count:
+            return
+        if count < len(self.codes):
+            keep = self.offsets[count] - self.arenabase
+        else:
+            keep = len(self.arena)
+        del self.times[:count]
+        del self.codes[:count]
+        del self.connids[:count]
+        del self.offsets[:count]
+        del self.lengths[:count]
+        del self.arena[:keep]
+        self.arenabase += keep
+        self.base += count
+
+    def clear(self):
+        self.trim(len(self.codes))
+
+    def resize(self, maxrecords):
+        self.maxrecords = maxrecords
+        if len(self.codes) > maxrecords:
+            self.trim(len(self.codes) - maxrecords)
+
+    def direction(self, index):
+        return DIRECTIONS[self.codes[index - self.base] & ~TEXT_FLAG]
+
+    def connid(self, index):
+        connid = self.connids[index - self.base]
+        return None if connid < 0 else connid
+
+    def data(self, index):
+        """ returns the data of a record as it was logged, bytes or str """
+
+        pos = index - self.base
+        start = self.offsets[pos] - self.arenabase
+        data = bytes(self.arena[start:start + self.lengths[pos]])
+        if self.codes[pos] & TEXT_FLAG:
+            return data.decode("utf-8", "surrogateescape")
+        return data
+
+    def datetime(self, index):
+        """ wall clock time of a record """
+
+        mono, wall = self.epoch
+        return datetime.datetime.fromtimestamp(wall + self.times[index - self.base] - mono)
+
+    def clock(self, index):
+        """ wall clock time of a record as HH:MM:SS.mmm """
+
+        mono, wall = self.epoch
+        stamp = wall + self.times[index - self.base] - mono
+        second = int(stamp)
+        if second != self.clocksecond[0]:
+            self.clocksecond = (second, time.strftime("%H:%M:%S", time.localtime(second)))
+        return "{}.{:03d}".format(self.clocksecond[1], int((stamp - second) * 1000))
+
+    def record(self, index):
+        """ returns (timestamp, direction, connid, data) """
+
+        return (self.times[index - self.base], self.direction(index), self.connid(index), self.data(index))
+
+    def line(self, index, bytecount=False):
+        """ formats one record like the terminal shows it """
+
+        return format_entry(self.direction(index), self.data(index), self.connid(index), bytecount, self.clock(index))
+
+    def lines(self, start=None, stop=None, bytecount=False):
+        """ yields the formatted records from start to stop """
+
+        start = self.base if start is None else max(start, self.base)
+        stop = self.end if stop is None else min(stop, self.end)
+        for index in range(start, stop):
+            yield self.line(index, bytecount)
+
+    def memoryUsage(self):
+        """ approximate bytes held by the records """
+
+        arrays = (self.times, self.codes, self.connids, self.offsets, self.lengths)
+        return sum(len(values) * values.itemsize for values in arrays) + len(self.arena)
@@ -0,0 +1,97 @@
+"""
+    Hosting of several emulated devices in one process and on one event
+    loop, described by a manifest file:
+
+        [
+            {"Name": "display", "Template": "lg_98uh5e_1_0_0_0.json", "Port": 9761},
+            {"Name": "matrix", "Template": "extr_foxma_1_0_0_0.json", "Port": 5001, "Log": "matrix.log"}
+        ]
+
+    Template and Log paths are relative to the manifest. Port defaults to
+    the port of the template, Host to 0.0.0.0 and LogMode to false.
+"""
+
+import os, json
+
+from .template import Template
+from .device import Device
+
+
+def load_manifest(fname):
+    """ reads a manifest and returns its entries with absolute paths """
+
+    with open(fname) as data_file:
+        entries = json.load(data_file)
+    if not isinstance(entries, list) or not entries:
+        raise ValueError("Manifest {} lists no devices".format(fname))
+
+    base = os.path.dirname(os.path.abspath(fname))
+    for entry in entries:
+        if "Template" not in entry:
+            raise ValueError("Manifest entry without Template: {}".format(entry))
+        entry["Template"] = os.path.join(base, entry["Template"])
+        if entry.get("Log"):
+            entry["Log"] = os.path.join(base, entry["Log"])
+    return entries
+
+
+class DeviceManager:
+    """
+    Owns a number of devices, each with its own template, command index,
+    script module instance, server and listeners, and starts and stops
+    them together.
+    """
+
+    def __init__(self):
+        self.devices = []
+
+    def __iter__(self):
+        return iter(self.devices)
+
+    def __len__(self):
+        return len(self.devices)
+
+    def add(self, template, name=None, port=None, host="0.0.0.0", logmode=False):
+        """ creates a device for a loaded template, it is started with the others """
+
+        device = Device(template, name or str(template))
+        device.port = int(port or template.port)
+        device.host = host
+        device.logmode = logmode
+        self.devices.append(device)
+        return device
+
+    def addManifestEntry(self, entry):
+        """ loads the template of one manifest entry and adds its device """
+
+        template = Template.load(entry["Template"])
+        return self.add(
+            template,
+            name=entry.get("Name"),
+            port=entry.get("Port"),
+            host=entry.get("Host", "0.0.0.0"),
+            logmode=bool(entry.get("LogMode", False)),
+        )
+
+    def loadScripts(self):
+        """ imports the scripts of all devices that use one, returns False if one failed """
+
+        ok = True
+        for device in self.devices:
+            if device.template.script and not device.loadScript():
+                ok = False
+        return ok
+
+    async def start(self, reuse_port=False):
+        """ opens the ports of all devices, closing the opened ones again if one fails """
+
+        try:
+            for device in self.devices:
+                await device.start(device.host, device.port, reuse_port)
+        except Exception:
+            self.stop()
+            raise
+
+    def stop(self):
+        for device in self.devices:
+            device.stop()
@@ -0,0 +1,194 @@
+"""
+    Metrics of the emulated devices and the local HTTP endpoint serving
+    them in the Prometheus text format (/metrics) and as JSON
+    (/metrics.json).
+
+    Everything is counted on the event loop thread with plain integer
+    additions, no locks: per command request counts, misses, script calls,
+    errors and run time, and histograms of the time from receiving a
+    frame to writing its response, per device and per connection.
+"""
+
+import json, bisect, asyncio, collections
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram:
+    """ fixed bucket histogram in seconds, the last count is for values above all buckets """
+
+    __slots__ = ("counts", "sum")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.sum += seconds
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def cumulative(self):
+        """ returns (upper bound, count of values up to it) pairs ending with +Inf """
+
+        total = 0
+        pairs = []
+        for bound, count in zip(LATENCY_BUCKETS + (float("inf"),), self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+    def snapshot(self):
+        return {"buckets": LATENCY_BUCKETS, "counts": list(self.counts), "sum": round(self.sum, 6), "count": self.count}
+
+
+class DeviceMetrics:
+    """ counters of one device, commands are counted by their index in the template """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.commands = collections.defaultdict(int)  # command index -> requests
+        self.misses = 0
+        self.scriptCalls = 0
+        self.scriptErrors = 0
+        self.scriptSeconds = 0.0
+        self.customCalls = 0
+        self.customSeconds = 0.0
+        self.slowCalls = 0  # script calls over the budget of the device
+        self.latency = Histogram()
+
+    def snapshot(self, device):
+        """ returns all metrics of device as a dict """
+
+        template = device.template
+        commands = []
+        if template:
+            for command in template.commands:
+                commands.append({
+                    "index": command.index, "description": command.description,
+                    "requests": self.commands.get(command.index, 0),
+                })
+        counters = device.counters()
+        counters.update({
+            "name": str(device), "port": device.port, "commands": commands, "misses": self.misses,
+            "scriptCalls": self.scriptCalls, "scriptErrors": self.scriptErrors,
+            "scriptSeconds": round(self.scriptSeconds, 6), "customCalls": self.customCalls,
+            "customSeconds": round(self.customSeconds, 6), "slowCalls": self.slowCalls, "latency": self.latency.snapshot(),
+            "connections": {conn.id: conn.latency.snapshot() for conn in device.connections.values()},
+        })
+        return counters
+
+
+def label(value):
+    """ escapes a Prometheus label value """
+
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def prometheus_text(devices):
+    """ formats the metrics of all devices in the Prometheus text exposition format """
+
+    families = {}  # name -> (type, help, lines)
+
+    def add(name, kind, helptext, labels, value):
+        family = families.setdefault(name, (kind, helptext, []))
+        labeltext = ",".join('{}="{}"'.format(key, label(val)) for key, val in labels)
+        family[2].append("{}{{{}}} {}".format(name, labeltext, value))
+
+    def add_histogram(name, helptext, labels, histogram):
+        family = families.setdefault(name, ("histogram", helptext, []))
+        labeltext = ",".join('{}="{}"'.format(key, label(val)) for key, val in labels)
+        for bound, count in histogram.cumulative():
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            family[2].append('{}_bucket{{{},le="{}"}} {}'.format(name, labeltext, le, count))
+        family[2].append("{}_sum{{{}}} {}".format(name, labeltext, histogram.sum))
+        family[2].append("{}_count{{{}}} {}".format(name, labeltext, histogram.count))
+
+    for device in devices:
+        metrics = device.metrics
+        labels = [("device", device), ("port", device.port)]
+        if device.template:
+            for command in device.template.commands:
+                add("pea_requests_total", "counter", "Frames answered by a template command",
+                    labels + [("command", command.description), ("index", command.index)],
+                    metrics.commands.get(command.index, 0))
+        add("pea_misses_total", "counter", "Frames neither the template nor the script answered", labels, metrics.misses)
+        add("pea_script_calls_total", "counter", "Frames handed to the device script", labels, metrics.scriptCalls)
+        add("pea_script_errors_total", "counter", "Exceptions raised by the device script", labels, metrics.scriptErrors)
+        add("pea_script_seconds_total", "counter", "Time spent in the device script", labels, metrics.scriptSeconds)
+        add("pea_custom_calls_total", "counter", "Custom functions of the script run", labels, metrics.customCalls)
+        add("pea_custom_seconds_total", "counter", "Time spent in custom functions", labels, metrics.customSeconds)
+        add("pea_script_slow_calls_total", "counter", "Script calls over the time budget", labels, metrics.slowCalls)
+        add("pea_rx_messages_total", "counter", "Frames received", labels, device.rxcount)
+        add("pea_rx_bytes_total", "counter", "Bytes received in frames", labels, device.rxbytes)
+        add("pea_tx_messages_total", "counter", "Writes to clients", labels, device.txcount)
+        add("pea_tx_bytes_total", "counter", "Bytes written to clients", labels, device.txbytes)
+        add("pea_clients_total", "counter", "Clients that connected", labels, device.clients)
+        add("pea_connected_clients", "gauge", "Clients connected now", labels, len(device.connections))
+        add_histogram("pea_response_latency_seconds", "Time from receiving a frame to writing its response",
+                      labels, metrics.latency)
+        for conn in device.connections.values():
+            add_histogram("pea_connection_latency_seconds", "Response latency of each connected client",
+                          labels + [("conn", conn.id)], conn.latency)
+
+    lines = []
+    for name, (kind, helptext, samples) in families.items():
+        lines.append("# HELP {} {}".format(name, helptext))
+        lines.append("# TYPE {} {}".format(name, kind))
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """
+    Minimal HTTP server on the event loop for the metrics of devices.
+    routes maps a path to a function returning (content type, body text),
+    more routes can be added before or after start().
+    """
+
+    def __init__(self, devices):
+        self.devices = devices
+        self.server = None
+        self.routes = {
+            "/metrics": lambda query: ("text/plain; version=0.0.4", prometheus_text(self.devices)),
+            "/metrics.json": lambda query: ("application/json", json.dumps(
+                [device.metrics.snapshot(device) for device in self.devices], indent=1
+            )),
+        }
+
+    async def start(self, host, port):
+        self.server = await asyncio.start_server(self.handle, host, port)
+
+    def stop(self):
+        if self.server:
+            self.server.close()
+            self.server = None
+
+    async def handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+                pass  # headers are not needed
+            parts = request.decode("latin-1").split()
+            path, _, query = (parts[1] if len(parts) > 1 else "/").partition("?")
+            route = self.routes.get(path)
+            if parts and parts[0] != "GET":
+                status, ctype, body = "405 Method Not Allowed", "text/plain", "GET only\n"
+            elif route is None:
+                status, ctype, body = "404 Not Found", "text/plain", "Try {}\n".format(", ".join(sorted(self.routes)))
+            else:
+                status = "200 OK"
+                ctype, body = route(query)
+            data = body.encode("utf-8")
+            writer.write("HTTP/1.0 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: close\r\n\r\n".format(
+                status, ctype, len(data)).encode("latin-1") + data)
+            await writer.drain()
+        except (asyncio.TimeoutError, OSError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,255 @@
+"""
+    Micro-benchmarks of the hot paths, run with python -m pea microbench.
+
+    Every case times one operation in nanoseconds, best of several runs,
+    without a network in between: clients are fed through the protocol
+    with a transport that drops what is written. Results can be saved as
+    a baseline and later runs flag every case that got slower than the
+    baseline by more than the threshold.
+"""
+
+import os, io, json, sys, timeit, asyncio, platform, contextlib
+
+from .template import Template, to_bytes
+from .device import Device, SocketServer
+from .scriptapi import ScriptRegistry
+from .framing import Framer, compile_framing
+from .logfmt import format_line
+from .logstore import LogStore
+from .logfilter import FilterCache
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "templates")
+DEFAULT_BASELINE = os.path.join("benchmarks", "microbench-baseline.json")
+DEFAULT_THRESHOLD = 0.25  # 25% slower than the baseline is a regression
+LARGE_LOG = 200000
+
+CASES = []
+
+
+def case(name, description):
+    """ registers a benchmark: a setup function returning the callable to time """
+
+    def register(setup):
+        CASES.append((name, description, setup))
+        return setup
+    return register
+
+
+class NullTransport:
+    """ transport that drops all writes, for feeding clients without sockets """
+
+    def get_extra_info(self, name, default=None):
+        return ("127.0.0.1", 40000) if name == "peername" else default
+
+    def write(self, data):
+        pass
+
+    def is_closing(self):
+        return False
+
+    def close(self):
+        pass
+
+
+def client(templatefile, logmode=False):
+    """ returns a connected protocol of a device serving templatefile without delay """
+
+    template = Template.load(os.path.join(TEMPLATE_DIR, templatefile))
+    template.delay = 0.0
+    device = Device(template)
+    device.logmode = logmode
+    if template.script:
+        device.loadScript(quiet=True)
+    protocol = SocketServer(device)
+    protocol.connection_made(NullTransport())
+    return protocol
+
+
+@case("match_exact", "data_received of a template query, answered from the query index")
+def bench_match_exact():
+    protocol = client("extr_iplt_1_0_0_0.json")
+    return lambda: protocol.data_received(b"Q")
+
+
+@case("match_miss", "data_received of an unknown query, answered with the error reply")
+def bench_match_miss():
+    protocol = client("extr_iplt_1_0_0_0.json")
+    return lambda: protocol.data_received(b"unknown\r")
+
+
+@case("match_pattern", "matching the last of 60 prefix, regex and mask queries with the combined matcher")
+def bench_match_pattern():
+    commands = []
+    for index in range(20):
+        commands.append({"Description": "", "Type": "prefix", "Query": "P{}*".format(index), "Response": ""})
+        commands.append({"Description": "", "Type": "mask", "Query": "\\x02M{:02d}\\x03".format(index), "Mask": "ffffff00ff", "Response": ""})
+        commands.append({"Description": "", "Type": "regex", "Query": "VOL{}=([0-9]+)\\r".format(index), "Response": ""})
+    template = Template([
+        {"Manufacturer": "PEA"}, {"Model": "Patterns"}, {"Category": "Bench"}, {"Version": "1_0_0_0"},
+        {"Port": 0}, {"Delay": 0}, {"Script": False}, commands,
+    ])
+    return lambda: template.match(b"VOL19=42\r")
+
+
+@case("format_response", "data_received of a regex query answered with a response format, no script")
+def bench_format_response():
+    template = Template([
+        {"Manufacturer": "PEA"}, {"Model": "Formats"}, {"Category": "Bench"}, {"Version": "1_0_0_0"},
+        {"Port": 0}, {"Delay": 0}, {"Script": False}, [{
+            "Description": "Tie", "Type": "regex", "Format": True,
+            "Query": "(?P<input>[0-9]+)\\*(?P<output>[0-9]+)!", "Response": "Out{output} In{input} All\\n\\r",
+        }],
+    ])
+    protocol = SocketServer(Device(template))
+    protocol.connection_made(NullTransport())
+    return lambda: protocol.data_received(b"3*7!")
+
+
+@case("state_actions", "data_received of a guarded regex query setting a state variable and reading it back")
+def bench_state_actions():
+    protocol = client("template_with_state.json")
+    protocol.data_received(b"PWR ON\r")
+    return lambda: protocol.data_received(b"VOL 50\r")
+
+
+@case("script_response", "data_received answered by the FOX matrix script, with the str to bytes conversion")
+def bench_script_response():
+    protocol = client("extr_foxma_1_0_0_0.json")
+    return lambda: protocol.data_received(b"3*7!")
+
+
+@case("script_bytes", "data_received answered by a PEA_API 2 script returning a list of buffers")
+def bench_script_bytes_response():
+    protocol = client("template_with_script.json")
+    return lambda: protocol.data_received(b"\x81\x8a\x8b\x01")
+
+
+@case("foxma_rxscript", "pea.on regex dispatch of the FOX matrix script alone")
+def bench_foxma_rxscript():
+    protocol = client("extr_foxma_1_0_0_0.json")
+    rxscript, conn = protocol.device.rxscript, protocol.conn
+    return lambda: rxscript(conn, b"w0*1*1vc\r")
+
+
+@case("script_dispatch", "pea.on dispatch between 300 handlers to the last one registered")
+def bench_script_dispatch():
+    pea = ScriptRegistry()
+    for number in range(300):
+        pea.on(rb"CMD%03d (\d+)\r" % number)(lambda conn, match: match.group(1))
+    dispatch = pea.bind(None)
+    return lambda: dispatch(None, b"CMD299 42\r")
+
+
+@case("to_bytes", "unicode_escape/latin-1 conversion of a template response")
+def bench_to_bytes():
+    text = "Vgp00 Out00*01 02 03 04 05 06 07 08 09 10 11 12 13 14 15 16Vid\\r\\n"
+    return lambda: to_bytes(text)
+
+
+@case("framer_delimiter", "delimiter framing of a read holding four frames")
+def bench_framer_delimiter():
+    loop = asyncio.get_running_loop()
+    framer = Framer(compile_framing({"Mode": "delimiter", "Delimiter": "\\r"}), loop, lambda frame: None)
+    data = b"1*1!\r2*2!\r3*3!\r4*4!\r"
+    return lambda: framer.feed(data)
+
+
+@case("format_line", "formatting of one terminal line")
+def bench_format_line():
+    protocol = client("extr_iplt_1_0_0_0.json")
+    conn = protocol.conn
+    return lambda: format_line("IN", b"w0*1*1vc\r", conn, True)
+
+
+@case("logstore_append", "appending one record to the GUI log store")
+def bench_logstore_append():
+    store = LogStore()
+    return lambda: store.append("IN", b"w0*1*1vc\r", 3)
+
+
+def large_log():
+    store = LogStore(LARGE_LOG)
+    for index in range(LARGE_LOG):
+        store.append("IN" if index % 2 else "OU", b"PWR%d\r" % (index % 10), index % 7)
+    return store
+
+
+@case("filter_substring", "substring filter over a 200000 line log, from scratch")
+def bench_filter_substring():
+    store = large_log()
+
+    def refresh():
+        FilterCache(store).select("AND", ["PWR3"])
+    return refresh
+
+
+@case("filter_indexed", "direction and connection filter over a 200000 line log, from scratch")
+def bench_filter_indexed():
+    store = large_log()
+
+    def refresh():
+        FilterCache(store).select("AND", ["=IN", "=#3"])
+    return refresh
+
+
+@case("filter_live", "live filter update for one new line")
+def bench_filter_live():
+    store = LogStore()
+    logfilter = FilterCache(store).select("AND", ["PWR3"])
+
+    def update():
+        store.append("IN", b"PWR3\r", 1)
+        logfilter.update()
+    return update
+
+
+async def run_cases(names=None, repeat=5):
+    """ times the cases, returns {name: nanoseconds per operation} """
+
+    results = {}
+    for name, description, setup in CASES:
+        if names and name not in names:
+            continue
+        with contextlib.redirect_stdout(io.StringIO()):  # scripts print while they run
+            timer = timeit.Timer(setup())
+            number, _ = timer.autorange()
+            best = min(timer.repeat(repeat, number))
+        results[name] = round(best / number * 1e9, 1)
+    return results
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """ returns the table of results against the baseline and the names of the regressed cases """
+
+    regressions = []
+    lines = ["{:<18} | {:>14} | {:>14} | {:>8}".format("case", "ns/op", "baseline", "change")]
+    for name, value in results.items():
+        base = baseline.get(name)
+        if base:
+            change = value / base - 1
+            flag = ""
+            if change > threshold:
+                regressions.append(name)
+                flag = " REGRESSION"
+            lines.append("{:<18} | {:>14,.1f} | {:>14,.1f} | {:>+7.1%}{}".format(name, value, base, change, flag))
+        else:
+            lines.append("{:<18} | {:>14,.1f} | {:>14} | {:>8}".format(name, value, "-", "-"))
+    return "\n".join(lines) + "\n", regressions
+
+
+def load_baseline(fname):
+    if not os.path.exists(fname):
+        return {}
+    with open(fname) as infile:
+        return json.load(infile).get("results", {})
+
+
+def save_baseline(fname, results):
+    if os.path.dirname(fname):
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+    data = {
+        "python": sys.version.split()[0], "platform": platform.platform(), "machine": platform.machine(),
+        "results": results,
+    }
+    with open(fname, "w") as outfile:
+        json.dump(data, outfile, indent=4)
@@ -0,0 +1,149 @@
+"""
+    On-demand profiling of the event loop thread, switched on and off
+    while the emulators run.
+
+    cprofile mode runs cProfile on the loop thread and writes the stats
+    (.pstats, for snakeviz or pstats) with a report sorted by cumulative
+    and own time (.txt). sample mode looks at the stack of the loop thread
+    every interval from a background thread, which costs the loop next to
+    nothing, and writes folded stacks (.folded, one "frame;frame;frame
+    count" line per stack for flamegraph.pl or speedscope) with a report
+    of the functions seen most (.txt).
+"""
+
+import io, os, sys, time, pstats, cProfile, threading, collections
+
+PROFILE_MODES = ("cprofile", "sample")
+SAMPLE_INTERVAL = 0.002  # seconds between stack samples
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return "{}:{}".format(os.path.basename(code.co_filename), code.co_name)
+
+
+class Profiler:
+    """ profiles the thread that calls start() until stop(), which writes the reports to directory """
+
+    def __init__(self, directory="profiles", name="pea", interval=SAMPLE_INTERVAL):
+        self.directory = directory
+        self.name = name
+        self.interval = interval
+        self.mode = None
+        self.started = 0.0
+        self.profile = None
+        self.sampler = None
+        self.stopping = threading.Event()
+        self.stacks = collections.Counter()  # folded stack -> samples
+
+    @property
+    def running(self):
+        return self.mode is not None
+
+    def start(self, mode="cprofile"):
+        """ starts profiling the calling thread, the event loop thread """
+
+        if mode not in PROFILE_MODES:
+            raise ValueError("Unknown profile mode {}, use {}".format(mode, " or ".join(PROFILE_MODES)))
+        if self.mode:
+            raise ValueError("The {} profiler is running already".format(self.mode))
+        if mode == "cprofile":
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        else:
+            self.stacks.clear()
+            self.stopping.clear()
+            self.sampler = threading.Thread(
+                target=self.sample, args=(threading.get_ident(),), name="pea-sampler", daemon=True
+            )
+            self.sampler.start()
+        self.mode = mode
+        self.started = time.monotonic()
+
+    def sample(self, ident):
+        """ sampler thread, counts the stacks of thread ident """
+
+        while not self.stopping.wait(self.interval):
+            frame = sys._current_frames().get(ident)
+            if frame is None:
+                return
+            names = []
+            while frame is not None:
+                names.append(frame_name(frame))
+                frame = frame.f_back
+            self.stacks[";".join(reversed(names))] += 1
+
+    def stop(self):
+        """ stops profiling and writes the reports, returns their file names """
+
+        if not self.mode:
+            raise ValueError("The profiler is not running")
+        seconds = time.monotonic() - self.started
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory, "{}-{}-{}".format(self.name, self.mode, time.strftime("%Y%m%d-%H%M%S")))
+        if self.mode == "cprofile":
+            self.profile.disable()
+            files = self.writeStats(base, seconds)
+            self.profile = None
+        else:
+            self.stopping.set()
+            self.sampler.join()
+            self.sampler = None
+            files = self.writeSamples(base, seconds)
+        self.mode = None
+        return files
+
+    def writeStats(self, base, seconds):
+        self.profile.dump_stats(base + ".pstats")
+        report = io.StringIO()
+        report.write("cProfile of the event loop over {:.1f}s\n\n".format(seconds))
+        stats = pstats.Stats(self.profile, stream=report).strip_dirs()
+        stats.sort_stats("cumulative").print_stats(40)
+        stats.sort_stats("tottime").print_stats(40)
+        with open(base + ".txt", "w") as outfile:
+            outfile.write(report.getvalue())
+        return [base + ".pstats", base + ".txt"]
+
+    def writeSamples(self, base, seconds):
+        with open(base + ".folded", "w") as outfile:
+            for stack, count in self.stacks.most_common():
+                outfile.write("{} {}\n".format(stack, count))
+
+        total = sum(self.stacks.values())
+        own = collections.Counter()
+        inclusive = collections.Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")
+            own[frames[-1]] += count
+            for name in set(frames):
+                inclusive[name] += count
+
+        lines = ["{} samples of the event loop every {:.1f} ms over {:.1f}s".format(total, self.interval * 1000, seconds)]
+        for title, counter in (("own samples", own), ("samples including callees", inclusive)):
+            lines.append("")
+            lines.append("{:>8} {:>7}  {}".format("samples", "%", title))
+            for name, count in counter.most_common(40):
+                lines.append("{:>8} {:>6.1%}  {}".format(count, count / total if total else 0, name))
+        with open(base + ".txt", "w") as outfile:
+            outfile.write("\n".join(lines) + "\n")
+        return [base + ".folded", base + ".txt"]
+
+    def routes(self):
+        """ control routes for MetricsServer: /profile/start?mode=sample and /profile/stop """
+
+        def start(query):
+            mode = query.partition("mode=")[2].partition("&")[0] or "cprofile"
+            try:
+                self.start(mode)
+            except ValueError as e:
+                return "text/plain", "{}\n".format(e)
+            return "text/plain", "Profiling with {}\n".format(mode)
+
+        def stop(query):
+            try:
+                files = self.stop()
+            except ValueError as e:
+                return "text/plain", "{}\n".format(e)
+            return "text/plain", "".join(fname + "\n" for fname in files)
+
+        return {"/profile/start": start, "/profile/stop": stop}
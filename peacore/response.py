@@ -0,0 +1,122 @@
+"""
+    Response formats: template responses that fill in parts of the query
+    and state of the connection, compiled once when the template loads.
+
+    A command with "Format": true has str.format fields in its response:
+
+        {level} {1}         named or numbered group of a regex query
+        {count}             requests of this command so far, this one included
+        {conn.id}           the connection: id, host, port, rxcount, txcount,
+                            anything else is a variable of the connection
+        {device.clients}    the device: rxcount, txcount, clients, connections, port
+        {state.volume}      a state variable, {state.video[2]} or {state.video[output]}
+                            an element of an array by number or query group
+
+    Format specs work as with str.format, a spec for numbers like {level:03d}
+    converts the value to an int first. Literal braces are doubled.
+"""
+
+import re, string
+
+NUMBER_SPECS = "bcdoxXn"
+CONN_FIELDS = {
+    "id": lambda conn: conn.id,
+    "host": lambda conn: conn.peer[0],
+    "port": lambda conn: conn.peer[1],
+    "rxcount": lambda conn: conn.rxcount,
+    "txcount": lambda conn: conn.txcount,
+}
+DEVICE_FIELDS = {
+    "rxcount": lambda device: device.rxcount,
+    "txcount": lambda device: device.txcount,
+    "clients": lambda device: device.clients,
+    "connections": lambda device: len(device.connections),
+    "port": lambda device: device.port,
+}
+
+
+def group_getter(name, group):
+    index = group(name)
+    if index is None:
+        raise ValueError("Response field {{{}}} is no group of the query".format(name))
+    return lambda found, conn, device, command: (found.group(index) or b"").decode("latin-1")
+
+
+def field_getter(name, group, state=None):
+    """
+    returns the function (match, conn, device, command) -> value of a field,
+    group maps group names to indices, state is the StateModel of the template
+    """
+
+    if name.startswith("state."):
+        if state is None:
+            raise ValueError("Response field {{{}}} needs a State in the template".format(name))
+        reference = re.fullmatch(r"state\.(\w+)(?:\[(\w+)\])?", name)
+        if reference is None:
+            raise ValueError("Bad state field {{{}}}".format(name))
+        variable, index = reference.groups()
+        if index is not None:
+            if index.isdigit() and group(index) is None:  # a constant element
+                index = int(index)
+                index = (lambda value: lambda found, conn, device, command: value)(index)
+            else:
+                index = group_getter(index, group)
+        return state.getter(variable, index)
+    if name == "count":
+        return lambda found, conn, device, command: device.metrics.commands[command.index]
+    if name.startswith("conn."):
+        key = name[5:]
+        field = CONN_FIELDS.get(key)
+        if field:
+            return lambda found, conn, device, command: field(conn)
+        return lambda found, conn, device, command: conn.state.get(key, "")
+    if name.startswith("device."):
+        field = DEVICE_FIELDS.get(name[7:])
+        if field is None:
+            raise ValueError("Unknown response field {{{}}}".format(name))
+        return lambda found, conn, device, command: field(device)
+    return group_getter(name, group)
+
+
+def as_number(getter):
+    def number(found, conn, device, command):
+        value = getter(found, conn, device, command)
+        return int(value) if isinstance(value, str) else value
+    return number
+
+
+class ResponseFormat:
+    """
+    A compiled response: the text with positional str.format fields and a
+    getter per field, calling it returns the bytes of one answer, format()
+    the text.
+    """
+
+    __slots__ = ("text", "getters")
+
+    def __init__(self, response, group=lambda name: None, state=None):
+        if isinstance(response, bytes):
+            response = response.decode("latin-1")
+        parts = []
+        getters = []
+        for literal, name, spec, conversion in string.Formatter().parse(response):
+            parts.append(literal.replace("{", "{{").replace("}", "}}"))
+            if name is None:
+                continue
+            if not name:
+                raise ValueError("Response fields need a name, {} is not allowed")
+            getter = field_getter(name, group, state)
+            if spec and spec[-1] in NUMBER_SPECS:
+                getter = as_number(getter)
+            parts.append("{{{}{}{}}}".format(
+                len(getters), "!" + conversion if conversion else "", ":" + spec if spec else ""
+            ))
+            getters.append(getter)
+        self.text = "".join(parts)
+        self.getters = tuple(getters)
+
+    def format(self, found, conn, device, command):
+        return self.text.format(*[getter(found, conn, device, command) for getter in self.getters])
+
+    def __call__(self, found, conn, device, command):
+        return self.text.format(*[getter(found, conn, device, command) for getter in self.getters]).encode("latin-1")
@@ -0,0 +1,134 @@
+"""
+    The interface between PEA and the device scripts, chosen by the script
+    with a module global PEA_API.
+
+    1, the default: rxscript(conn, rx) gets the received bytes and returns
+    a str, customFunc(func) returns a str too. The str is converted to
+    bytes by parsing its \\x escapes, so a reply can't contain a plain
+    backslash.
+
+    2: rxscript(conn, rx) gets a memoryview of the received frame (re
+    and bytes methods work on it, bytes(rx) copies it) and returns bytes,
+    a bytearray, a memoryview or a list of them, which are written as
+    they are, a list with writelines. customFunc returns the same. A
+    returned buffer must not be changed afterwards, responses can wait
+    in the scheduler.
+
+    Both get a pea object to register handlers instead of writing an
+    rxscript that tries one regex after the other:
+
+        @pea.on(rb"(\d+)\*(\d+)(&|\$|!)")
+        def tie(conn, match):
+            return ...
+
+    All patterns of a device are searched in one pass, see ScriptRegistry.
+"""
+
+import re
+
+from .template import global_flags, scope_groups
+
+SCOPED_FLAGS = (
+    (re.ASCII, b"a"), (re.LOCALE, b"L"), (re.IGNORECASE, b"i"), (re.MULTILINE, b"m"), (re.DOTALL, b"s"), (re.VERBOSE, b"x"),
+)
+
+LEGACY_API = 1
+BYTES_API = 2
+SCRIPT_APIS = (LEGACY_API, BYTES_API)
+
+
+def script_api(script):
+    """ returns the PEA_API version a loaded script module asks for """
+
+    api = getattr(script, "PEA_API", LEGACY_API)
+    if api not in SCRIPT_APIS:
+        raise ValueError("PEA_API {} is not supported, use 1 or 2".format(api))
+    return api
+
+
+def legacy_reply(text):
+    """ the bytes of a str reply of an API 1 script, same escapes as the template """
+
+    return text.encode("latin-1").decode("unicode_escape").encode("latin-1")
+
+
+def reply_data(reply):
+    """ checks the reply of an API 2 script: buffers are written as they are, a list of them with writelines """
+
+    if isinstance(reply, (bytes, bytearray, memoryview)):
+        return reply
+    if isinstance(reply, (list, tuple)):
+        return list(reply)
+    raise TypeError("a PEA_API 2 script returns bytes or a list of buffers, not {}".format(type(reply).__name__))
+
+
+class ScriptRegistry:
+    """
+    The pea object of a script. @pea.on(pattern) registers a handler that
+    is called as handler(conn, match) for received data the pattern finds
+    and returns the reply like rxscript does.
+
+    compile() joins all patterns into one alternation, each followed by an
+    empty group named after its handler. One search finds the earliest
+    match of any pattern, the first registered one if several match
+    there, and its lastgroup names the handler. The handler gets the
+    match of its own pattern, matched again at that position, so its
+    groups are numbered as it wrote them. Leading flags like (?i) and
+    numbered backreferences are scoped to their pattern by scope_groups.
+    Data no handler matches goes to the rxscript of the script, if any.
+    """
+
+    def __init__(self):
+        self.handlers = []  # (compiled pattern, handler) in the order registered
+        self.targets = {}  # group name -> (compiled pattern, handler)
+        self.matcher = None
+        self.fallback = None
+
+    def on(self, pattern, flags=0):
+        """ decorator registering a handler for a bytes regex, str patterns are taken as latin-1 """
+
+        if isinstance(pattern, str):
+            pattern = pattern.encode("latin-1")
+        try:
+            compiled = re.compile(pattern, flags)
+        except re.error as e:
+            raise ValueError("Bad handler pattern {!r}: {}".format(pattern, e))
+
+        def register(handler):
+            self.handlers.append((compiled, handler))
+            self.matcher = None
+            return handler
+        return register
+
+    def compile(self):
+        parts = []
+        self.targets = {}
+        for index, (compiled, handler) in enumerate(self.handlers):
+            name = "h{}".format(index)
+            # leading (?i) and the like are in compiled.flags, which go into the scoped group below
+            pattern = scope_groups(name, global_flags(compiled.pattern)[1])
+            scoped = b"".join(letter for flag, letter in SCOPED_FLAGS if compiled.flags & flag)
+            # an empty group after the pattern names the handler, in front of it it would hide
+            # the first byte of the pattern from the quick check re does on every alternative
+            parts.append(b"(?%s:%s)(?P<%s>)" % (scoped, pattern, name.encode()))
+            self.targets[name] = (compiled, handler)
+        try:
+            self.matcher = re.compile(b"|".join(parts)).search
+        except re.error as e:
+            raise ValueError("Handler patterns can't be combined: {}".format(e))
+
+    def bind(self, script):
+        """ returns the function answering received data for the script: the dispatch or its rxscript """
+
+        self.fallback = getattr(script, "rxscript", None)
+        if not self.handlers:
+            return self.fallback
+        self.compile()
+        return self.dispatch
+
+    def dispatch(self, conn, rx):
+        found = self.matcher(rx)
+        if found is None:
+            return self.fallback(conn, rx) if self.fallback else None
+        compiled, handler = self.targets[found.lastgroup]
+        return handler(conn, compiled.match(rx, found.start()))
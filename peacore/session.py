@@ -0,0 +1,298 @@
+"""
+    Session recording and replay.
+
+    A session file holds the raw byte stream of every client connection
+    with its timing:
+
+        MAGIC, then records of struct RECORD (time, connection, kind, length)
+        followed by length bytes of data
+
+    time is in seconds since the start of the recording. An OPEN record
+    carries the port the client connected to, IN and OU records the bytes
+    read from and written to the client, CLOSE has no data.
+
+    A recorded session can be replayed as a client against a PEA device or
+    the real device, comparing the answers with the recorded ones, or as a
+    server that answers with the recorded responses in order.
+"""
+
+import time, struct, asyncio, threading, collections
+
+from .device import ResponseScheduler
+
+MAGIC = b"PEASESS1"
+RECORD = struct.Struct("<dIBI")
+IN, OU, OPEN, CLOSE = range(4)
+KINDS = {"IN": IN, "OU": OU}
+FLUSH_INTERVAL = 0.5
+
+
+class SessionRecorder:
+    """
+    Records the clients of one or more devices to a session file. The taps
+    only queue the data, a background thread writes it like CaptureWriter.
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.file = open(fname, "wb")
+        self.file.write(MAGIC)
+        self.start = time.monotonic()
+        self.events = collections.deque()
+        self.open = {}  # connection id -> connection
+        self.running = True
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="pea-recorder", daemon=True)
+        self.thread.start()
+
+    def attach(self, device):
+        device.taps.append(self.tap)
+        device.watchers.append(self.watch)
+
+    def detach(self, device):
+        device.taps.remove(self.tap)
+        device.watchers.remove(self.watch)
+
+    def tap(self, direction, data, conn):
+        now = time.monotonic() - self.start
+        if conn.id not in self.open:
+            self.open[conn.id] = conn
+            self.events.append((now, conn.id, OPEN, str(conn.device.port).encode()))
+        self.events.append((now, conn.id, KINDS[direction], bytes(data)))
+
+    def watch(self, device):
+        """ device watcher, records the clients of device that disconnected """
+
+        now = time.monotonic() - self.start
+        for connid, conn in list(self.open.items()):
+            if conn.device is device and connid not in device.connections:
+                del self.open[connid]
+                self.events.append((now, connid, CLOSE, b""))
+
+    def run(self):
+        while self.running:
+            self.wakeup.wait(FLUSH_INTERVAL)
+            self.wakeup.clear()
+            self.writeQueued()
+        self.writeQueued()
+        self.file.close()
+
+    def writeQueued(self):
+        chunks = []
+        popleft = self.events.popleft
+        try:
+            while True:
+                stamp, connid, kind, data = popleft()
+                chunks.append(RECORD.pack(stamp, connid, kind, len(data)))
+                chunks.append(data)
+        except IndexError:
+            pass
+        if chunks:
+            try:
+                self.file.write(b"".join(chunks))
+                self.file.flush()
+            except OSError as e:
+                print("Session recording error:", e)
+
+    def close(self):
+        self.running = False
+        self.wakeup.set()
+        self.thread.join()
+
+
+def read_session(fname):
+    """ yields the (time, connection id, kind, data) records of a session file """
+
+    with open(fname, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("Not a PEA session file: {}".format(fname))
+        while True:
+            header = f.read(RECORD.size)
+            if not header:
+                return
+            if len(header) < RECORD.size:
+                raise ValueError("Truncated session file: {}".format(fname))
+            stamp, connid, kind, length = RECORD.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                raise ValueError("Truncated session file: {}".format(fname))
+            yield stamp, connid, kind, data
+
+
+class SessionConnection:
+    """ the recorded traffic of one client: port, open time and (time, kind, data) events """
+
+    def __init__(self, connid, port, opened):
+        self.id = connid
+        self.port = port
+        self.opened = opened
+        self.events = []
+
+    def expected(self):
+        """ all bytes the device sent to this client """
+
+        return b"".join(data for stamp, kind, data in self.events if kind == OU)
+
+
+def load_session(fname):
+    """ returns the recorded connections of a session file in the order they opened """
+
+    connections = collections.OrderedDict()
+    for stamp, connid, kind, data in read_session(fname):
+        if kind == OPEN:
+            connections[connid] = SessionConnection(connid, int(data or 0), stamp)
+        elif kind in (IN, OU) and connid in connections:
+            connections[connid].events.append((stamp, kind, data))
+    return list(connections.values())
+
+
+def mismatch(expected, received):
+    """ returns the offset of the first differing byte, None if received equals expected """
+
+    for offset, (want, got) in enumerate(zip(expected, received)):
+        if want != got:
+            return offset
+    if len(expected) != len(received):
+        return min(len(expected), len(received))
+    return None
+
+
+async def replay_client(connections, host, port=None, speed=1.0, timeout=2.0):
+    """
+    Replays the recorded client traffic against host. speed 0 sends as fast
+    as possible: every request goes out as soon as the responses recorded
+    before it arrived, so devices without framing still see one request at
+    a time. Returns one result dict per connection.
+    """
+
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    first = min((conn.opened for conn in connections), default=0.0)
+
+    async def wait_until(stamp):
+        if speed:
+            delay = start + (stamp - first) / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    async def replay_connection(conn):
+        await wait_until(conn.opened)
+        result = {"conn": conn.id, "sent": 0, "sentbytes": 0, "expected": len(conn.expected()), "received": 0}
+        try:
+            reader, writer = await asyncio.open_connection(host, port or conn.port)
+        except OSError as e:
+            result["error"] = str(e)
+            return result
+
+        expected = conn.expected()
+        received = bytearray()
+        arrived = asyncio.Event()
+
+        async def read_all():
+            while len(received) < len(expected):
+                chunk = await reader.read(65536)
+                if not chunk:
+                    return
+                received.extend(chunk)
+                arrived.set()
+
+        async def wait_for_bytes(count):
+            deadline = loop.time() + timeout
+            while len(received) < count and not reading.done() and loop.time() < deadline:
+                arrived.clear()
+                try:
+                    await asyncio.wait_for(arrived.wait(), deadline - loop.time())
+                except asyncio.TimeoutError:
+                    return
+
+        reading = asyncio.ensure_future(read_all())
+        answered = 0  # recorded response bytes before the current event
+        for stamp, kind, data in conn.events:
+            if kind == OU:
+                answered += len(data)
+            else:
+                if speed:
+                    await wait_until(stamp)
+                else:
+                    await wait_for_bytes(answered)
+                writer.write(data)
+                await writer.drain()
+                result["sent"] += 1
+                result["sentbytes"] += len(data)
+        try:
+            await asyncio.wait_for(reading, timeout)
+        except asyncio.TimeoutError:
+            pass
+        writer.close()
+
+        result["received"] = len(received)
+        result["mismatch"] = mismatch(expected, bytes(received))
+        return result
+
+    return await asyncio.gather(*(replay_connection(conn) for conn in connections))
+
+
+class ReplayServer(asyncio.Protocol):
+    """
+    Answers like the recorded device: every accepted client plays the next
+    recorded connection, the responses that followed a recorded request
+    are sent once the same number of bytes arrived, with the recorded delay.
+    """
+
+    def __init__(self, connections, speed=1.0, log=None):
+        self.connections = connections
+        self.speed = speed
+        self.log = log or (lambda direction, data, conn=None: None)
+        self.conn = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.scheduler = ResponseScheduler(asyncio.get_running_loop(), self.send)
+        self.received = bytearray()
+        self.consumed = 0
+        self.position = 0
+        if not self.connections:
+            self.log("ER", "No recorded connection left to replay")
+            transport.close()
+            return
+        self.conn = self.connections.pop(0)
+        self.log("--", "Replaying recorded connection #{}".format(self.conn.id))
+        self.answer(self.conn.opened)
+
+    def data_received(self, data):
+        if self.conn is None:
+            return
+        self.log("IN", data)
+        self.received.extend(data)
+        events = self.conn.events
+        while self.position < len(events) and events[self.position][1] == IN:
+            stamp, kind, request = events[self.position]
+            if len(self.received) - self.consumed < len(request):
+                return
+            got = bytes(self.received[self.consumed:self.consumed + len(request)])
+            if got != request:
+                self.log("ER", "Expected {} but got {}".format(request, got))
+            self.consumed += len(request)
+            self.position += 1
+            self.answer(stamp)
+        if self.position >= len(events):
+            self.log("--", "Recorded connection #{} fully replayed".format(self.conn.id))
+
+    def answer(self, since):
+        """ schedules the recorded responses up to the next request, delays relative to since """
+
+        events = self.conn.events
+        while self.position < len(events) and events[self.position][1] == OU:
+            stamp, kind, data = events[self.position]
+            delay = (stamp - since) / self.speed if self.speed else 0
+            self.scheduler.schedule(data, delay)
+            self.position += 1
+
+    def send(self, data):
+        if not self.transport.is_closing():
+            self.log("OU", data)
+            self.transport.write(data)
+
+    def connection_lost(self, exc):
+        if self.conn is not None:
+            self.scheduler.cancel()
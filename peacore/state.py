@@ -0,0 +1,257 @@
+"""
+    Declarative device state: typed variables in the template and the
+    guards and actions of the commands that read and change them.
+
+        {"State": {"Scope": "device", "Variables": {
+            "power": {"Type": "bool"},
+            "volume": {"Type": "int", "Default": 20, "Min": 0, "Max": 100},
+            "input": {"Type": "str", "Default": "HDMI1"},
+            "video": {"Type": "int", "Size": 32, "Base": 1}
+        }}}
+
+    Scope device shares the variables between all clients of a device,
+    connection gives every client its own. Types are bool, int, float and
+    str, a Size makes an array indexed from Base (0 by default).
+
+    Commands change the state with "Actions", in order:
+
+        {"Set": "volume", "Value": "{level}"}
+        {"Set": "video", "Index": "{output}", "Value": "{input}"}
+        {"Toggle": "power"}
+        {"Increment": "volume", "By": -1}
+
+    and only answer while their "Guard" holds, a condition or a list of
+    them: {"Var": "power", "Equals": true}, "NotEquals", "Min" or "Max".
+    Otherwise the command answers its "Otherwise" response if it has one,
+    or the frame is a miss. Strings with braces are response formats of
+    the query groups, responses read the variables with {state.volume} or
+    {state.video[2]}.
+
+    The variables of a scope are one list, a slot per variable; arrays
+    are array.array slots except for str arrays.
+"""
+
+import array
+
+ARRAY_TYPECODES = {"bool": "B", "int": "q", "float": "d"}
+STATE_SCOPES = ("device", "connection")
+
+
+def to_bool(value):
+    """ bool of a JSON value or query text: true, on, yes and numbers other than 0 are True """
+
+    if isinstance(value, str):
+        text = value.strip().lower()
+        if text.isdigit():
+            return int(text) != 0
+        return text in ("true", "on", "yes")
+    return bool(value)
+
+
+STATE_TYPES = {"bool": to_bool, "int": int, "float": float, "str": str}
+
+
+class Variable:
+    """ one declared variable and its slot in the value list """
+
+    __slots__ = ("name", "slot", "kind", "convert", "default", "size", "base", "minimum", "maximum")
+
+    def __init__(self, name, slot, spec):
+        self.name = name
+        self.slot = slot
+        self.kind = spec.get("Type", "int")
+        if self.kind not in STATE_TYPES:
+            raise ValueError("Unknown type {} of state variable {}".format(self.kind, name))
+        self.convert = STATE_TYPES[self.kind]
+        self.default = self.convert(spec.get("Default", "" if self.kind == "str" else 0))
+        self.size = int(spec.get("Size", 0))
+        self.base = int(spec.get("Base", 0))
+        self.minimum = spec.get("Min")
+        self.maximum = spec.get("Max")
+
+    def initial(self):
+        if not self.size:
+            return self.default
+        if self.kind == "str":
+            return [self.default] * self.size
+        return array.array(ARRAY_TYPECODES[self.kind], [self.default] * self.size)
+
+    def position(self, index):
+        """ the position of element index in the array, a ValueError outside of it """
+
+        position = int(index) - self.base
+        if not 0 <= position < self.size:
+            raise ValueError("Index {} of {} is not within {}..{}".format(
+                index, self.name, self.base, self.base + self.size - 1
+            ))
+        return position
+
+    def clamp(self, value):
+        """ converts value to the type of the variable and keeps it within Min and Max """
+
+        value = self.convert(value)
+        if self.minimum is not None and value < self.minimum:
+            value = self.convert(self.minimum)
+        if self.maximum is not None and value > self.maximum:
+            value = self.convert(self.maximum)
+        return value
+
+
+def constant_or_format(value, format_value):
+    """ returns a function (found, conn, device, command) -> value, strings with braces are formats """
+
+    if isinstance(value, str) and "{" in value:
+        return format_value(value)
+    return lambda found, conn, device, command: value
+
+
+class StateModel:
+    """
+    The compiled "State" entry of a template. new() returns the value list
+    of one scope, values(conn, device) the list a request works on.
+    """
+
+    def __init__(self, spec):
+        self.scope = spec.get("Scope", "device")
+        if self.scope not in STATE_SCOPES:
+            raise ValueError("State Scope must be device or connection, not {}".format(self.scope))
+        self.variables = {}
+        for slot, (name, variable) in enumerate(spec.get("Variables", {}).items()):
+            self.variables[name] = Variable(name, slot, variable)
+        if self.scope == "device":
+            self.values = lambda conn, device: device.variables
+        else:
+            self.values = lambda conn, device: conn.variables
+
+    def new(self):
+        return [variable.initial() for variable in self.variables.values()]
+
+    def variable(self, name):
+        variable = self.variables.get(name)
+        if variable is None:
+            raise ValueError("Unknown state variable {}".format(name))
+        return variable
+
+    def getter(self, reference, index=None):
+        """
+        returns the function (found, conn, device, command) -> value of
+        variable reference, index is the function of an array index
+        """
+
+        variable = self.variable(reference)
+        slot = variable.slot
+        values = self.values
+        if not variable.size:
+            return lambda found, conn, device, command: values(conn, device)[slot]
+        if index is None:
+            raise ValueError("State variable {} is an array and needs an index".format(reference))
+        typed = str if variable.kind == "str" else variable.convert  # bool arrays hold 0 and 1
+        position = variable.position
+
+        def element(found, conn, device, command):
+            return typed(values(conn, device)[slot][position(index(found, conn, device, command))])
+        return element
+
+    def compileCommand(self, cmd, format_value):
+        """ returns the CommandActions of a template command, None without Guard and Actions """
+
+        guards = cmd.get("Guard", [])
+        if isinstance(guards, dict):
+            guards = [guards]
+        if not guards and not cmd.get("Actions"):
+            return None
+        return CommandActions(
+            [self.compileGuard(guard, format_value) for guard in guards],
+            [self.compileAction(action, format_value) for action in cmd.get("Actions", [])],
+        )
+
+    def indexGetter(self, spec, format_value):
+        if "Index" not in spec:
+            return None
+        return constant_or_format(spec["Index"], format_value)
+
+    def compileGuard(self, guard, format_value):
+        name = guard.get("Var")
+        if name is None:
+            raise ValueError("A Guard needs the Var it tests")
+        variable = self.variable(name)
+        get = self.getter(name, self.indexGetter(guard, format_value))
+        tests = []
+        for key, test in (
+            ("Equals", lambda value, limit: value == limit), ("NotEquals", lambda value, limit: value != limit),
+            ("Min", lambda value, limit: value >= limit), ("Max", lambda value, limit: value <= limit),
+        ):
+            if key in guard:
+                limit = variable.convert(guard[key])
+                tests.append((test, limit))
+        if not tests:
+            raise ValueError("Guard of {} needs Equals, NotEquals, Min or Max".format(name))
+
+        def holds(found, conn, device, command):
+            value = get(found, conn, device, command)
+            return all(test(value, limit) for test, limit in tests)
+        return holds
+
+    def compileAction(self, action, format_value):
+        for key in ("Set", "Toggle", "Increment"):
+            if key in action:
+                break
+        else:
+            raise ValueError("Unknown action {}, use Set, Toggle or Increment".format(action))
+        variable = self.variable(action[key])
+        slot = variable.slot
+        values = self.values
+        index = self.indexGetter(action, format_value)
+        if variable.size and index is None:
+            raise ValueError("State variable {} is an array and needs an Index".format(variable.name))
+        if not variable.size and index is not None:
+            raise ValueError("State variable {} is no array".format(variable.name))
+
+        if key == "Set":
+            if "Value" not in action:
+                raise ValueError("Set of {} needs a Value".format(variable.name))
+            value = constant_or_format(action["Value"], format_value)
+            change = lambda current, found, conn, device, command: value(found, conn, device, command)
+        elif key == "Toggle":
+            if variable.kind != "bool":
+                raise ValueError("Toggle needs a bool variable, {} is {}".format(variable.name, variable.kind))
+            change = lambda current, found, conn, device, command: not current
+        else:
+            if variable.kind not in ("int", "float"):
+                raise ValueError("Increment needs a number variable, {} is {}".format(variable.name, variable.kind))
+            step = variable.convert(action.get("By", 1))
+            change = lambda current, found, conn, device, command: current + step
+
+        if index is None:
+            def run(found, conn, device, command):
+                slots = values(conn, device)
+                slots[slot] = variable.clamp(change(slots[slot], found, conn, device, command))
+        else:
+            def run(found, conn, device, command):
+                items = values(conn, device)[slot]
+                position = variable.position(index(found, conn, device, command))
+                items[position] = variable.clamp(change(items[position], found, conn, device, command))
+        return run
+
+
+class CommandActions:
+    """
+    Guards and actions of one command. Calling it checks the guards and
+    runs the actions if they hold, returning whether they did. otherwise
+    is the Command answering when a guard fails, None for a miss.
+    """
+
+    __slots__ = ("guards", "actions", "otherwise")
+
+    def __init__(self, guards, actions, otherwise=None):
+        self.guards = tuple(guards)
+        self.actions = tuple(actions)
+        self.otherwise = otherwise
+
+    def __call__(self, found, conn, device, command):
+        for guard in self.guards:
+            if not guard(found, conn, device, command):
+                return False
+        for action in self.actions:
+            action(found, conn, device, command)
+        return True
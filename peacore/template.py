@@ -0,0 +1,349 @@
+"""
+    Loading and compiling of the emulator JSON templates.
+
+    A template is a list of single key dicts followed by the commands:
+
+        [{"Manufacturer": ..}, {"Model": ..}, {"Category": ..},
+         {"Version": ..}, {"Port": ..}, {"Delay": ..}, {"Script": ..},
+         [{"Description": .., "Query": .., "Response": ..}, ..],
+         optional entries such as {"Framing": {..}}]
+
+    A command may declare how its query matches a received frame with
+    "Type": exact (the default), prefix (the frame starts with the query),
+    regex (the frame fully matches the query as a Python regex over bytes)
+    or mask (a "Mask" of hex bytes, where each set bit of the query has to
+    match and 00 matches any byte). With "Format": true the response is
+    a ResponseFormat filled in with the groups of the query and the state
+    of the connection. An optional "State" entry declares variables the
+    commands change with "Actions" and test with a "Guard" (see state.py).
+"""
+
+import os, re, json, collections
+
+from .framing import compile_framing
+from .response import ResponseFormat
+from .state import StateModel
+
+QUERY_TYPES = ("exact", "prefix", "regex", "mask")
+
+# one prepared template command, response bytes ready to be written
+Command = collections.namedtuple(
+    "Command", "index description query response kind render actions", defaults=("exact", None, None)
+)
+
+
+def to_bytes(text):
+    """ converts a template string with \\x escapes to the bytes it describes """
+
+    return text.encode("latin-1").decode("unicode_escape").encode("latin-1")
+
+
+def from_bytes(data):
+    """ converts bytes to a template string, the inverse of to_bytes, control bytes become \\x escapes """
+
+    text = []
+    for char in data.decode("latin-1"):
+        if char == "\\":
+            text.append("\\\\")
+        elif char in "\r\n\t" or " " <= char < "\x7f":
+            text.append(char)
+        else:
+            text.append("\\x{:02x}".format(ord(char)))
+    return "".join(text)
+
+
+def query_pattern(kind, query, mask=None):
+    """ returns the regex over bytes matching a whole frame for a prefix, regex or mask query """
+
+    if kind == "prefix":
+        return re.escape(query) + b".*"
+    if kind == "regex":
+        return query
+    if mask is None:
+        raise ValueError("Query type mask needs a Mask")
+    mask = bytes.fromhex(mask)
+    if len(mask) != len(query):
+        raise ValueError("Mask {} does not have the length of its query".format(mask.hex()))
+    parts = []
+    for byte, bits in zip(query, mask):
+        if bits == 0xff:
+            parts.append(re.escape(bytes([byte])))
+        elif bits == 0:
+            parts.append(b".")
+        else:
+            parts.append(b"[" + b"".join(b"\\x%02x" % value for value in range(256) if value & bits == byte & bits) + b"]")
+    return b"".join(parts)
+
+
+def global_flags(pattern):
+    """ splits the leading global flags like (?i) off a pattern, returns their letters and the rest """
+
+    flags = re.match(rb"(?:\(\?[aiLmsux]+\))+", pattern)
+    if flags is None:
+        return b"", pattern
+    return re.sub(rb"[()?]", b"", flags.group()), pattern[flags.end():]
+
+
+def scope_groups(name, pattern):
+    """
+    returns a pattern that can be one alternative of several: its named groups
+    are prefixed with name, numbered backreferences and conditionals refer to
+    the groups by name and leading global flags like (?i) become a scoped group
+    """
+
+    flags, pattern = global_flags(pattern)
+    if flags:
+        pattern = b"(?%s:%s)" % (flags, pattern)
+    prefix = name.encode()
+    parts = []
+    groups = [None]  # group number -> (index of its opening in parts, name or None)
+    position = 0
+    in_class = False
+
+    def reference(number):
+        if number >= len(groups):
+            raise ValueError("Backreference {} refers to no group before it".format(number))
+        opening, group = groups[number]
+        if group is None:
+            group = b"%s_%d" % (prefix, number)
+            parts[opening] = b"(?P<%s>" % group
+            groups[number] = (opening, group)
+        return group
+
+    while position < len(pattern):
+        char = pattern[position:position + 1]
+        if char == b"\\":
+            digits = re.match(rb"[0-9]{1,3}", pattern[position + 1:position + 4])
+            if in_class or not digits or digits.group()[0:1] == b"0" or re.fullmatch(rb"[0-7]{3}", digits.group()):
+                parts.append(pattern[position:position + 2])  # an escape or octal, not a group
+                position += 2
+                continue
+            number = digits.group()[:2]
+            parts.append(b"(?P=%s)" % reference(int(number)))
+            position += 1 + len(number)
+            continue
+        if in_class:
+            if char == b"]":
+                in_class = False
+            parts.append(char)
+            position += 1
+            continue
+        if char == b"[":
+            start = re.match(rb"\[\^?\]?", pattern[position:]).group()  # a ] right after [ is literal
+            parts.append(start)
+            position += len(start)
+            in_class = True
+            continue
+        if char == b"(":
+            named = re.match(rb"\(\?P<(\w+)>", pattern[position:])
+            if named:
+                group = b"%s_%s" % (prefix, named.group(1))
+                groups.append((len(parts), group))
+                parts.append(b"(?P<%s>" % group)
+                position += named.end()
+                continue
+            backreference = re.match(rb"\(\?P=(\w+)\)", pattern[position:])
+            if backreference:
+                parts.append(b"(?P=%s_%s)" % (prefix, backreference.group(1)))
+                position += backreference.end()
+                continue
+            condition = re.match(rb"\(\?\((\w+)\)", pattern[position:])
+            if condition:
+                group = condition.group(1)
+                group = reference(int(group)) if group.isdigit() else b"%s_%s" % (prefix, group)
+                parts.append(b"(?(%s)" % group)
+                position += condition.end()
+                continue
+            if pattern[position + 1:position + 2] == b"?":
+                parts.append(b"(?")
+                position += 2
+                continue
+            groups.append((len(parts), None))
+        parts.append(char)
+        position += 1
+    return b"".join(parts)
+
+
+def template_option(data, key, default=None):
+    """ returns an optional {key: value} entry of a template, these follow the fixed entries """
+
+    for entry in data[8:]:
+        if isinstance(entry, dict) and key in entry:
+            return entry[key]
+    return default
+
+
+class Template:
+    """
+    A loaded emulator JSON file compiled for serving.
+
+    queryIndex maps query bytes to the prepared Command, responseIndex maps
+    response bytes back to the commands sending it for diagnostics.
+    All other query types are compiled into one alternation, each query
+    followed by an empty group named after its command: matcher(frame)
+    matches it in one pass and the lastgroup of the match names the
+    command in patternCommands. Exact queries are looked up first, so
+    they win over every pattern. The
+    render of a command is its ResponseFormat or None, its actions the
+    CommandActions of the StateModel in state, if the template has one.
+    """
+
+    def __init__(self, data, fname=None):
+        self.data = data
+        self.fname = fname
+        self.path = os.path.dirname(os.path.abspath(fname)) if fname else None
+        self.scriptName = os.path.basename(fname)[:-5] if fname else None
+
+        self.manufacturer = data[0]["Manufacturer"]
+        self.model = data[1]["Model"]
+        self.category = data[2]["Category"]
+        self.version = data[3]["Version"]
+        self.port = int(data[4]["Port"])
+        self.delay = float(data[5]["Delay"])
+        self.script = bool(data[6]["Script"])
+        self.scriptCode = None
+        self.compile()
+
+    @classmethod
+    def load(cls, fname):
+        """ reads and compiles a template file """
+
+        with open(fname) as data_file:
+            data = json.load(data_file)
+        if not data:
+            raise ValueError("Empty template {}".format(fname))
+        return cls(data, fname)
+
+    def __str__(self):
+        return "{} - {}".format(self.manufacturer, self.model)
+
+    def compile(self):
+        """ converts all queries and responses to bytes and builds the lookup tables """
+
+        entries = []
+        patterns = {}  # command index -> pattern of a prefix, regex or mask query
+
+        for idx, cmd in enumerate(self.data[7]):
+            kind = cmd.get("Type", "exact").lower()
+            if kind not in QUERY_TYPES:
+                raise ValueError("Unknown query type {} of command {}".format(cmd["Type"], idx))
+            # regex queries keep their backslashes for re, the other types use the template escapes
+            query = cmd["Query"].encode("latin-1") if kind == "regex" else to_bytes(cmd["Query"])
+            entries.append((idx, cmd, kind, query))
+            if kind != "exact":
+                try:
+                    pattern = query_pattern(kind, query, cmd.get("Mask"))
+                    re.compile(pattern)
+                    patterns[idx] = scope_groups("c{}".format(idx), pattern)
+                except re.error as e:
+                    raise ValueError("Command {}: Bad query pattern: {}".format(idx, e))
+                except ValueError as e:
+                    raise ValueError("Command {}: {}".format(idx, e))
+        try:
+            combined = re.compile(
+                b"|".join(b"(?:%s)(?P<c%d>)" % (pattern, idx) for idx, pattern in patterns.items()), re.DOTALL
+            ) if patterns else None
+        except re.error as e:
+            raise ValueError("Bad query pattern: {}".format(e))
+
+        spec = template_option(self.data, "State")
+        state = StateModel(spec) if spec else None
+        commands = []
+        queryIndex = {}
+        responseIndex = {}
+        patternCommands = {}
+        for idx, cmd, kind, query in entries:
+            try:
+                group = self.groupResolver(combined, idx, patterns.get(idx))
+                format_value = lambda text: ResponseFormat(text, group, state).format
+                command = Command(
+                    idx, cmd["Description"], query, to_bytes(cmd["Response"]), kind,
+                    self.compileResponse(cmd, cmd["Response"], group, state), None,
+                )
+                if state:
+                    actions = state.compileCommand(cmd, format_value)
+                    if actions and "Otherwise" in cmd:
+                        actions.otherwise = command._replace(
+                            response=to_bytes(cmd["Otherwise"]),
+                            render=self.compileResponse(cmd, cmd["Otherwise"], group, state),
+                        )
+                    command = command._replace(actions=actions)
+                elif "Actions" in cmd or "Guard" in cmd:
+                    raise ValueError("Actions and Guard need a State entry in the template")
+            except ValueError as e:
+                raise ValueError("Command {}: {}".format(idx, e))
+            commands.append(command)
+            if kind == "exact":
+                queryIndex.setdefault(command.query, command)  # first entry wins like the old linear scan
+            else:
+                patternCommands["c{}".format(idx)] = command  # earlier alternatives win like the exact entries
+            responseIndex.setdefault(command.response, []).append(command)
+
+        self.commands = commands
+        self.queryIndex = queryIndex
+        self.responseIndex = responseIndex
+        self.patternCommands = patternCommands
+        self.matcher = combined.fullmatch if combined else None
+        self.state = state
+        self.framing = compile_framing(template_option(self.data, "Framing"))
+
+    @staticmethod
+    def compileResponse(cmd, response, group, state):
+        """ returns the ResponseFormat of a response of cmd, None unless the command has Format """
+
+        if cmd.get("Format"):
+            return ResponseFormat(to_bytes(response), group, state)
+        return None
+
+    @staticmethod
+    def groupResolver(combined, idx, pattern):
+        """ returns the function mapping a group name or number of command idx to its index in the combined pattern """
+
+        if pattern is None:
+            return lambda name: None
+        count = re.compile(pattern).groups
+        first = combined.groupindex["c{}".format(idx)] - count - 1  # the groups of a query precede its marker
+
+        def resolve(name):
+            if name.isdigit():
+                if int(name) == 0:
+                    return 0  # the whole frame, the matcher matches all of it
+                return first + int(name) if int(name) <= count else None
+            return combined.groupindex.get("c{}_{}".format(idx, name))
+        return resolve
+
+    def match(self, data):
+        """ returns the command answering a frame, None if no query matches """
+
+        command = self.queryIndex.get(data)
+        if command is None and self.matcher:
+            found = self.matcher(data)
+            if found:
+                command = self.patternCommands[found.lastgroup]
+        return command
+
+    def scriptFile(self):
+        """ returns the path of the script belonging to this template """
+
+        return os.path.join(self.path, self.scriptName + ".py")
+
+    def compileScript(self, reload=False):
+        """
+        returns the compiled code of the script, compiled once and shared by
+        every device running this template, reload compiles it again
+        """
+
+        if self.scriptCode is None or reload:
+            fname = self.scriptFile()
+            with open(fname, "rb") as script_file:
+                self.scriptCode = compile(script_file.read(), fname, "exec")
+        return self.scriptCode
+
+    def reloadCommands(self):
+        """ re-reads only the commands from disk, connection details stay as they are """
+
+        with open(self.fname) as data_file:
+            data = json.load(data_file)
+        if data:
+            self.data[7:] = data[7:]
+            self.compile()
@@ -0,0 +1,148 @@
+"""
+    Worker pool mode: spreads the emulators over several processes so the
+    load is not limited to one core.
+
+    Every worker is a python -m peacore process with the same command line
+    that loads and compiles the templates on its own. A single device or a
+    manifest is served by all workers on the same ports with SO_REUSEPORT,
+    so the kernel balances the clients between them. A fleet is split,
+    every worker runs every n-th instance. The parent only reads the log
+    lines and counter reports the workers print to their stdout.
+"""
+
+import os, sys, json, time, queue, signal, socket, asyncio, threading, subprocess
+
+REPORT_INTERVAL = 0.1   # seconds between flushes of the worker log
+COUNTER_INTERVAL = 1.0  # seconds between counter reports
+COUNTER_PREFIX = "#counters "
+COUNTER_KEYS = ("clients", "connected", "rxcount", "rxbytes", "txcount", "txbytes")
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))  # the directory holding peacore
+
+
+class Reporter:
+    """ flushes the log of a worker regularly and reports its summed counters """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    async def run(self, devices):
+        lastcounters = 0.0
+        while True:
+            await asyncio.sleep(REPORT_INTERVAL)
+            if time.monotonic() - lastcounters >= COUNTER_INTERVAL:
+                lastcounters = time.monotonic()
+                self.report(devices)
+            else:
+                self.stream.flush()
+
+    def report(self, devices):
+        totals = dict.fromkeys(COUNTER_KEYS, 0)
+        for device in devices:
+            for key, value in device.counters().items():
+                totals[key] += value
+        totals["devices"] = len(devices)
+        self.stream.write(COUNTER_PREFIX + json.dumps(totals) + "\n")
+        self.stream.flush()
+
+
+def setup_worker(args):
+    """ prepares the arguments of a worker process started by supervise() """
+
+    worker, workers = (int(value) for value in args.worker.split("/"))
+    args.part = (worker, workers)
+    args.reuse_port = args.func.__name__ != "fleet"
+    args.log = None  # the parent writes the log
+    args.stream = sys.stdout
+    args.reporter = Reporter(sys.stdout)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C reaches the parent, which stops the workers
+
+
+def supervise(args, argv):
+    """ starts the workers, prints their logs and a counter summary, returns the exit code """
+
+    if args.func.__name__ != "fleet" and not hasattr(socket, "SO_REUSEPORT"):
+        print("Error: SO_REUSEPORT is not available here, only fleets can be split between workers", file=sys.stderr)
+        return 1
+
+    lines = queue.Queue()
+    processes = []
+    # the workers run in the same directory for relative paths, but have to find peacore from anywhere
+    environment = dict(os.environ)
+    environment["PYTHONPATH"] = os.pathsep.join(filter(None, (PACKAGE_ROOT, environment.get("PYTHONPATH"))))
+    for worker in range(args.workers):
+        command = [sys.executable, "-m", "peacore"] + list(argv) + ["--worker", "{}/{}".format(worker, args.workers)]
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True, bufsize=1, env=environment)
+        reader = threading.Thread(target=read_worker, args=(worker, process, lines), daemon=True)
+        reader.start()
+        processes.append(process)
+
+    stream = open(args.log, "a", buffering=1) if args.log else sys.stdout
+    counters = {}
+    running = len(processes)
+    try:
+        while running:
+            try:
+                worker, line = lines.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            running -= handle_line(worker, line, counters, stream)
+    except KeyboardInterrupt:  # stop the workers and collect their last reports
+        for process in processes:
+            process.terminate()
+        deadline = time.monotonic() + 3
+        while running and time.monotonic() < deadline:
+            try:
+                worker, line = lines.get(timeout=0.2)
+            except (queue.Empty, KeyboardInterrupt):
+                continue
+            running -= handle_line(worker, line, counters, stream)
+    finally:
+        for process in processes:
+            try:
+                process.wait(timeout=3)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        stream.write(counter_table(counters))
+        stream.flush()
+        if stream is not sys.stdout:
+            stream.close()
+
+    return max(process.returncode or 0 for process in processes)
+
+
+def read_worker(worker, process, lines):
+    """ thread passing the stdout lines of one worker to the parent, None when it ended """
+
+    for line in process.stdout:
+        lines.put((worker, line))
+    lines.put((worker, None))
+
+
+def handle_line(worker, line, counters, stream):
+    """ logs or records one line of a worker, returns 1 when the worker ended """
+
+    if line is None:
+        return 1
+    if line.startswith(COUNTER_PREFIX):
+        counters[worker] = json.loads(line[len(COUNTER_PREFIX):])
+    else:
+        stream.write("[w{}] {}".format(worker, line))
+    return 0
+
+
+def counter_table(counters):
+    """ formats the last counters of all workers and their totals as a table """
+
+    header = ("worker", "devices") + COUNTER_KEYS
+    rows = []
+    totals = dict.fromkeys(header[1:], 0)
+    for worker in sorted(counters):
+        values = counters[worker]
+        rows.append(["w{}".format(worker)] + [values.get(key, 0) for key in header[1:]])
+        for key in header[1:]:
+            totals[key] += values.get(key, 0)
+    rows.append(["total"] + [totals[key] for key in header[1:]])
+
+    widths = [max(len(str(row[idx])) for row in rows + [header]) for idx in range(len(header))]
+    lines = [" | ".join(str(value).rjust(width) for value, width in zip(row, widths)) for row in [header] + rows]
+    return "\n".join(lines) + "\n"
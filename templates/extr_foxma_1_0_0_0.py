@@ -1,5 +1,3 @@
-import re
-  
 print('FOX MATRIX Script Imported')
 
 # dev stores all the attributes of the device
@@ -9,45 +7,24 @@ dev = {
 
 audio = []
 video = []
-matchStringDict = {}
-
-def rxscript(conn, rx):
-    ''' Function to deal with more complex requests '''
-    for regexString, CurrentMatch in matchStringDict.items():
-        result = re.search(regexString, rx)
-
-        if result:
-            OutData = CurrentMatch['callback'](result, CurrentMatch['para'])
-    return OutData
-
-def AddMatchString(regex_string, callback, arg):
-    ''' Only add regex handler if not already in list '''
-    #if regex_string not in matchStringDict:
-    matchStringDict[regex_string] = {'callback': callback, 'para':arg}
 
-def addMatch():
-    ''' Builds all regex searches into a dict  '''
-    AddMatchString(re.compile(b'w\d+cv\\r\\n'), MatchVerboseModeSet, None)
-    AddMatchString(re.compile(b'\x1bEXEC\\r'), MatchExecModeSet, None)
-    AddMatchString(re.compile(b'(\d+)\*(\d+)(\&|\$|\!)'), MatchMatrixTieSet, None)
-    AddMatchString(re.compile(b'w0\*(\d+)\*(\d+)vc\\r'), MatchMatrixStatusRequest, None)
-    #AddMatchString(re.compile(b'\x1bE(\d+)HDCP\\r'), MatchHDCPAuthRequest, None)
-    #AddMatchString(re.compile(b'E(\d+)\*(\d)HDCP\\r'), MatchHDCPAuthSet, None)
-    #AddMatchString(re.compile(b'wO\*HDCP\\r'), MatchHDCPRequestAll, None)
-    #AddMatchString(re.compile(b'0\*\!'), MatchResetMatrix, None)
-    print("Add match complete")
+# pea.on registers the handlers, PEA searches all their patterns at once
+# and calls the one that matched with the match of its own pattern
 
-def MatchVerboseModeSet(match, tag):
+@pea.on(rb'w\d+cv\r\n')
+def MatchVerboseModeSet(conn, match):
     ''' Response to verbose mode setting from GCP diver '''
     print("VB Set")
     return "Vrb3\r\n"
-    
-def MatchExecModeSet(match, tag):
+
+@pea.on(rb'\x1bEXEC\r')
+def MatchExecModeSet(conn, match):
     ''' Respond to EXEC mode from GCP - used as heartbeat/keepalive '''
     return "Exec2\r\n"
 
 TieTypes = {"$":"Aud", "&":"Vid", "!":"All"}
-def MatchMatrixTieSet(match, tag):
+@pea.on(rb'(\d+)\*(\d+)(&|\$|!)')
+def MatchMatrixTieSet(conn, match):
     ''' Incomming tie commands from GCP. Feedback is then sent to ALL rooms/GCP '''
     In = match.group(1).decode()
     Out = match.group(2).decode()
@@ -61,8 +38,9 @@ def MatchMatrixTieSet(match, tag):
         video[int(Out) - 1] = int(In)    
     cmd = "Out{} In{} {}\n\r".format(Out, In, TieType)
     return cmd
-    
-def MatchMatrixStatusRequest(match, tag):
+
+@pea.on(rb'w0\*(\d+)\*(\d+)vc\r')
+def MatchMatrixStatusRequest(conn, match):
     ''' send entire status of matrix to GCP system '''
     start = int(match.group(1).decode())
     TieTypeNum = int(match.group(2).decode())
@@ -72,6 +50,8 @@ def MatchMatrixStatusRequest(match, tag):
     elif TieTypeNum == 2:
         TieType = 'Vid'
         statusList = video
+    else:
+        return None
     cmdList = []
     
     for x in range(start, start + 16):
@@ -79,6 +59,11 @@ def MatchMatrixStatusRequest(match, tag):
     cmd = 'Vgp00 Out00*{}{}\r\n'.format(''.join(cmdList), TieType)
     return cmd
 
+#@pea.on(rb'\x1bE(\d+)HDCP\r') MatchHDCPAuthRequest
+#@pea.on(rb'E(\d+)\*(\d)HDCP\r') MatchHDCPAuthSet
+#@pea.on(rb'wO\*HDCP\r') MatchHDCPRequestAll
+#@pea.on(rb'0\*\!') MatchResetMatrix
+
 def initMatrix():
     ''' Sets all the status elements of the lists at startup '''
     for x in range(33):
@@ -86,19 +71,7 @@ def initMatrix():
         video.append(0)
     print("Matrix initialized")
 
-def HandleReceiveData(data):
-    ''' Incoming XTP commands from the GCP driver in the room systems '''
-        
-    for regexString, CurrentMatch in matchStringDict.items():
-        result = re.search(regexString, data)
-
-        if result:
-            CurrentMatch['callback'](result, CurrentMatch['para'])
-            return
-    print('Room: {} NO MATCH Rx: {} '.format(roomNum, data))
-
 initMatrix()
-addMatch()
 
 ''' ***************************** '''
 ''' Custom functions from buttons '''
@@ -0,0 +1 @@
+""" Tests of peacore, run with python -m unittest from the repository root. """
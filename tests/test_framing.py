@@ -0,0 +1,32 @@
+"""
+    Tests of the stream framing, run with python -m unittest from the
+    repository root.
+"""
+
+import unittest
+
+from peacore.framing import Framer, compile_framing
+
+
+def framer(options):
+    frames = []
+    return Framer(compile_framing(options), None, frames.append), frames
+
+
+class LengthFramingTest(unittest.TestCase):
+
+    def test_split_and_merged_frames(self):
+        feeder, frames = framer({"Mode": "length", "Offset": 0, "Size": 1})
+        feeder.feed(b"\x02a")
+        feeder.feed(b"b\x01c\x02")
+        self.assertEqual(frames, [b"\x02ab", b"\x01c"])
+
+    def test_frames_before_an_invalid_prefix_are_kept(self):
+        feeder, frames = framer({"Mode": "length", "Offset": 0, "Size": 1, "Adjust": -2})
+        with self.assertRaisesRegex(ValueError, "Invalid length prefix"):
+            feeder.feed(b"\x03a\x03b\x00")
+        self.assertEqual(frames, [b"\x03a", b"\x03b"])
+
+
+if __name__ == "__main__":
+    unittest.main()
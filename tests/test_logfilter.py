@@ -0,0 +1,55 @@
+"""
+    Tests of the incremental log filters, run with python -m unittest from
+    the repository root.
+"""
+
+import unittest
+
+from peacore.logstore import LogStore
+from peacore.logfilter import FilterCache
+
+
+class FilterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = LogStore()
+        self.store.append("IN", b"ERR #3", 1)
+        self.store.append("ER", b"bad", 2)
+        self.store.append("OU", b"x", 3)
+
+    def select(self, mode, words, cache=None):
+        return list((cache or FilterCache(self.store)).select(mode, words).matches)
+
+    def test_plain_words_are_substrings(self):
+        self.assertEqual(self.select("AND", ["ER"]), [0, 1])
+        self.assertEqual(self.select("AND", ["#3"]), [0, 2])
+
+    def test_field_words(self):
+        self.assertEqual(self.select("AND", ["=ER"]), [1])
+        self.assertEqual(self.select("AND", ["=#3"]), [2])
+        self.assertEqual(self.select("OR", ["=#2", "=OU"]), [1, 2])
+
+    def test_refining_a_field_word_rescans(self):
+        self.store.append("IN", b"=I", 4)
+        cache = FilterCache(self.store)
+        self.select("AND", ["=I"], cache)
+        self.assertEqual(self.select("AND", ["=IN"], cache), self.select("AND", ["=IN"]))
+
+    def test_refining_a_substring(self):
+        cache = FilterCache(self.store)
+        self.select("AND", ["R"], cache)
+        self.assertEqual(self.select("AND", ["ERR"], cache), [0])
+
+    def test_update_in_chunks(self):
+        for number in range(10):
+            self.store.append("IN", b"ERR %d" % number, number % 3)
+        logfilter = FilterCache(self.store).select("AND", ["ERR"], 4)
+        chunks = [list(logfilter.matches)]
+        while logfilter.pending:
+            chunks.append(logfilter.update(4))
+        self.assertEqual(sum(chunks, []), self.select("AND", ["ERR"]))
+        self.assertEqual(list(logfilter.matches), self.select("AND", ["ERR"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
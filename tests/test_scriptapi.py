@@ -0,0 +1,38 @@
+"""
+    Tests of the pea.on handler registry of scripts, run with
+    python -m unittest from the repository root.
+"""
+
+import re
+import unittest
+
+from peacore.scriptapi import ScriptRegistry
+
+
+def registry(*patterns):
+    pea = ScriptRegistry()
+    for number, (pattern, flags) in enumerate(patterns):
+        pea.on(pattern, flags)(lambda conn, match, number=number: (number, match.group(0), match.groups()))
+    return pea.bind(None)
+
+
+class DispatchTest(unittest.TestCase):
+
+    def test_inline_global_flags(self):
+        dispatch = registry((rb"(x)(y)", 0), (rb"(?i)abc(\d)", 0), (rb"q", re.IGNORECASE))
+        self.assertEqual(dispatch(None, b"ABC4"), (1, b"ABC4", (b"4",)))
+        self.assertEqual(dispatch(None, b"Q"), (2, b"Q", ()))
+        self.assertIsNone(dispatch(None, b"XY"))
+
+    def test_numbered_backreference_goes_to_its_handler(self):
+        dispatch = registry((rb"(x)(y)", 0), (rb"(a)\1", 0))
+        self.assertEqual(dispatch(None, b"-aa"), (1, b"aa", (b"a",)))
+        self.assertIsNone(dispatch(None, b"ab"))
+
+    def test_backreference_to_no_group(self):
+        with self.assertRaisesRegex(ValueError, "invalid group reference"):
+            registry((rb"(a)\2", 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
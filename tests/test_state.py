@@ -0,0 +1,55 @@
+"""
+    Tests of the declarative device state, run with python -m unittest
+    from the repository root.
+"""
+
+import unittest
+from types import SimpleNamespace
+
+from peacore.template import Template
+
+HEADER = [
+    {"Manufacturer": "Test"}, {"Model": "Matrix"}, {"Category": "Test"}, {"Version": "1.0"},
+    {"Port": "5000"}, {"Delay": "0"}, {"Script": False},
+]
+COMMANDS = [
+    {"Description": "Set", "Type": "regex", "Query": r"S(?P<output>-?\d+)=(?P<input>\d+)", "Response": "OK",
+     "Actions": [{"Set": "video", "Index": "{output}", "Value": "{input}"}]},
+    {"Description": "Get", "Type": "regex", "Query": r"G(?P<output>-?\d+)", "Response": "{state.video[output]}",
+     "Format": True},
+]
+STATE = {"State": {"Scope": "device", "Variables": {"video": {"Type": "int", "Size": 4, "Base": 1}}}}
+
+
+class ArrayIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.template = Template(HEADER + [COMMANDS, STATE])
+        self.device = SimpleNamespace(variables=self.template.state.new())
+
+    def request(self, frame):
+        command = self.template.match(frame)
+        found = self.template.matcher(frame)
+        if command.actions:
+            command.actions(found, None, self.device, command)
+        return command.render(found, None, self.device, command) if command.render else command.response
+
+    def test_index_within_base(self):
+        self.request(b"S1=7")
+        self.request(b"S4=9")
+        self.assertEqual(list(self.device.variables[0]), [7, 0, 0, 9])
+        self.assertEqual(self.request(b"G4"), b"9")
+
+    def test_index_outside_does_not_change_state(self):
+        for frame in (b"S0=7", b"S5=7", b"S-1=7"):
+            with self.assertRaises(ValueError):
+                self.request(frame)
+        self.assertEqual(list(self.device.variables[0]), [0, 0, 0, 0])
+
+    def test_index_outside_in_response(self):
+        with self.assertRaises(ValueError):
+            self.request(b"G0")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+"""
+    Tests of the combined matcher of prefix, regex and mask queries,
+    run with python -m unittest from the repository root.
+"""
+
+import unittest
+
+from peacore.template import Template
+
+HEADER = [
+    {"Manufacturer": "Test"}, {"Model": "Matcher"}, {"Category": "Test"}, {"Version": "1.0"},
+    {"Port": "5000"}, {"Delay": "0"}, {"Script": False},
+]
+
+
+def template(*commands):
+    return Template(HEADER + [list(commands)])
+
+
+def regex(description, query, response="", **options):
+    return dict(Description=description, Type="regex", Query=query, Response=response, **options)
+
+
+class CombinedMatcherTest(unittest.TestCase):
+
+    def assertMatches(self, tpl, frame, description):
+        command = tpl.match(frame)
+        self.assertEqual(command.description if command else None, description, frame)
+
+    def test_numbered_backreference_after_other_queries(self):
+        tpl = template(regex("pair", "(x)(y)"), regex("double", r"(a)\1"))
+        self.assertMatches(tpl, b"xy", "pair")
+        self.assertMatches(tpl, b"aa", "double")
+        self.assertMatches(tpl, b"ab", None)
+
+    def test_numbered_conditional_after_other_queries(self):
+        tpl = template(regex("pair", "(x)(y)"), regex("bracket", "(<)?k(?(1)>)"))
+        self.assertMatches(tpl, b"<k>", "bracket")
+        self.assertMatches(tpl, b"k", "bracket")
+        self.assertMatches(tpl, b"<k", None)
+
+    def test_backreference_to_no_group(self):
+        with self.assertRaisesRegex(ValueError, "Command 0"):
+            template(regex("bad", r"(a)\2"))
+
+    def test_inline_global_flags(self):
+        tpl = template(regex("power", "PWR"), regex("volume", r"(?i)vol(\d)", "VOL{1}", Format=True))
+        self.assertMatches(tpl, b"vOl4", "volume")
+        self.assertMatches(tpl, b"pwr", None)
+        command = tpl.match(b"Vol4")
+        self.assertEqual(command.render(tpl.matcher(b"Vol4"), None, None, command), b"VOL4")
+
+    def test_escapes_and_classes_are_not_groups(self):
+        tpl = template(regex("pair", "(x)(y)"), regex("class", r"[(\1]\(\101"))
+        self.assertMatches(tpl, b"((A", "class")
+        self.assertMatches(tpl, b"\x01(A", "class")
+
+
+if __name__ == "__main__":
+    unittest.main()